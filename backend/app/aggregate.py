@@ -0,0 +1,287 @@
+"""Area statistics and threshold exceedance over a region x time window.
+
+The window is reduced one time step at a time (a step is one contiguous read
+in the map layout), so memory stays at one region slice regardless of the
+window length. Each step is reduced to a small partial:
+
+* count / sum / sum of squares / min / max and a fixed-bin histogram of the
+  values inside the region, and
+* per threshold, a packed bitmask of the region cells above (or below) it.
+
+Partials are keyed by (source file stamp, variable, region, step time[,
+threshold]) and kept in an LRU with a byte budget, so a query that overlaps an
+earlier one (same area, shifted window; same window, another threshold) only
+reduces the steps it has not seen. Percentiles come from the merged
+histograms; their resolution is the bin width of the variable's range.
+"""
+
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .store import nearest_indices
+
+HIST_BINS = 1000
+
+# диапазоны гистограмм для процентилей (вне диапазона — в крайние корзины)
+RANGES: Dict[str, Tuple[float, float]] = {
+    "VHM0": (0.0, 20.0), "VTPK": (0.0, 30.0), "VTM10": (0.0, 30.0), "VMDR": (0.0, 360.0),
+    "uo": (-3.0, 3.0), "vo": (-3.0, 3.0), "cur_speed": (0.0, 4.0), "cur_dir": (0.0, 360.0),
+    "thetao": (-2.0, 30.0), "so": (0.0, 40.0), "zos": (-3.0, 3.0),
+    "siconc": (0.0, 1.0), "siconc_pct": (0.0, 100.0), "sithick": (0.0, 5.0),
+    "ice_drift_speed": (0.0, 2.0), "ice_drift_dir": (0.0, 360.0), "sea_state": (0.0, 10.0),
+}
+
+OPS = {"gt": np.greater, "ge": np.greater_equal, "lt": np.less, "le": np.less_equal}
+
+
+def value_range(variable: str, attrs: dict) -> Optional[Tuple[float, float]]:
+    if variable in RANGES:
+        return RANGES[variable]
+    lo, hi = attrs.get("valid_min"), attrs.get("valid_max")
+    if lo is not None and hi is not None and float(hi) > float(lo):
+        return float(lo), float(hi)
+    return None
+
+
+def points_in_polygon(x: np.ndarray, y: np.ndarray, poly: np.ndarray) -> np.ndarray:
+    """Чётно-нечётное правило, векторно по точкам (цикл только по рёбрам)."""
+    inside = np.zeros(x.shape, dtype=bool)
+    xs, ys = poly[:, 0], poly[:, 1]
+    for (x1, y1), (x2, y2) in zip(zip(xs, ys), zip(np.roll(xs, -1), np.roll(ys, -1))):
+        if y1 == y2:
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        x_at = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < x_at)
+    return inside
+
+
+class Region:
+    """bbox, полигон (lon, lat) или набор точек; cells() — индексы узлов сетки внутри."""
+
+    def __init__(self, bbox: Optional[Sequence[float]] = None, polygon: Optional[Sequence[Sequence[float]]] = None,
+                 points: Optional[Sequence[Sequence[float]]] = None):
+        given = [v is not None for v in (bbox, polygon, points)]
+        if sum(given) != 1:
+            raise ValueError("Нужно ровно одно из: bbox, polygon, points")
+        self.polygon = self.points = None
+        if bbox is not None:
+            if len(bbox) != 4:
+                raise ValueError("bbox: [min_lon, min_lat, max_lon, max_lat]")
+            x0, y0, x1, y1 = (float(v) for v in bbox)
+            self.bounds = (min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1))
+            self.kind, raw = "bbox", list(self.bounds)
+        elif polygon is not None:
+            self.polygon = np.asarray(polygon, dtype=float)
+            if self.polygon.ndim != 2 or self.polygon.shape[1] != 2 or len(self.polygon) < 3:
+                raise ValueError("polygon: не менее трёх вершин [lon, lat]")
+            self.bounds = (self.polygon[:, 0].min(), self.polygon[:, 0].max(),
+                           self.polygon[:, 1].min(), self.polygon[:, 1].max())
+            self.kind, raw = "polygon", self.polygon.round(6).tolist()
+        else:
+            self.points = np.asarray(points, dtype=float)  # (n, 2): lat, lon
+            if self.points.ndim != 2 or self.points.shape[1] != 2 or not len(self.points):
+                raise ValueError("points: список [lat, lon]")
+            self.bounds = (self.points[:, 1].min(), self.points[:, 1].max(),
+                           self.points[:, 0].min(), self.points[:, 0].max())
+            self.kind, raw = "points", self.points.round(6).tolist()
+        self.key = self.kind + ":" + hashlib.sha1(json.dumps(raw).encode("utf-8")).hexdigest()[:16]
+        self._cells: Dict[Hashable, Tuple[np.ndarray, np.ndarray]] = {}
+
+    def cells(self, lats: np.ndarray, lons: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        sig = (lats.size, float(lats[0]), float(lats[-1]), lons.size, float(lons[0]), float(lons[-1]))
+        found = self._cells.get(sig)
+        if found is not None:
+            return found
+        if self.kind == "points":
+            # точка -> ближайший узел (повторы допустимы: у каждой точки свой ряд)
+            iy, ix = nearest_indices(lats, self.points[:, 0]), nearest_indices(lons, self.points[:, 1])
+        else:
+            glon, glat = np.meshgrid(lons, lats)
+            x0, x1, y0, y1 = self.bounds
+            mask = (glon >= x0) & (glon <= x1) & (glat >= y0) & (glat <= y1)
+            if self.kind == "polygon":
+                mask &= points_in_polygon(glon, glat, self.polygon)
+            if not mask.any():
+                # область уже ячейки сетки — берём ближайший к центру узел
+                mask[nearest_indices(lats, [(y0 + y1) / 2])[0], nearest_indices(lons, [(x0 + x1) / 2])[0]] = True
+            iy, ix = np.nonzero(mask)
+        self._cells[sig] = (iy, ix)
+        return iy, ix
+
+
+class Partial(NamedTuple):
+    count: int
+    total: float
+    total_sq: float
+    vmin: float
+    vmax: float
+    hist: Optional[np.ndarray]
+
+
+class Exceed(NamedTuple):
+    count: int          # узлов за порогом на этом сроке
+    valid: int          # узлов с данными
+    cells: int          # узлов области (длина маски до упаковки)
+    bits: np.ndarray    # упакованная маска по узлам области
+    wet: np.ndarray     # упакованная маска узлов с данными (суша и NaN — 0)
+
+
+def reduce_step(values: np.ndarray, rng: Optional[Tuple[float, float]]) -> Partial:
+    v = values[np.isfinite(values)]
+    if not v.size:
+        return Partial(0, 0.0, 0.0, np.inf, -np.inf, np.zeros(HIST_BINS, np.int32) if rng else None)
+    hist = None
+    if rng:
+        idx = np.clip(((v - rng[0]) / (rng[1] - rng[0]) * HIST_BINS).astype(np.int64), 0, HIST_BINS - 1)
+        hist = np.bincount(idx, minlength=HIST_BINS).astype(np.int32)
+    return Partial(int(v.size), float(v.sum(dtype=np.float64)), float(np.square(v, dtype=np.float64).sum()),
+                   float(v.min()), float(v.max()), hist)
+
+
+def exceed_step(values: np.ndarray, op: str, threshold: float) -> Exceed:
+    with np.errstate(invalid="ignore"):
+        above = OPS[op](values, threshold)
+    finite = np.isfinite(values)
+    return Exceed(int(above.sum()), int(finite.sum()), above.size, np.packbits(above), np.packbits(finite))
+
+
+def hist_percentiles(hist: np.ndarray, rng: Tuple[float, float], qs: Iterable[float]) -> Dict[str, float]:
+    cum = np.cumsum(hist, dtype=np.float64)
+    n = cum[-1]
+    width = (rng[1] - rng[0]) / HIST_BINS
+    out = {}
+    for q in qs:
+        target = q / 100.0 * n
+        i = int(np.searchsorted(cum, target))
+        i = min(i, HIST_BINS - 1)
+        before = cum[i - 1] if i else 0.0
+        frac = (target - before) / hist[i] if hist[i] else 0.0
+        out[f"{q:g}"] = rng[0] + (i + frac) * width
+    return out
+
+
+class Step(NamedTuple):
+    """Один срок окна: ключ источника (None — не кэшировать) и чтение (values, lats, lons)."""
+    source: Optional[Hashable]
+    time: np.datetime64
+    read: Callable[[], Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+
+class AreaStats:
+    """Свёртка окна по срокам с LRU частичных результатов (бюджет в байтах)."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lru: "OrderedDict[tuple, object]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._mu = threading.Lock()  # run() идёт в потоках, по запросу на поток
+
+    def stats(self) -> dict:
+        return {"entries": len(self._lru), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
+
+    @staticmethod
+    def _size(value) -> int:
+        if isinstance(value, Partial):
+            return 64 + (value.hist.nbytes if value.hist is not None else 0)
+        return 64 + value.bits.nbytes + value.wet.nbytes
+
+    def _get(self, key: Optional[tuple]):
+        if key is None:
+            return None
+        with self._mu:
+            value = self._lru.get(key)
+            if value is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+        return value
+
+    def _put(self, key: Optional[tuple], value) -> None:
+        with self._mu:
+            self.misses += 1
+            if key is None or key in self._lru:
+                return
+            self._lru[key] = value
+            self._bytes += self._size(value)
+            while self._bytes > self.max_bytes and self._lru:
+                _, old = self._lru.popitem(last=False)
+                self._bytes -= self._size(old)
+
+    def run(self, steps: List[Step], variable: str, attrs: dict, region: Region,
+            percentiles: Sequence[float] = (), thresholds: Sequence[Tuple[str, float]] = (),
+            series: bool = False) -> dict:
+        rng = value_range(variable, attrs)
+        partials: List[Partial] = []
+        exceeds: Dict[Tuple[str, float], List[Exceed]] = {t: [] for t in thresholds}
+        for step in steps:
+            base = None if step.source is None else (step.source, variable, region.key, str(step.time))
+            part = self._get(base)
+            found = {t: self._get(base + t) if base is not None else None for t in thresholds}
+            if part is None or None in found.values():
+                grid, lats, lons = step.read()
+                iy, ix = region.cells(lats, lons)
+                values = np.asarray(grid, dtype=float)[iy, ix]
+                if part is None:
+                    part = reduce_step(values, rng)
+                    self._put(base, part)
+                for t, ex in found.items():
+                    if ex is None:
+                        found[t] = exceed_step(values, *t)
+                        self._put(base and base + t, found[t])
+            partials.append(part)
+            for t, ex in found.items():
+                exceeds[t].append(ex)
+        return self._combine(steps, partials, exceeds, rng, percentiles, series, region.kind == "points")
+
+    @staticmethod
+    def _combine(steps: List[Step], partials: List[Partial], exceeds: Dict[Tuple[str, float], List[Exceed]],
+                 rng: Optional[Tuple[float, float]], percentiles: Sequence[float], series: bool,
+                 per_cell: bool) -> dict:
+        times = np.array([s.time for s in steps], dtype="datetime64[ns]")
+        step_h = float(np.median(np.diff(times)) / np.timedelta64(1, "h")) if times.size > 1 else 1.0
+        n = sum(p.count for p in partials)
+        out: dict = {"steps": len(steps), "step_hours": step_h, "count": n}
+        if n:
+            mean = sum(p.total for p in partials) / n
+            var = max(0.0, sum(p.total_sq for p in partials) / n - mean * mean)
+            out.update(min=min(p.vmin for p in partials), max=max(p.vmax for p in partials),
+                       mean=mean, std=var ** 0.5)
+            if percentiles and rng:
+                hist = np.sum([p.hist for p in partials], axis=0)
+                out["percentiles"] = hist_percentiles(hist, rng, percentiles)
+                out["percentile_resolution"] = (rng[1] - rng[0]) / HIST_BINS
+        if series:
+            out["series"] = {
+                "min": [p.vmin if p.count else None for p in partials],
+                "max": [p.vmax if p.count else None for p in partials],
+                "mean": [p.total / p.count if p.count else None for p in partials],
+            }
+        out["exceedance"] = []
+        for (op, thr), items in exceeds.items():
+            pct = np.array([e.count / e.valid * 100.0 if e.valid else np.nan for e in items])
+            steps_above = (np.sum([np.unpackbits(e.bits)[:e.cells] for e in items], axis=0) if items
+                           else np.zeros(0))
+            # знаменатель — узлы, где данные были хотя бы на одном сроке (не суша)
+            wet = (np.any([np.unpackbits(e.wet)[:e.cells] for e in items], axis=0) if items
+                   else np.zeros(0, dtype=bool))
+            hours = steps_above * step_h
+            entry = {"op": op, "threshold": thr,
+                     "area_pct_max": float(np.nanmax(pct)) if np.isfinite(pct).any() else None,
+                     "area_pct_mean": float(np.nanmean(pct)) if np.isfinite(pct).any() else None,
+                     "hours_max": float(hours.max()) if hours.size else 0.0,
+                     "hours_mean": float(hours[wet].mean()) if wet.any() else 0.0,
+                     "area_pct_ever": float((steps_above[wet] > 0).mean() * 100.0) if wet.any() else 0.0}
+            if series:
+                entry["area_pct"] = [None if np.isnan(v) else float(v) for v in pct]
+            if per_cell:
+                entry["hours"] = [float(h) if w else None for h, w in zip(hours, wet)]
+            out["exceedance"].append(entry)
+        return out
@@ -0,0 +1,435 @@
+"""Server-side alert rules over a watchlist of points and areas.
+
+Rules (variable, op, threshold, at a point or over an area) live in one JSON
+file under CACHE_DIR shared by all workers. Every check walks the forecast
+horizon of each (dataset, variable) one time step at a time: one read of the
+rules' common bbox per step, then one vectorized pass for all rules on that
+variable — points by fancy indexing, areas by their cell lists, thresholds
+compared per op over arrays. Per-step results are cached by source file
+version, so after an ingest only the newly written steps are read.
+
+Each worker evaluates for its own subscribers; changes of a rule's state
+(raised / cleared / updated) go through AlertHub to the SSE and WebSocket
+streams in main.py. Event ids come from a journal shared by all workers (a
+JSON file under a file lock): a transition already written by another worker
+keeps its id, so a client reconnecting with Last-Event-ID to any worker gets
+the events it missed from that journal. Point rules are moved to the nearest
+sea cell first (``snap``), otherwise a coastal point would read NaN.
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+import contextlib
+from collections import OrderedDict, deque
+from typing import Callable, ContextManager, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .aggregate import OPS, Region, Step
+from .shared import FileLock
+from .store import nearest_indices
+
+log = logging.getLogger("uvicorn.error")
+
+# (dataset_id, variable, xmin, xmax, ymin, ymax, t_start, t_end) -> сроки окна или None
+StepSource = Callable[[str, str, float, float, float, float, str, str], Optional[List[Step]]]
+# (dataset_id, variable, lats, lons) -> координаты ближайших морских узлов
+PointSnap = Callable[[str, str, List[float], List[float]], Tuple[np.ndarray, np.ndarray]]
+
+
+def _iso(t: np.datetime64) -> str:
+    return str(np.datetime64(t, "s")) + "Z"
+
+
+def rule_region(rule: dict) -> Region:
+    if rule.get("lat") is not None and rule.get("lon") is not None:
+        return Region(points=[[rule["lat"], rule["lon"]]])
+    return Region(bbox=rule.get("bbox"), polygon=rule.get("polygon"))
+
+
+class Watchlist:
+    """Правила в JSON-файле; изменения — под блокировкой файла, чтение — по mtime."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rules: Dict[str, dict] = {}
+        self._mtime: Optional[int] = None
+        self._lock = FileLock(path + ".lock")
+        self.reload()
+
+    def reload(self) -> bool:
+        """Перечитать файл, если его изменил этот или другой процесс; True — правила сменились."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                rules = json.load(f).get("rules", [])
+        except (OSError, ValueError):
+            rules = []
+        self.rules = {r["id"]: r for r in rules}
+        return True
+
+    def _write(self) -> None:
+        tmp = f"{self.path}.{os.getpid()}.part"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "rules": list(self.rules.values())}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self._mtime = None
+        self.reload()
+
+    def add(self, rule: dict) -> dict:
+        with self._lock:
+            self._mtime = None
+            self.reload()
+            rule = dict(rule, id=uuid.uuid4().hex[:12], created=time.time())
+            self.rules[rule["id"]] = rule
+            self._write()
+        return rule
+
+    def remove(self, rule_id: str) -> bool:
+        with self._lock:
+            self._mtime = None
+            self.reload()
+            if self.rules.pop(rule_id, None) is None:
+                return False
+            self._write()
+        return True
+
+
+class RuleSet:
+    """Правила одной переменной в виде массивов для векторной проверки на срезе."""
+
+    def __init__(self, rules: List[dict]):
+        self.rules = rules
+        self.ids = [r["id"] for r in rules]
+        self.ops = np.array([r["op"] for r in rules])
+        self.thresholds = np.array([float(r["threshold"]) for r in rules])
+        self.min_area_pct = np.array([float(r.get("min_area_pct") or 0.0) for r in rules])
+        self.regions = [rule_region(r) for r in rules]
+        self.is_point = np.array([reg.kind == "points" for reg in self.regions])
+        x0 = min(reg.bounds[0] for reg in self.regions)
+        x1 = max(reg.bounds[1] for reg in self.regions)
+        y0 = min(reg.bounds[2] for reg in self.regions)
+        y1 = max(reg.bounds[3] for reg in self.regions)
+        self.bounds = (x0, x1, y0, y1)
+        raw = json.dumps([[r["id"], r["op"], r["threshold"], r.get("min_area_pct"), reg.key]
+                          for r, reg in zip(rules, self.regions)])
+        self.key = hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+        self._points = np.array([reg.points[0] for reg, p in zip(self.regions, self.is_point) if p]).reshape(-1, 2)
+
+    def compare(self, values: np.ndarray) -> np.ndarray:
+        hit = np.zeros(values.shape, dtype=bool)
+        with np.errstate(invalid="ignore"):
+            for op, fn in OPS.items():
+                m = self.ops == op
+                if m.any():
+                    hit[m] = fn(values[m], self.thresholds[m])
+        return hit
+
+    def evaluate(self, grid: np.ndarray, lats: np.ndarray, lons: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(значение, доля площади за порогом %, срабатывание) по всем правилам на одном срезе.
+
+        Для точки значение — в ближайшем узле; для области — максимум (для
+        gt/ge) или минимум (lt/le) по узлам, а доля площади — от узлов с данными.
+        """
+        grid = np.asarray(grid, dtype=float)
+        n = len(self.rules)
+        values = np.full(n, np.nan)
+        pct = np.full(n, np.nan)
+        if self.is_point.any():
+            iy = nearest_indices(lats, self._points[:, 0])
+            ix = nearest_indices(lons, self._points[:, 1])
+            values[self.is_point] = grid[iy, ix]
+        for i in np.nonzero(~self.is_point)[0]:
+            cells = grid[self.regions[i].cells(lats, lons)]
+            valid = cells[np.isfinite(cells)]
+            if not valid.size:
+                continue
+            values[i] = valid.max() if self.ops[i] in ("gt", "ge") else valid.min()
+            pct[i] = OPS[self.ops[i]](valid, self.thresholds[i]).mean() * 100.0
+        hit = self.compare(values)
+        hit &= self.is_point | (np.nan_to_num(pct) >= self.min_area_pct)
+        return values, pct, hit
+
+
+def _transition(event: dict) -> tuple:
+    """Что именно изменилось — без времени публикации: одинаково у всех воркеров."""
+    a = event.get("alert", {})
+    return (event["type"], a.get("rule_id"), a.get("active"), a.get("first_utc"), a.get("peak"), a.get("peak_utc"))
+
+
+class AlertHub:
+    """Рассылка событий подписчикам воркера (очереди asyncio).
+
+    Номера событий и буфер для переподключений — в общем журнале path (под
+    блокировкой файла, запись в потоке); без path — только в памяти процесса.
+    Прочитанный журнал держится в памяти и перечитывается, только когда файл
+    изменился.
+    """
+
+    def __init__(self, path: Optional[str] = None, history: int = 256, queue_size: int = 256):
+        self.path = path
+        self.history = history
+        self.queue_size = queue_size
+        self.published = 0
+        self._seq = 0
+        self._recent: deque = deque(maxlen=history)
+        self._subs: set = set()
+        self._lock = FileLock(path + ".lock") if path else None
+        self._cached: Tuple[Optional[int], dict] = (None, {"seq": 0, "events": []})
+
+    def stats(self) -> dict:
+        return {"subscribers": len(self._subs), "published": self.published}
+
+    def subscribe(self) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subs.add(q)
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue) -> None:
+        self._subs.discard(q)
+
+    def _read(self) -> dict:
+        """Журнал; с диска — только если файл изменился с прошлого чтения."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        cached_mtime, journal = self._cached
+        if mtime is None or mtime == cached_mtime:
+            return journal
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return journal
+        self._cached = (mtime, journal)
+        return journal
+
+    def _journal(self, events: List[dict]) -> List[dict]:
+        """События с общими номерами; переход, уже записанный другим воркером, сохраняет свой номер."""
+        out = []
+        with self._lock:
+            journal = self._read()
+            seq = journal["seq"]
+            journal = {"seq": seq, "events": list(journal["events"])}
+            for event in events:
+                rid = event.get("alert", {}).get("rule_id")
+                for e in reversed(journal["events"]):
+                    if e.get("alert", {}).get("rule_id") == rid:
+                        if _transition(e) == _transition(event):
+                            event = e
+                        break
+                if "id" not in event:
+                    journal["seq"] += 1
+                    event = dict(event, id=journal["seq"])
+                    journal["events"] = (journal["events"] + [event])[-self.history:]
+                out.append(event)
+            if journal["seq"] == seq:
+                return out
+            tmp = f"{self.path}.{os.getpid()}.part"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(journal, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._cached = (os.stat(self.path).st_mtime_ns, journal)
+        return out
+
+    async def publish(self, events: List[dict]) -> None:
+        if not events:
+            return
+        if self.path:
+            events = await asyncio.to_thread(self._journal, events)
+        else:
+            events = [dict(e, id=self._seq + i + 1) for i, e in enumerate(events)]
+            self._recent.extend(events)
+        for event in events:
+            self._seq = max(self._seq, event["id"])
+            self.published += 1
+            for q in self._subs:
+                if q.full():
+                    # медленный клиент теряет самое старое, а не тормозит остальных
+                    q.get_nowait()
+                q.put_nowait(event)
+
+    def last_id(self) -> int:
+        """Номер последнего события (общий для воркеров, если есть журнал)."""
+        return self._read()["seq"] if self.path else self._seq
+
+    async def since(self, last_id: int) -> Optional[List[dict]]:
+        """События после last_id или None, если буфер их уже не хранит (нужен снимок)."""
+        if self.path:
+            journal = await asyncio.to_thread(self._read)
+            seq, recent = journal["seq"], journal["events"]
+        else:
+            seq, recent = self._seq, list(self._recent)
+        if last_id > seq or (recent and recent[0]["id"] > last_id + 1):
+            return None
+        return [e for e in recent if e["id"] > last_id]
+
+
+class AlertEngine:
+    def __init__(self, watchlist: Watchlist, hub: AlertHub, steps: StepSource,
+                 horizon_h: float = 72.0, interval_s: float = 30.0, max_cached_steps: int = 4096,
+                 snap: Optional[PointSnap] = None,
+                 reading: Callable[[], ContextManager] = contextlib.nullcontext):
+        self.watchlist = watchlist
+        self.hub = hub
+        self.steps = steps
+        self.snap = snap
+        # на время чтения сроков: источник не закрывает файлы, из которых они читаются
+        self.reading = reading
+        self.horizon_h = horizon_h
+        self.interval_s = interval_s
+        self.max_cached_steps = max_cached_steps
+        self.state: Dict[str, dict] = {}
+        self.checks = 0
+        self.last_check: dict = {}
+        self._cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._checking = asyncio.Lock()
+        self._rule_ids: set = set()
+
+    def stats(self) -> dict:
+        return {"rules": len(self.watchlist.rules), "active": sum(s["active"] for s in self.state.values()),
+                "checks": self.checks, "last_check": self.last_check, "cached_steps": len(self._cache),
+                **self.hub.stats()}
+
+    def snapshot(self, rule_ids: Optional[set] = None) -> List[dict]:
+        return [s for rid, s in self.state.items() if rule_ids is None or rid in rule_ids]
+
+    def _snapped(self, ds_id: str, variable: str, rules: List[dict]) -> List[dict]:
+        """Копии правил, где точки перенесены в ближайший морской узел."""
+        idx = [i for i, r in enumerate(rules) if r.get("lat") is not None and r.get("lon") is not None]
+        if self.snap is None or not idx:
+            return rules
+        lats, lons = self.snap(ds_id, variable, [rules[i]["lat"] for i in idx], [rules[i]["lon"] for i in idx])
+        out = list(rules)
+        for k, i in enumerate(idx):
+            out[i] = dict(rules[i], lat=float(lats[k]), lon=float(lons[k]))
+        return out
+
+    def _read(self, ruleset: RuleSet, ds_id: str, variable: str,
+              *window) -> Tuple[Optional[List[Step]], List[tuple]]:
+        """Сроки окна и их свёртка — в одном потоке, под reading()."""
+        with self.reading():
+            steps = self.steps(ds_id, variable, *window)
+            return steps, (self._run_steps(ruleset, variable, steps) if steps else [])
+
+    def _run_steps(self, ruleset: RuleSet, variable: str, steps: List[Step]) -> List[tuple]:
+        """Свёртка сроков по правилам; читаются только сроки, которых нет в кэше."""
+        out = []
+        for step in steps:
+            key = None if step.source is None else (step.source, variable, ruleset.key, str(step.time))
+            found = self._cache.get(key) if key is not None else None
+            if found is None:
+                found = ruleset.evaluate(*step.read())
+                if key is not None:
+                    self._cache[key] = found
+                    while len(self._cache) > self.max_cached_steps:
+                        self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(key)
+            out.append(found)
+        return out
+
+    @staticmethod
+    def _rule_state(rule: dict, times: np.ndarray, values: np.ndarray, pct: np.ndarray, hit: np.ndarray,
+                    horizon_end: np.datetime64) -> dict:
+        keep = times <= horizon_end
+        times, values, pct, hit = times[keep], values[keep], pct[keep], hit[keep]
+        state = {"rule_id": rule["id"], "name": rule.get("name"), "variable": rule["variable"],
+                 "dataset": rule["dataset"], "op": rule["op"], "threshold": rule["threshold"],
+                 "active": bool(hit.any()), "first_utc": None, "last_utc": None, "peak": None, "peak_utc": None,
+                 "hours": 0.0, "now": None if not values.size or np.isnan(values[0]) else float(values[0]),
+                 "checked_utc": _iso(times[0]) if times.size else None}
+        if state["active"]:
+            idx = np.nonzero(hit)[0]
+            high = rule["op"] in ("gt", "ge")
+            j = idx[np.nanargmax(values[idx]) if high else np.nanargmin(values[idx])]
+            step_h = float(np.median(np.diff(times)) / np.timedelta64(1, "h")) if times.size > 1 else 1.0
+            state.update(first_utc=_iso(times[idx[0]]), last_utc=_iso(times[idx[-1]]), peak=float(values[j]),
+                         peak_utc=_iso(times[j]), hours=idx.size * step_h)
+            if not np.isnan(pct[j]):
+                state["area_pct"] = float(pct[j])
+        return state
+
+    async def check(self) -> dict:
+        """Одна проверка всех правил; рассылает изменения состояния."""
+        async with self._checking:
+            return await self._check()
+
+    async def _check(self) -> dict:
+        self.watchlist.reload()
+        now = np.datetime64(int(time.time()), "s")
+        t_start = _iso(now - np.timedelta64(1, "h"))
+        groups: Dict[Tuple[str, str], List[dict]] = {}
+        for rule in self.watchlist.rules.values():
+            groups.setdefault((rule["dataset_id"], rule["variable"]), []).append(rule)
+        fresh: Dict[str, dict] = {}
+        missing = 0
+        for (ds_id, variable), rules in groups.items():
+            ruleset = RuleSet(await asyncio.to_thread(self._snapped, ds_id, variable, rules))
+            horizon = max(float(r.get("horizon_h") or self.horizon_h) for r in rules)
+            x0, x1, y0, y1 = ruleset.bounds
+            t_end = _iso(now + np.timedelta64(int(horizon * 3600), "s"))
+            try:
+                steps, results = await asyncio.to_thread(self._read, ruleset, ds_id, variable,
+                                                         x0, x1, y0, y1, t_start, t_end)
+            except (OSError, ValueError, KeyError) as e:
+                log.warning("Alert rules on %s/%s not evaluated: %s", ds_id, variable, e)
+                steps, results = None, []
+            if not steps:
+                missing += len(rules)
+                continue
+            times = np.array([s.time for s in steps], dtype="datetime64[ns]")
+            values, pct, hit = (np.stack(a) for a in zip(*results))
+            for i, rule in enumerate(rules):
+                end = now + np.timedelta64(int(float(rule.get("horizon_h") or self.horizon_h) * 3600), "s")
+                fresh[rule["id"]] = self._rule_state(rule, times, values[:, i], pct[:, i], hit[:, i], end)
+        await self._publish_changes(fresh)
+        self.checks += 1
+        self.last_check = {"at": time.time(), "rules": len(self.watchlist.rules), "not_covered": missing}
+        return self.last_check
+
+    async def _publish_changes(self, fresh: Dict[str, dict]) -> None:
+        at = _iso(np.datetime64(int(time.time()), "s"))
+        events = []
+        for rid, state in fresh.items():
+            old = self.state.get(rid)
+            if old is None or old["active"] != state["active"]:
+                kind = "raised" if state["active"] else "cleared"
+                if old is None and not state["active"]:
+                    kind = None
+            elif state["active"] and (old["first_utc"], old["peak"], old["peak_utc"]) != (
+                    state["first_utc"], state["peak"], state["peak_utc"]):
+                kind = "updated"
+            else:
+                kind = None
+            if kind:
+                events.append({"type": kind, "at": at, "alert": state})
+        for rid in self._rule_ids - set(self.watchlist.rules):
+            events.append({"type": "removed", "at": at, "alert": {"rule_id": rid}})
+        await self.hub.publish(events)
+        self._rule_ids = set(self.watchlist.rules)
+        # правила вне покрытия куба сохраняют прежнее состояние
+        self.state = {rid: fresh.get(rid, self.state.get(rid)) for rid in self.watchlist.rules
+                      if rid in fresh or rid in self.state}
+
+    async def loop(self) -> None:
+        while True:
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Alert check failed: %s", e)
+            await asyncio.sleep(self.interval_s)
@@ -0,0 +1,259 @@
+"""Compact index of the WMTS GetCapabilities document.
+
+The Copernicus capabilities XML is several MB; it is parsed once per refresh
+into plain dicts (layers, styles, TileMatrixSets, time dimension values) that
+the API can filter and serve as small JSON documents.
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import datetime as dt
+import xml.etree.ElementTree as ET
+from typing import List, Optional, Tuple
+
+NS = {
+    "wmts": "http://www.opengis.net/wmts/1.0",
+    "ows": "http://www.opengis.net/ows/1.1",
+}
+
+_DURATION_RE = re.compile(
+    r"^P(?:(?P<d>\d+(?:\.\d+)?)D)?(?:T(?:(?P<h>\d+(?:\.\d+)?)H)?(?:(?P<m>\d+(?:\.\d+)?)M)?(?:(?P<s>\d+(?:\.\d+)?)S)?)?$")
+
+
+def _text(el: Optional[ET.Element], path: str) -> Optional[str]:
+    if el is None:
+        return None
+    found = el.find(path, NS)
+    if found is None or found.text is None:
+        return None
+    return found.text.strip()
+
+
+def _texts(el: ET.Element, path: str) -> List[str]:
+    return [f.text.strip() for f in el.findall(path, NS) if f.text]
+
+
+def parse_duration(value: str) -> Optional[dt.timedelta]:
+    """ISO-8601 период вида P1D / PT1H / PT15M (без лет и месяцев)."""
+    m = _DURATION_RE.match(value.strip())
+    if not m or not any(m.groupdict().values()):
+        return None
+    g = {k: float(v) if v else 0.0 for k, v in m.groupdict().items()}
+    return dt.timedelta(days=g["d"], hours=g["h"], minutes=g["m"], seconds=g["s"])
+
+
+def _parse_time(value: str) -> dt.datetime:
+    t = dt.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=dt.timezone.utc)
+    return t.astimezone(dt.timezone.utc)
+
+
+def _fmt_time(t: dt.datetime) -> str:
+    return t.astimezone(dt.timezone.utc).replace(tzinfo=None).isoformat(timespec="seconds") + "Z"
+
+
+def _parse_layer(el: ET.Element) -> dict:
+    dims = {}
+    for d in el.findall("wmts:Dimension", NS):
+        ident = (_text(d, "ows:Identifier") or "").lower()
+        if not ident:
+            continue
+        values = []
+        for v in _texts(d, "wmts:Value"):
+            values.extend(x.strip() for x in v.split(",") if x.strip())
+        dims[ident] = {"default": _text(d, "wmts:Default"), "units": _text(d, "ows:UOM"), "values": values}
+    bbox = el.find("ows:WGS84BoundingBox", NS)
+    wgs84 = None
+    if bbox is not None:
+        lower = (_text(bbox, "ows:LowerCorner") or "").split()
+        upper = (_text(bbox, "ows:UpperCorner") or "").split()
+        if len(lower) == 2 and len(upper) == 2:
+            wgs84 = [float(lower[0]), float(lower[1]), float(upper[0]), float(upper[1])]
+    return {
+        "id": _text(el, "ows:Identifier"),
+        "title": _text(el, "ows:Title"),
+        "abstract": _text(el, "ows:Abstract"),
+        "wgs84_bbox": wgs84,
+        "formats": _texts(el, "wmts:Format"),
+        "styles": [{"id": _text(s, "ows:Identifier"), "title": _text(s, "ows:Title"),
+                    "default": s.get("isDefault") == "true"} for s in el.findall("wmts:Style", NS)],
+        "tile_matrix_sets": _texts(el, "wmts:TileMatrixSetLink/wmts:TileMatrixSet"),
+        "resource_urls": [{"format": r.get("format"), "type": r.get("resourceType"), "template": r.get("template")}
+                          for r in el.findall("wmts:ResourceURL", NS)],
+        "dimensions": dims,
+    }
+
+
+def _parse_tms(el: ET.Element) -> dict:
+    matrices = []
+    for m in el.findall("wmts:TileMatrix", NS):
+        top_left = (_text(m, "wmts:TopLeftCorner") or "").split()
+        matrices.append({
+            "id": _text(m, "ows:Identifier"),
+            "scale_denominator": float(_text(m, "wmts:ScaleDenominator") or 0),
+            "top_left": [float(x) for x in top_left],
+            "tile_width": int(_text(m, "wmts:TileWidth") or 256),
+            "tile_height": int(_text(m, "wmts:TileHeight") or 256),
+            "matrix_width": int(_text(m, "wmts:MatrixWidth") or 0),
+            "matrix_height": int(_text(m, "wmts:MatrixHeight") or 0),
+        })
+    return {"id": _text(el, "ows:Identifier"), "crs": _text(el, "ows:SupportedCRS"), "matrices": matrices}
+
+
+def parse_capabilities(xml: bytes) -> dict:
+    root = ET.fromstring(xml)
+    contents = root.find("wmts:Contents", NS)
+    if contents is None:
+        raise ValueError("GetCapabilities: нет секции Contents")
+    layers = [_parse_layer(el) for el in contents.findall("wmts:Layer", NS)]
+    tms = [_parse_tms(el) for el in contents.findall("wmts:TileMatrixSet", NS)]
+    layers = [l for l in layers if l["id"]]
+    return {
+        "title": _text(root, "ows:ServiceIdentification/ows:Title"),
+        "layers": {l["id"]: l for l in layers},
+        "summaries": {l["id"]: layer_summary(l) for l in layers},
+        "tile_matrix_sets": {t["id"]: t for t in tms if t["id"]},
+    }
+
+
+def time_extent(values: List[str]) -> Tuple[Optional[str], Optional[str], int]:
+    """(первое, последнее, число значений) по списку моментов/интервалов start/end/period."""
+    first = last = None
+    count = 0
+    for v in values:
+        parts = v.split("/")
+        try:
+            start = _parse_time(parts[0])
+            end = _parse_time(parts[1]) if len(parts) > 1 else start
+        except ValueError:
+            continue
+        step = parse_duration(parts[2]) if len(parts) > 2 else None
+        n = int((end - start) / step) + 1 if step else (1 if len(parts) == 1 else 2)
+        count += n
+        first = start if first is None or start < first else first
+        last = end if last is None or end > last else last
+    return (_fmt_time(first) if first else None, _fmt_time(last) if last else None, count)
+
+
+def nearest_time(values: List[str], t: dt.datetime) -> Optional[str]:
+    """Ближайшее к t значение измерения time (с учётом интервалов с периодом)."""
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=dt.timezone.utc)
+    best: Optional[dt.datetime] = None
+    for v in values:
+        parts = v.split("/")
+        try:
+            start = _parse_time(parts[0])
+            end = _parse_time(parts[1]) if len(parts) > 1 else start
+        except ValueError:
+            continue
+        step = parse_duration(parts[2]) if len(parts) > 2 else None
+        if t <= start:
+            cand = start
+        elif t >= end:
+            cand = end
+        elif step:
+            k = round((t - start) / step)
+            cand = min(start + k * step, end)
+        else:
+            cand = start if (t - start) <= (end - t) else end
+        if best is None or abs(cand - t) < abs(best - t):
+            best = cand
+    return _fmt_time(best) if best else None
+
+
+def layer_summary(layer: dict) -> dict:
+    time_dim = layer["dimensions"].get("time")
+    out = {"id": layer["id"], "title": layer["title"], "tile_matrix_sets": layer["tile_matrix_sets"],
+           "formats": layer["formats"], "styles": [s["id"] for s in layer["styles"]]}
+    if time_dim:
+        first, last, count = time_extent(time_dim["values"])
+        out["time"] = {"first": first, "last": last, "count": count, "default": time_dim["default"]}
+    return out
+
+
+def search_layers(index: dict, q: Optional[str] = None, text: Optional[str] = None) -> List[dict]:
+    q = (q or "").upper()
+    text = (text or "").upper()
+    out = []
+    for layer in index["layers"].values():
+        if q and q not in layer["id"].upper():
+            continue
+        if text and text not in (layer["title"] or "").upper() and text not in (layer["abstract"] or "").upper():
+            continue
+        out.append(layer)
+    return out
+
+
+def _content_etag(xml: bytes) -> str:
+    return '"' + hashlib.sha1(xml).hexdigest() + '"'
+
+
+class CapabilitiesCache:
+    """Сырой XML + индекс, сохраняемые на диск, чтобы рестарт не ждал загрузки."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.xml: Optional[bytes] = None
+        self.xml_etag: Optional[str] = None  # ETag для клиентов: по содержимому, а не upstream
+        self.index: Optional[dict] = None
+        self.etag: Optional[str] = None
+        self.fetched_at: Optional[float] = None
+        self._mtime: Optional[int] = None  # версия capabilities.json, из которой загружен индекс
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    @property
+    def _xml_path(self) -> str:
+        return os.path.join(self.root, "capabilities.xml")
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.root, "capabilities.json")
+
+    def _load(self) -> None:
+        try:
+            self._mtime = os.stat(self._index_path).st_mtime_ns
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            with open(self._xml_path, "rb") as f:
+                xml = f.read()
+        except (OSError, ValueError):
+            return
+        self.xml, self.index = xml, state["index"]
+        self.xml_etag = _content_etag(xml)
+        self.etag, self.fetched_at = state.get("etag"), state.get("fetched_at")
+
+    def reload(self) -> bool:
+        """Перечитать файлы, если их обновил другой воркер; True — индекс сменился."""
+        try:
+            mtime = os.stat(self._index_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        self._load()
+        return True
+
+    def update(self, xml: bytes, index: dict, etag: Optional[str]) -> None:
+        self.xml, self.index, self.etag, self.fetched_at = xml, index, etag, time.time()
+        self.xml_etag = _content_etag(xml)
+        for path, data in ((self._xml_path, xml),
+                           (self._index_path, json.dumps({"index": index, "etag": etag,
+                                                          "fetched_at": self.fetched_at}).encode("utf-8"))):
+            # XML раньше индекса: воркер, увидевший новый capabilities.json, найдёт и новый XML
+            tmp = f"{path}.{os.getpid()}.part"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        try:
+            self._mtime = os.stat(self._index_path).st_mtime_ns
+        except OSError:
+            pass
+
+    def touch(self) -> None:
+        self.fetched_at = time.time()
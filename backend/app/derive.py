@@ -0,0 +1,119 @@
+"""Fields derived from the raw model variables.
+
+Computed once at ingest and stored next to the raw variables, so the API serves
+them like any other variable. When a file predates the derivation stage, the API
+computes them from the inputs with the same functions.
+
+Directions are nautical "towards": degrees clockwise from north.
+"""
+
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+
+# Douglas sea state, верхние границы высоты волн (м) для кодов 0..8; выше — 9
+DOUGLAS_EDGES = np.array([0.0, 0.1, 0.5, 1.25, 2.5, 4.0, 6.0, 9.0, 14.0])
+
+ICE_U_NAMES = ("siu", "uice", "sivelu", "si_vel_u")
+ICE_V_NAMES = ("siv", "vice", "siveln", "si_vel_v")
+ICE_SIC_NAMES = ("siconc", "sic", "ice_concentration", "sea_ice_area_fraction")
+ICE_SIT_NAMES = ("sithick", "sit", "ice_thickness", "sea_ice_thickness")
+
+
+def pick_var(ds: xr.Dataset, candidates: Iterable[str]) -> Optional[str]:
+    names = set(ds.variables)
+    for c in candidates:
+        if c in names:
+            return c
+    lowered = {str(v).lower(): v for v in ds.variables}
+    for c in candidates:
+        if c.lower() in lowered:
+            return lowered[c.lower()]
+    return None
+
+
+def speed(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    return np.hypot(u, v)
+
+
+def direction_to(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    return np.degrees(np.arctan2(u, v)) % 360.0
+
+
+def sic_percent(values: np.ndarray, unit: Optional[str]) -> Tuple[np.ndarray, str]:
+    """Сплочённость льда в процентах (доля 0..1 -> %), как в исходном ice_timeseries."""
+    unit = (unit or "").strip()
+    if not unit or unit in ("1", "fraction"):
+        return values * 100.0, "%"
+    if unit in ("%", "percent"):
+        return values, "%"
+    return values, unit
+
+
+def douglas(hs: np.ndarray) -> np.ndarray:
+    code = np.digitize(hs, DOUGLAS_EDGES, right=True).astype("f4")
+    code[~np.isfinite(hs)] = np.nan
+    return code
+
+
+class Derived(NamedTuple):
+    inputs: Tuple[Tuple[str, ...], ...]  # для каждого входа — допустимые имена
+    compute: Callable[..., Tuple[np.ndarray, str]]
+    long_name: str
+
+
+DERIVED: Dict[str, Derived] = {
+    "cur_speed": Derived((("uo",), ("vo",)), lambda u, v: (speed(u.values, v.values), "m s-1"),
+                         "sea water speed"),
+    "cur_dir": Derived((("uo",), ("vo",)), lambda u, v: (direction_to(u.values, v.values), "degree"),
+                       "sea water direction (towards, clockwise from north)"),
+    "ice_drift_speed": Derived((ICE_U_NAMES, ICE_V_NAMES), lambda u, v: (speed(u.values, v.values), "m s-1"),
+                               "sea ice drift speed"),
+    "ice_drift_dir": Derived((ICE_U_NAMES, ICE_V_NAMES), lambda u, v: (direction_to(u.values, v.values), "degree"),
+                             "sea ice drift direction (towards, clockwise from north)"),
+    "siconc_pct": Derived((ICE_SIC_NAMES,),
+                          lambda c: sic_percent(c.values, c.attrs.get("units")), "sea ice area fraction"),
+    "sea_state": Derived((("VHM0",),), lambda hs: (douglas(hs.values), "1"),
+                         "Douglas sea state code (0-9) from VHM0"),
+}
+
+
+def available(name: str, names: Iterable[str]) -> bool:
+    """Есть ли поле среди names — готовым или через все его входы."""
+    names = set(names)
+    if name in names:
+        return True
+    spec = DERIVED.get(name)
+    return spec is not None and all(any(c in names for c in cands) for cands in spec.inputs)
+
+
+def inputs_of(names: Iterable[str], ds: Optional[xr.Dataset] = None) -> List[str]:
+    """Исходные переменные, нужные для производных полей (первые имена-кандидаты, если ds нет)."""
+    out: List[str] = []
+    for name in names:
+        if name not in DERIVED:
+            out.append(name)
+            continue
+        for cands in DERIVED[name].inputs:
+            found = pick_var(ds, cands) if ds is not None else None
+            out.append(found or cands[0])
+    return list(dict.fromkeys(out))
+
+
+def add_derived(ds: xr.Dataset, names: Optional[Iterable[str]] = None) -> xr.Dataset:
+    """Добавить в набор производные поля, для которых есть входы (по умолчанию — все)."""
+    new = {}
+    for name in (DERIVED if names is None else names):
+        spec = DERIVED.get(name)
+        if spec is None or name in ds.data_vars:
+            continue
+        found = [pick_var(ds, cands) for cands in spec.inputs]
+        if not all(found):
+            continue
+        args = [ds[f] for f in found]
+        values, unit = spec.compute(*args)
+        new[name] = xr.DataArray(np.asarray(values, dtype="f4"), dims=args[0].dims, coords=args[0].coords,
+                                 attrs={"units": unit, "long_name": spec.long_name,
+                                        "derived_from": " ".join(found)})
+    return ds.assign(new) if new else ds
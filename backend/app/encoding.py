@@ -0,0 +1,212 @@
+"""Compact binary encodings for grid and series responses.
+
+Formats (selected by ?format= or the Accept header):
+
+* ``f32``  — application/x-hydrometeo-f32: b"HMF1", uint32 LE header length,
+  UTF-8 JSON header, then the raw little-endian arrays, each aligned to 8
+  bytes. The header lists name/dtype/shape/offset of every array plus
+  ``scale``/``add_offset`` for quantised arrays and the name of the NaN mask.
+* ``npz``  — application/x-npz: numpy savez archive (meta as ``__meta__`` JSON bytes).
+* ``arrow``— application/vnd.apache.arrow.stream: one record batch of equal-length
+  columns, meta in the schema metadata. Needs the optional ``pyarrow`` package.
+
+Quantisation (``int16``/``uint8``) maps [min, max] linearly onto the integer
+range and reserves the top code for NaN; ``nan_mask`` adds a bit-packed mask
+and zeroes NaNs in the float payload, which compresses far better.
+"""
+
+import io
+import json
+import struct
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow IPC — опционально
+    pa = None
+
+MAGIC = b"HMF1"
+
+MEDIA_TYPES = {
+    "json": "application/json",
+    "f32": "application/x-hydrometeo-f32",
+    "npz": "application/x-npz",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+_BY_MEDIA = {v: k for k, v in MEDIA_TYPES.items()}
+_BY_MEDIA["application/octet-stream"] = "f32"
+
+_QUANT = {"int16": (np.dtype("<i2"), -32767, 32766, -32768),
+          "uint8": (np.dtype("u1"), 0, 254, 255)}
+
+
+class UnsupportedFormat(ValueError):
+    pass
+
+
+def negotiate(fmt: Optional[str], accept: Optional[str]) -> str:
+    """Формат ответа: явный ?format= важнее заголовка Accept; по умолчанию JSON."""
+    if fmt:
+        fmt = fmt.lower()
+        if fmt == "npy":
+            fmt = "npz"
+        if fmt not in MEDIA_TYPES:
+            raise UnsupportedFormat(f"Неизвестный формат '{fmt}' (json|f32|npz|arrow)")
+        if fmt == "arrow" and pa is None:
+            raise UnsupportedFormat("Формат arrow недоступен: не установлен pyarrow")
+        return fmt
+    for part in (accept or "").split(","):
+        media = part.split(";")[0].strip().lower()
+        name = _BY_MEDIA.get(media)
+        if name == "arrow" and pa is None:
+            continue
+        if name:
+            return name
+    return "json"
+
+
+def quantize(a: np.ndarray, kind: str) -> Tuple[np.ndarray, float, float]:
+    dtype, lo, hi, nan_code = _QUANT[kind]
+    a = np.asarray(a, dtype=np.float64)
+    finite = np.isfinite(a)
+    if finite.any():
+        vmin, vmax = float(a[finite].min()), float(a[finite].max())
+    else:
+        vmin = vmax = 0.0
+    scale = (vmax - vmin) / (hi - lo) if vmax > vmin else 1.0
+    add_offset = vmin - lo * scale
+    q = np.full(a.shape, nan_code, dtype=dtype)
+    q[finite] = np.clip(np.rint((a[finite] - add_offset) / scale), lo, hi).astype(dtype)
+    return q, scale, add_offset
+
+
+def encode_f32(arrays: Dict[str, np.ndarray], meta: dict,
+               quant: Optional[str] = None, nan_mask: bool = False,
+               float_fields: Optional[List[str]] = None) -> bytes:
+    """float_fields — массивы, к которым применяются quant/nan_mask (прочие пишутся как есть)."""
+    float_fields = set(float_fields if float_fields is not None else arrays)
+    parts: List[Tuple[dict, bytes]] = []
+    for name, a in arrays.items():
+        a = np.asarray(a)
+        desc = {"name": name, "shape": list(a.shape)}
+        if name in float_fields:
+            a = a.astype("<f4", copy=False)
+            nan = np.isnan(a)
+            if nan_mask and nan.any():
+                mask_name = name + "_nan"
+                parts.append(({"name": mask_name, "shape": [int(a.size)], "dtype": "bits"},
+                              np.packbits(nan.ravel(), bitorder="little").tobytes()))
+                desc["nan_mask"] = mask_name
+                a = np.where(nan, np.float32(0), a)
+            if quant:
+                a, scale, add_offset = quantize(a, quant)
+                desc.update(scale=scale, add_offset=add_offset, nan_code=int(_QUANT[quant][3]))
+        elif a.dtype.kind == "f":
+            a = a.astype("<f4", copy=False)
+        else:
+            a = a.astype(a.dtype.newbyteorder("<"), copy=False)
+        desc["dtype"] = a.dtype.str
+        parts.append((desc, np.ascontiguousarray(a).tobytes()))
+    descs, offset = [], 0
+    for desc, raw in parts:
+        desc["offset"], desc["nbytes"] = offset, len(raw)
+        descs.append(desc)
+        offset += len(raw) + (-len(raw) % 8)
+    header = json.dumps({"meta": meta, "arrays": descs}, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-(len(header) + 8) % 8)
+    buf = io.BytesIO()
+    buf.write(MAGIC + struct.pack("<I", len(header)) + header)
+    for _, raw in parts:
+        buf.write(raw)
+        buf.write(b"\0" * (-len(raw) % 8))
+    return buf.getvalue()
+
+
+def encode_npz(arrays: Dict[str, np.ndarray], meta: dict) -> bytes:
+    buf = io.BytesIO()
+    payload = {k: np.asarray(v) for k, v in arrays.items()}
+    payload["__meta__"] = np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)
+    np.savez(buf, **payload)
+    return buf.getvalue()
+
+
+def encode_arrow(columns: Dict[str, np.ndarray], meta: dict) -> bytes:
+    if pa is None:
+        raise UnsupportedFormat("Формат arrow недоступен: не установлен pyarrow")
+    batch = pa.RecordBatch.from_pydict({k: np.asarray(v) for k, v in columns.items()})
+    schema = batch.schema.with_metadata({"meta": json.dumps(meta)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch.replace_schema_metadata(schema.metadata))
+    return sink.getvalue().to_pybytes()
+
+
+def grid_columns(lons: np.ndarray, lats: np.ndarray, fields: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Табличный (long) вид сетки для Arrow: lon/lat на каждую ячейку + поля."""
+    lon2, lat2 = np.meshgrid(np.asarray(lons, dtype="f4"), np.asarray(lats, dtype="f4"))
+    cols = {"lon": lon2.ravel(), "lat": lat2.ravel()}
+    cols.update({k: np.asarray(v, dtype="f4").ravel() for k, v in fields.items()})
+    return cols
+
+
+def encode(fmt: str, arrays: Dict[str, np.ndarray], meta: dict,
+           columns: Optional[Dict[str, np.ndarray]] = None,
+           quant: Optional[str] = None, nan_mask: bool = False,
+           float_fields: Optional[List[str]] = None) -> Tuple[bytes, str]:
+    if quant is not None and quant not in _QUANT:
+        raise UnsupportedFormat(f"Неизвестная квантизация '{quant}' (int16|uint8)")
+    if fmt == "f32":
+        body = encode_f32(arrays, meta, quant, nan_mask, float_fields)
+    elif fmt == "npz":
+        body = encode_npz(arrays, meta)
+    elif fmt == "arrow":
+        body = encode_arrow(columns if columns is not None else arrays, meta)
+    else:
+        raise UnsupportedFormat(f"Формат '{fmt}' не бинарный")
+    return body, MEDIA_TYPES[fmt]
+
+
+# --- time axis ---
+
+TIME_FORMATS = ("iso", "epoch_ms", "start_step")
+
+
+def iso_times(times: np.ndarray) -> List[str]:
+    """ISO-8601 'Z' строки для datetime64-массива без цикла по элементам."""
+    t = np.asarray(times).astype("datetime64[ms]").astype("datetime64[us]")
+    if t.size == 0:
+        return []
+    # как datetime.isoformat(): дробная часть только если она есть
+    unit = "s" if not (t.astype(np.int64) % 1_000_000).any() else "us"
+    return np.char.add(np.datetime_as_string(t, unit=unit), "Z").tolist()
+
+
+def encode_times(times: np.ndarray, mode: Optional[str]) -> dict:
+    """Поля ответа для оси времени: times_utc (iso), times_epoch_ms или time_start + time_step_s.
+
+    start_step возможен только для равномерной оси; иначе откатываемся на epoch_ms.
+    """
+    mode = (mode or "iso").lower()
+    if mode not in TIME_FORMATS:
+        raise UnsupportedFormat(f"Неизвестный time_format '{mode}' ({'|'.join(TIME_FORMATS)})")
+    if mode == "iso":
+        return {"time_encoding": "iso", "times_utc": iso_times(times)}
+    ms = np.asarray(times).astype("datetime64[ms]").astype(np.int64)
+    if mode == "start_step" and ms.size >= 1:
+        steps = np.diff(ms)
+        if steps.size == 0 or (steps == steps[0]).all():
+            return {"time_encoding": "start_step", "times_utc": [],
+                    "time_start": iso_times(ms[:1].astype("datetime64[ms]"))[0],
+                    "time_step_s": float(steps[0]) / 1000.0 if steps.size else 0.0,
+                    "time_count": int(ms.size)}
+    return {"time_encoding": "epoch_ms", "times_utc": [], "times_epoch_ms": ms.tolist()}
+
+
+def ndjson_lines(times: np.ndarray, values: np.ndarray) -> bytes:
+    """Строки NDJSON {"time": ..., "value": ...} для куска ряда (NaN -> null)."""
+    vals = np.asarray(values, dtype=float)
+    text = np.where(np.isfinite(vals), np.char.mod("%.9g", vals), "null")
+    lines = np.char.add(np.char.add(np.char.add('{"time":"', iso_times(times)), '","value":'), text)
+    return ("}\n".join(lines.tolist()) + "}\n").encode("utf-8") if vals.size else b""
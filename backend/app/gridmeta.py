@@ -0,0 +1,205 @@
+"""Per-dataset grid metadata and a wet-cell index for point lookups.
+
+For every file kind the API keeps the coordinate names, the lat/lon axes and,
+per variable, a land/sea mask (cells that are finite at the first time step on
+the top level). They are built once from the widest synced file and persisted
+as one .npz per kind under GRID_DIR, so a restart or another worker loads them
+instead of reopening a file.
+
+A point goes to its nearest grid node by a binary search on each axis; if that
+node is land, to the nearest wet node within ``max_km``. The regular grid is
+the spatial index: the candidates are the nodes of a window around the point
+that covers ``max_km`` in both directions, distances are on the sphere
+(equirectangular, exact enough at these ranges). Harbour and coastal points
+thus get the closest sea values instead of a NaN land cell.
+"""
+
+import os
+import re
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+
+from .store import LocalStore, nearest_indices
+
+KM_PER_DEG = 111.195
+
+
+def wet_mask(ds: xr.Dataset, variables: Iterable[str], lat_name: str, lon_name: str) -> np.ndarray:
+    """Узлы, где все переменные конечны на первом сроке и верхнем уровне."""
+    wet = None
+    for name in variables:
+        da = ds[name]
+        extra = {d: 0 for d in da.dims if d not in (lat_name, lon_name)}
+        ok = np.isfinite(np.asarray(da.isel(extra).transpose(lat_name, lon_name).values, dtype=float))
+        wet = ok if wet is None else wet & ok
+    return wet
+
+
+class GridMeta:
+    """Сетка одного вида файлов: имена координат, оси и маски «море» по переменным."""
+
+    def __init__(self, names: Tuple[str, str, str], lats: np.ndarray, lons: np.ndarray,
+                 masks: Optional[Dict[str, np.ndarray]] = None):
+        self.names = tuple(names)  # (time, lat, lon)
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.masks: Dict[str, np.ndarray] = dict(masks or {})
+
+    @property
+    def signature(self) -> tuple:
+        return self.names + (self.lats.size, self.lons.size,
+                             round(float(self.lats.min()), 6), round(float(self.lats.max()), 6),
+                             round(float(self.lons.min()), 6), round(float(self.lons.max()), 6))
+
+    def fits(self, ds: xr.Dataset) -> bool:
+        """Есть ли в наборе те же имена координат (тогда detect_coords не нужен)."""
+        return self.names[0] in ds.dims and self.names[1] in ds.dims and self.names[2] in ds.dims
+
+    def covers(self, lat: np.ndarray, lon: np.ndarray) -> bool:
+        """Все ли точки внутри сетки (с полшага по краям)."""
+        hy = float(np.abs(np.diff(self.lats)).max()) / 2 if self.lats.size > 1 else 0.0
+        hx = float(np.abs(np.diff(self.lons)).max()) / 2 if self.lons.size > 1 else 0.0
+        return bool(np.all((lat >= self.lats.min() - hy) & (lat <= self.lats.max() + hy)
+                           & (lon >= self.lons.min() - hx) & (lon <= self.lons.max() + hx)))
+
+    def snap(self, variable: str, lat: np.ndarray, lon: np.ndarray,
+             max_km: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Индексы (iy, ix) ближайших морских узлов и расстояние до них (км).
+
+        Если в радиусе max_km моря нет (или маски для переменной нет) — просто
+        ближайший узел; расстояние тогда считается до него.
+        """
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        iy = nearest_indices(self.lats, lat)
+        ix = nearest_indices(self.lons, lon)
+        coslat = np.cos(np.radians(lat))
+        wet = self.masks.get(variable)
+        if wet is not None and self.lats.size > 1 and self.lons.size > 1 and max_km > 0:
+            dlat = float(np.abs(np.diff(self.lats)).min())
+            dlon = float(np.abs(np.diff(self.lons)).min())
+            ry = int(np.ceil(max_km / (dlat * KM_PER_DEG)))
+            rx = int(np.ceil(max_km / (dlon * KM_PER_DEG * max(float(coslat.min()), 0.05))))
+            cy = np.clip(iy[:, None, None] + np.arange(-ry, ry + 1)[None, :, None], 0, self.lats.size - 1)
+            cx = np.clip(ix[:, None, None] + np.arange(-rx, rx + 1)[None, None, :], 0, self.lons.size - 1)
+            with np.errstate(invalid="ignore"):
+                dist = np.hypot((self.lats[cy] - lat[:, None, None]) * KM_PER_DEG,
+                                (self.lons[cx] - lon[:, None, None]) * KM_PER_DEG * coslat[:, None, None])
+            dist = np.where(wet[cy, cx] & (dist <= max_km), dist, np.inf).reshape(lat.size, -1)
+            best = dist.argmin(axis=1)
+            found = np.isfinite(dist[np.arange(lat.size), best])
+            by, bx = np.divmod(best, cx.shape[2])
+            iy = np.where(found, cy[np.arange(lat.size), by, 0], iy)
+            ix = np.where(found, cx[np.arange(lat.size), 0, bx], ix)
+        km = np.hypot((self.lats[iy] - lat) * KM_PER_DEG, (self.lons[ix] - lon) * KM_PER_DEG * coslat)
+        return iy, ix, km
+
+    def save(self, path: str) -> None:
+        # запись атомарная: соседний воркер читает либо старый файл, либо новый
+        tmp = f"{path}.{os.getpid()}.part"
+        arrays = {"names": np.array(self.names), "lats": self.lats, "lons": self.lons}
+        for name, mask in self.masks.items():
+            arrays["mask_" + name] = np.packbits(mask, axis=None)
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "GridMeta":
+        with np.load(path, allow_pickle=False) as z:
+            lats, lons = z["lats"], z["lons"]
+            shape = (lats.size, lons.size)
+            masks = {k[5:]: np.unpackbits(z[k], count=shape[0] * shape[1]).astype(bool).reshape(shape)
+                     for k in z.files if k.startswith("mask_")}
+            return cls(tuple(str(n) for n in z["names"]), lats, lons, masks)
+
+
+class GridCatalog:
+    """Сетки по видам файлов локального куба: в памяти и на диске (root/<kind>.npz).
+
+    Сетка берётся из файла с самым широким охватом; если он сменился на файл с
+    другими осями, сетка и маски строятся заново.
+
+    get() сканирует каталог и может открыть файл — из async-кода только через
+    asyncio.to_thread. Готовая сетка отдаётся без блокировки; lock берётся лишь
+    на загрузку/построение, чтобы два потока не строили одну маску.
+    """
+
+    def __init__(self, store: LocalStore, root: str, max_km: float):
+        self.store = store
+        self.root = root
+        self.max_km = max_km
+        self._grids: Dict[str, GridMeta] = {}
+        self._lock = threading.Lock()
+        self.built = 0
+        self.loaded = 0
+
+    def _path(self, kind: str) -> str:
+        return os.path.join(self.root, re.sub(r"[^A-Za-z0-9_.-]", "_", kind) + ".npz")
+
+    def get(self, dataset_id: str, variable: str, inputs: Iterable[str] = ()) -> Optional[GridMeta]:
+        """Сетка с маской для переменной (производной — по её исходным) или None без локальных файлов."""
+        names = [variable]
+        cov = self.store.grid_source(dataset_id, names)
+        if cov is None and inputs:
+            names = list(inputs)
+            cov = self.store.grid_source(dataset_id, names)
+        if cov is None:
+            return None
+        sig = (cov.time_name, cov.lat_name, cov.lon_name)
+        grid = self._grids.get(cov.kind)
+        if grid is not None and variable in grid.masks and grid.signature == self._signature(cov):
+            return grid
+        with self._lock:
+            grid = self._grids.get(cov.kind)
+            if grid is None or grid.names != sig:
+                grid = self._load(cov.kind)
+            if grid is not None and variable in grid.masks and grid.signature == self._signature(cov):
+                self._grids[cov.kind] = grid
+                return grid
+            try:
+                with xr.open_dataset(cov.path) as ds:
+                    lats, lons = ds[cov.lat_name].values, ds[cov.lon_name].values
+                    if grid is None or grid.signature != GridMeta(sig, lats, lons).signature:
+                        grid = GridMeta(sig, lats, lons)
+                    else:
+                        # читатели без lock видят либо старую сетку, либо новую целиком
+                        grid = GridMeta(grid.names, grid.lats, grid.lons, grid.masks)
+                    grid.masks[variable] = wet_mask(ds, names, cov.lat_name, cov.lon_name)
+            except Exception:
+                # файл может переписываться ingest-ом — обойдёмся без сетки
+                return None
+            self.built += 1
+            self._grids[cov.kind] = grid
+            try:
+                os.makedirs(self.root, exist_ok=True)
+                grid.save(self._path(cov.kind))
+            except OSError:
+                pass
+            return grid
+
+    def _load(self, kind: str) -> Optional[GridMeta]:
+        try:
+            grid = GridMeta.load(self._path(kind))
+        except (OSError, ValueError, KeyError):
+            return None
+        self.loaded += 1
+        return grid
+
+    @staticmethod
+    def _signature(cov) -> tuple:
+        # оси файла сверяются по охвату и числу узлов (шаг из Coverage)
+        n_lat = int(round((cov.lat_max - cov.lat_min) / (2 * cov.half_dlat))) + 1 if cov.half_dlat else 1
+        n_lon = int(round((cov.lon_max - cov.lon_min) / (2 * cov.half_dlon))) + 1 if cov.half_dlon else 1
+        return (cov.time_name, cov.lat_name, cov.lon_name, n_lat, n_lon,
+                round(cov.lat_min, 6), round(cov.lat_max, 6), round(cov.lon_min, 6), round(cov.lon_max, 6))
+
+    def stats(self) -> dict:
+        # без lock: /metrics не должен ждать построения маски
+        grids = dict(self._grids)
+        return {"kinds": sorted(grids), "built": self.built, "loaded": self.loaded, "max_km": self.max_km,
+                "bytes": sum(g.lats.nbytes + g.lons.nbytes + sum(m.size for m in list(g.masks.values()))
+                             for g in grids.values())}
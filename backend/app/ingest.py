@@ -0,0 +1,340 @@
+"""Incremental ingest of the Baltic PHY/WAV/ICE products into the local store.
+
+Replaces the hourly full 48-hour re-download of cron/sync_baltic.sh. For every
+file kind the last ingested time step is remembered, and the CLI is asked only
+for [last - overlap, now]. The overlap re-fetches the most recent steps, which a
+newer forecast run may have revised. Each download becomes one time partition
+baltic_<kind>_<YYYYMMDD>_<HHMMSS>.nc (a name LocalStore already picks up), and
+the steps it covers are cut out of older partitions, so the newest run always
+wins. Partitions of complete days are compacted into one baltic_<kind>_<YYYYMMDD>.nc
+per UTC day, and files past the retention window are deleted.
+
+Usage from cron:  python -m app.ingest [--kinds phy,wav,ice] [--loop]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import subprocess
+import datetime as dt
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import xarray as xr
+
+from .store import SYNC_FILE_RE, detect_coords
+from .pyramid import build_pyramid, pyramid_dir
+from .layout import build_series, drop_series, encoding
+from .derive import add_derived
+
+log = logging.getLogger("ingest")
+
+STATE_FILE = "ingest_state.json"
+STAGING_DIR = ".ingest"
+
+
+class Product(NamedTuple):
+    kind: str
+    dataset_id: str
+    variables: Tuple[str, ...]
+    max_depth: Optional[float] = None  # нижняя граница столба (м); None — все уровни
+
+
+class Partition(NamedTuple):
+    path: str
+    t_min: np.datetime64
+    t_max: np.datetime64
+    mtime: float
+
+
+class IngestError(RuntimeError):
+    pass
+
+
+def _cli_time(t: np.datetime64) -> str:
+    return str(np.datetime64(t, "s")) + "Z"
+
+
+def partition_name(kind: str, t: np.datetime64) -> str:
+    s = str(np.datetime64(t, "s"))
+    return f"baltic_{kind}_{s[:10].replace('-', '')}_{s[11:].replace(':', '')}.nc"
+
+
+def daily_name(kind: str, day: np.datetime64) -> str:
+    return f"baltic_{kind}_{str(np.datetime64(day, 'D')).replace('-', '')}.nc"
+
+
+def _utcnow() -> np.datetime64:
+    return np.datetime64(int(time.time()), "s")
+
+
+def _write_atomic(ds: xr.Dataset, path: str) -> None:
+    # временное имя начинается с точки — LocalStore его не видит
+    tmp = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".part")
+    ds.to_netcdf(tmp, encoding=encoding(ds, series=False))
+    os.replace(tmp, path)
+
+
+class Ingest:
+    """Append-only ingest of time partitions into ``root`` (CACHE_DIR)."""
+
+    def __init__(self, root: str, products: Sequence[Product], bbox: Tuple[float, float, float, float],
+                 overlap: dt.timedelta = dt.timedelta(hours=6),
+                 bootstrap: dt.timedelta = dt.timedelta(hours=48),
+                 retention: dt.timedelta = dt.timedelta(days=14),
+                 cli_timeout: float = 1800.0, pyramid_root: Optional[str] = None,
+                 series_root: Optional[str] = None):
+        self.root = root
+        self.products = {p.kind: p for p in products}
+        self.bbox = bbox
+        self.overlap = np.timedelta64(int(overlap.total_seconds()), "s")
+        self.bootstrap = np.timedelta64(int(bootstrap.total_seconds()), "s")
+        self.retention = np.timedelta64(int(retention.total_seconds()), "s")
+        self.cli_timeout = cli_timeout
+        self.pyramid_root = pyramid_root
+        self.series_root = series_root
+        self.staging = os.path.join(root, STAGING_DIR)
+        os.makedirs(self.staging, exist_ok=True)
+        self.state = self._load_state()
+
+    # --- state ---
+
+    @property
+    def _state_path(self) -> str:
+        return os.path.join(self.root, STATE_FILE)
+
+    def _load_state(self) -> Dict[str, dict]:
+        try:
+            with open(self._state_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self) -> None:
+        tmp = self._state_path + ".part"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp, self._state_path)
+
+    # --- partitions ---
+
+    def partitions(self, kind: str) -> List[Partition]:
+        out = []
+        for name in sorted(os.listdir(self.root)):
+            m = SYNC_FILE_RE.match(name)
+            if not m or m.group("kind") != kind:
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                with xr.open_dataset(path) as ds:
+                    tname = detect_coords(ds)[0]
+                    times = ds[tname].values
+                mtime = os.path.getmtime(path)
+            except Exception:
+                continue
+            if times.size:
+                out.append(Partition(path, times.min(), times.max(), mtime))
+        return out
+
+    def last_time(self, kind: str) -> Optional[np.datetime64]:
+        saved = self.state.get(kind, {}).get("last_time")
+        if saved:
+            return np.datetime64(saved.rstrip("Z"), "s")
+        parts = self.partitions(kind)
+        return max(p.t_max for p in parts).astype("datetime64[s]") if parts else None
+
+    def _forget(self, kind: str, path: str) -> None:
+        try: os.remove(path)
+        except OSError: pass
+        if kind == "phy" and self.pyramid_root:
+            shutil.rmtree(pyramid_dir(self.pyramid_root, path), ignore_errors=True)
+        if self.series_root:
+            drop_series(self.series_root, path)
+
+    def _changed(self, kind: str, path: str) -> None:
+        """Файл раздела переписан: пересобрать производные (пирамиду течений, раскладку «ряды»)."""
+        if kind == "phy" and self.pyramid_root:
+            build_pyramid(path, self.pyramid_root)
+        if self.series_root:
+            build_series(path, self.series_root)
+
+    def _cut(self, kind: str, part: Partition, a: np.datetime64, b: np.datetime64) -> None:
+        """Убрать из раздела сроки [a, b] — их заменил более свежий прогон."""
+        if part.t_min >= a and part.t_max <= b:
+            self._forget(kind, part.path)
+            return
+        with xr.open_dataset(part.path) as ds:
+            tname = detect_coords(ds)[0]
+            times = ds[tname].values
+            keep = (times < a) | (times > b)
+            if keep.all():
+                return
+            rest = ds.isel({tname: np.nonzero(keep)[0]}).load()
+        _write_atomic(rest, part.path)
+        self._changed(kind, part.path)
+
+    # --- steps ---
+
+    def fetch(self, product: Product, t0: np.datetime64, t1: np.datetime64) -> str:
+        name = f"{product.kind}.{os.getpid()}.{time.time_ns()}.nc"
+        cmd = ["copernicusmarine", "subset", "-i", product.dataset_id]
+        for v in product.variables:
+            cmd += ["-v", v]
+        xmin, xmax, ymin, ymax = self.bbox
+        cmd += ["-x", str(xmin), "-X", str(xmax), "-y", str(ymin), "-Y", str(ymax),
+                "-t", _cli_time(t0), "-T", _cli_time(t1),
+                "-o", self.staging, "-f", name, "--file-format", "netcdf"]
+        if product.max_depth is not None:
+            cmd += ["-z", "0", "-Z", str(product.max_depth), "--coordinates-selection-method", "nearest"]
+        path = os.path.join(self.staging, name)
+        try:
+            res = subprocess.run(cmd, capture_output=True, text=True, timeout=self.cli_timeout)
+        except subprocess.TimeoutExpired:
+            self._discard(path)
+            raise IngestError(f"copernicusmarine subset: таймаут {self.cli_timeout:.0f} с")
+        if res.returncode != 0 or not os.path.exists(path):
+            self._discard(path)
+            raise IngestError((res.stderr or res.stdout or "Ошибка copernicusmarine subset").strip()[-400:])
+        return path
+
+    def _discard(self, path: str) -> None:
+        try: os.remove(path)
+        except OSError: pass
+
+    def append(self, product: Product, staged: str) -> Optional[Tuple[np.datetime64, np.datetime64]]:
+        """Перенести загрузку в хранилище как новый раздел; вернуть его [t_min, t_max]."""
+        try:
+            with xr.open_dataset(staged) as ds:
+                tname = detect_coords(ds)[0]
+                times = ds[tname].values
+                if times.size == 0:
+                    return None
+                # производные поля (скорость/направление, % льда, балл волнения) — один раз здесь
+                new = add_derived(ds.load())
+        finally:
+            self._discard(staged)
+        a, b = times.min(), times.max()
+        path = os.path.join(self.root, partition_name(product.kind, a))
+        older = [p for p in self.partitions(product.kind) if p.path != path and p.t_max >= a and p.t_min <= b]
+        # сначала новый раздел, потом обрезка старых: сроки не пропадают ни на миг
+        _write_atomic(new, path)
+        self._changed(product.kind, path)
+        for part in older:
+            self._cut(product.kind, part, a, b)
+        return a, b
+
+    def compact(self, kind: str, now: np.datetime64) -> int:
+        """Слить разделы завершённых суток (старше перекрытия) в один файл на сутки."""
+        seal_day = (now - self.overlap).astype("datetime64[D]")
+        parts = [p for p in self.partitions(kind) if p.t_max.astype("datetime64[D]") < seal_day]
+        days: Dict[np.datetime64, List[Partition]] = {}
+        for p in parts:
+            for day in np.arange(p.t_min.astype("datetime64[D]"), p.t_max.astype("datetime64[D]") + 1):
+                days.setdefault(day, []).append(p)
+        merged = 0
+        targets = set()
+        for day, group in sorted(days.items()):
+            target = os.path.join(self.root, daily_name(kind, day))
+            targets.add(target)
+            only = group[0]
+            if (len(group) == 1 and only.path == target
+                    and only.t_min.astype("datetime64[D]") == only.t_max.astype("datetime64[D]") == day):
+                continue
+            slices = []
+            # при совпадении сроков остаётся более поздняя запись
+            for p in sorted(group, key=lambda p: p.mtime, reverse=True):
+                with xr.open_dataset(p.path) as ds:
+                    tname = detect_coords(ds)[0]
+                    sel = ds.sel({tname: slice(day, day + np.timedelta64(1, "D") - np.timedelta64(1, "ns"))})
+                    slices.append(sel.load())
+            ds = xr.concat(slices, dim=tname, join="outer")
+            _, first = np.unique(ds[tname].values, return_index=True)
+            _write_atomic(ds.isel({tname: first}), target)
+            self._changed(kind, target)
+            merged += 1
+        for p in parts:
+            if p.path not in targets:
+                self._forget(kind, p.path)
+        return merged
+
+    def expire(self, kind: str, now: np.datetime64) -> int:
+        cutoff = now - self.retention
+        old = [p for p in self.partitions(kind) if p.t_max < cutoff]
+        for p in old:
+            self._forget(kind, p.path)
+        return len(old)
+
+    def run_once(self, kinds: Optional[Sequence[str]] = None) -> Dict[str, dict]:
+        """Один проход по всем видам: дозагрузка, компактация, удаление по сроку хранения."""
+        report = {}
+        for kind in kinds or list(self.products):
+            product = self.products[kind]
+            now = _utcnow()
+            last = self.last_time(kind)
+            t0 = now - self.bootstrap if last is None else max(last - self.overlap, now - self.retention)
+            entry = {"from": _cli_time(t0), "to": _cli_time(now)}
+            try:
+                staged = self.fetch(product, t0, now)
+                span = self.append(product, staged)
+            except IngestError as e:
+                log.warning("[%s] ingest failed: %s", kind, e)
+                entry["error"] = str(e)
+                report[kind] = entry
+                continue
+            if span is not None:
+                prev = self.state.get(kind, {}).get("last_time")
+                new_last = _cli_time(span[1])
+                self.state[kind] = {"last_time": max(prev, new_last) if prev else new_last,
+                                    "updated_at": _cli_time(now)}
+                self._save_state()
+                entry.update(steps=[_cli_time(span[0]), _cli_time(span[1])])
+            entry["compacted_days"] = self.compact(kind, now)
+            entry["expired"] = self.expire(kind, now)
+            report[kind] = entry
+        return report
+
+
+def from_env() -> Ingest:
+    cache_dir = os.getenv("CACHE_DIR", "./data/cache")
+    phy = os.getenv("CMDS_DATASET_PHY", "cmems_mod_bal_phy_anfc_PT15M-i")
+    max_depth = os.getenv("INGEST_PHY_MAX_DEPTH", "")
+    products = [
+        Product("phy", phy, ("uo", "vo", "thetao"), float(max_depth) if max_depth else None),
+        Product("wav", os.getenv("CMDS_DATASET_WAV", "cmems_mod_bal_wav_anfc_PT1H-i"), ("VHM0", "VMDR", "VTPK")),
+        Product("ice", os.getenv("CMDS_DATASET_ICE", phy),
+                tuple(os.getenv("INGEST_ICE_VARS", "siconc,sithick").split(","))),
+    ]
+    bbox = tuple(float(v) for v in os.getenv("INGEST_BBOX", "9,31,53,66").split(","))
+    return Ingest(
+        cache_dir, products, bbox,
+        overlap=dt.timedelta(hours=float(os.getenv("INGEST_OVERLAP_H", "6"))),
+        bootstrap=dt.timedelta(hours=float(os.getenv("INGEST_BOOTSTRAP_H", "48"))),
+        retention=dt.timedelta(days=float(os.getenv("INGEST_RETENTION_D", "14"))),
+        cli_timeout=float(os.getenv("INGEST_CLI_TIMEOUT_S", "1800")),
+        pyramid_root=os.getenv("PYRAMID_DIR") or os.path.join(cache_dir, "pyramid"),
+        series_root=os.getenv("SERIES_DIR") or os.path.join(cache_dir, "series"),
+    )
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Incremental Baltic ingest")
+    parser.add_argument("--kinds", default="phy,wav,ice")
+    parser.add_argument("--loop", action="store_true", help="не выходить, повторять каждые INGEST_INTERVAL_MIN")
+    args = parser.parse_args()
+    ingest = from_env()
+    kinds = [k for k in args.kinds.split(",") if k]
+    while True:
+        for kind, entry in ingest.run_once(kinds).items():
+            print(f"[{'!' if 'error' in entry else '*'}] {kind}: " + json.dumps(entry, ensure_ascii=False))
+        sys.stdout.flush()
+        if not args.loop:
+            break
+        time.sleep(float(os.getenv("INGEST_INTERVAL_MIN", "60")) * 60)
@@ -0,0 +1,71 @@
+"""Vectorized interpolation of gridded fields at scattered (time, lat, lon) points.
+
+Bilinear in space and linear in time: every point takes the 8 surrounding grid
+values with trilinear weights, all points at once with NumPy fancy indexing.
+Corners that are NaN (land) are dropped and the remaining weights
+renormalised, so points next to the coast still get a sea value. Angles
+(units "degree") are interpolated as unit vectors.
+"""
+
+from typing import Optional, Tuple
+
+import numpy as np
+
+CIRCULAR_UNITS = ("degree", "degrees", "deg")
+
+
+def _bracket(axis: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Соседние узлы (i0, i1), вес i1 и признак «внутри оси ± полшага» для каждого значения."""
+    axis = np.asarray(axis, dtype=float)
+    values = np.asarray(values, dtype=float)
+    n = axis.size
+    if n == 1:
+        zero = np.zeros(values.shape, dtype=np.intp)
+        return zero, zero, np.zeros(values.shape), np.ones(values.shape, dtype=bool)
+    desc = axis[0] > axis[-1]
+    a = axis[::-1] if desc else axis
+    i1 = np.clip(np.searchsorted(a, values, side="right"), 1, n - 1)
+    i0 = i1 - 1
+    w = (values - a[i0]) / (a[i1] - a[i0])
+    half = float(np.abs(np.diff(a)).max()) / 2.0
+    inside = (values >= a[0] - half) & (values <= a[-1] + half)
+    w = np.clip(w, 0.0, 1.0)
+    if desc:
+        i0, i1 = n - 1 - i0, n - 1 - i1
+    return i0, i1, w, inside
+
+
+def is_circular(units: Optional[str]) -> bool:
+    return (units or "").strip().lower() in CIRCULAR_UNITS
+
+
+def interp_points(data: np.ndarray, t_axis: np.ndarray, lat_axis: np.ndarray, lon_axis: np.ndarray,
+                  t: np.ndarray, lat: np.ndarray, lon: np.ndarray, circular: bool = False) -> np.ndarray:
+    """Значения поля data[time, lat, lon] в точках (t, lat, lon); вне охвата — NaN.
+
+    t и t_axis — datetime64 (или числа в одной шкале).
+    """
+    if np.issubdtype(np.asarray(t_axis).dtype, np.datetime64):
+        origin = np.asarray(t_axis)[0]
+        t_axis = (np.asarray(t_axis) - origin) / np.timedelta64(1, "s")
+        t = (np.asarray(t) - origin) / np.timedelta64(1, "s")
+    it0, it1, wt, okt = _bracket(t_axis, t)
+    iy0, iy1, wy, oky = _bracket(lat_axis, lat)
+    ix0, ix1, wx, okx = _bracket(lon_axis, lon)
+    it = np.stack([it0, it0, it0, it0, it1, it1, it1, it1])
+    iy = np.stack([iy0, iy0, iy1, iy1, iy0, iy0, iy1, iy1])
+    ix = np.stack([ix0, ix1, ix0, ix1, ix0, ix1, ix0, ix1])
+    ft, fy, fx = (np.stack([1 - wt] * 4 + [wt] * 4), np.stack([1 - wy, 1 - wy, wy, wy] * 2),
+                  np.stack([1 - wx, wx] * 4))
+    vals = np.asarray(data, dtype=float)[it, iy, ix]  # (8, n)
+    valid = np.isfinite(vals)
+    w = np.where(valid, ft * fy * fx, 0.0)
+    wsum = w.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if circular:
+            rad = np.radians(np.where(valid, vals, 0.0))
+            out = np.degrees(np.arctan2((np.sin(rad) * w).sum(axis=0), (np.cos(rad) * w).sum(axis=0))) % 360.0
+        else:
+            out = (np.where(valid, vals, 0.0) * w).sum(axis=0) / wsum
+    out[(wsum <= 1e-12) | ~(okt & oky & okx)] = np.nan
+    return out
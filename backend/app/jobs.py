@@ -0,0 +1,143 @@
+"""Asyncio executor for Copernicus CLI invocations.
+
+The handlers are coroutines, so the CLI must never run through the blocking
+subprocess.run: jobs go into a bounded priority queue and a fixed number of
+workers run them with asyncio subprocesses, each under its own timeout. A full
+queue is reported to the caller immediately (QueueFull) instead of piling up.
+"""
+
+import asyncio
+import itertools
+import time
+from typing import List, Optional, NamedTuple
+
+PRIORITY_SYSTEM = 0
+PRIORITY_INTERACTIVE = 10
+PRIORITY_BACKGROUND = 100
+
+
+class CliResult(NamedTuple):
+    returncode: int
+    stdout: str
+    stderr: str
+    elapsed: float
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"CLI queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class _Job:
+    __slots__ = ("cmd", "timeout", "future", "proc")
+
+    def __init__(self, cmd: List[str], timeout: float, future: "asyncio.Future"):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.future = future
+        self.proc: Optional[asyncio.subprocess.Process] = None
+
+
+class CliExecutor:
+    def __init__(self, concurrency: int = 2, max_queue: int = 32, timeout: float = 300.0):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(1, max_queue)
+        self.timeout = timeout
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: List[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._avg = 30.0  # скользящее среднее длительности задания, с
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue(maxsize=self.max_queue)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, job = self._queue.get_nowait()
+                if not job.future.done():
+                    job.future.cancel()
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize() if self._queue else 0, "running": self._running,
+                "concurrency": self.concurrency, "max_queue": self.max_queue,
+                "avg_job_s": round(self._avg, 2)}
+
+    def retry_after(self) -> int:
+        pending = (self._queue.qsize() if self._queue else 0) + self._running
+        return max(1, int(self._avg * pending / self.concurrency))
+
+    async def run(self, cmd: List[str], priority: int = PRIORITY_INTERACTIVE,
+                  timeout: Optional[float] = None) -> CliResult:
+        """Поставить команду в очередь и дождаться результата.
+
+        Отмена ожидающей корутины снимает задание из очереди либо убивает
+        уже запущенный процесс.
+        """
+        if self._queue is None:
+            await self.start()
+        if self._queue.full():
+            raise QueueFull(self.retry_after())
+        job = _Job(cmd, timeout or self.timeout, asyncio.get_running_loop().create_future())
+        self._queue.put_nowait((priority, next(self._seq), job))
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            job.future.cancel()
+            if job.proc is not None and job.proc.returncode is None:
+                job.proc.kill()
+            raise
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.future.done():
+                    continue
+                self._running += 1
+                try:
+                    result = await self._exec(job)
+                except BaseException as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                    if isinstance(e, asyncio.CancelledError):
+                        raise
+                else:
+                    if not job.future.done():
+                        job.future.set_result(result)
+                finally:
+                    self._running -= 1
+            finally:
+                self._queue.task_done()
+
+    async def _exec(self, job: _Job) -> CliResult:
+        t0 = time.monotonic()
+        job.proc = await asyncio.create_subprocess_exec(
+            *job.cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            out, err = await asyncio.wait_for(job.proc.communicate(), timeout=job.timeout)
+        except asyncio.TimeoutError:
+            job.proc.kill()
+            await job.proc.wait()
+            raise JobTimeout(f"'{job.cmd[0]} {job.cmd[1] if len(job.cmd) > 1 else ''}' exceeded {job.timeout:.0f}s")
+        except asyncio.CancelledError:
+            if job.proc.returncode is None:
+                job.proc.kill()
+            raise
+        elapsed = time.monotonic() - t0
+        self._avg = 0.8 * self._avg + 0.2 * elapsed
+        return CliResult(job.proc.returncode, out.decode("utf-8", "replace"),
+                         err.decode("utf-8", "replace"), elapsed)
@@ -0,0 +1,107 @@
+"""Two on-disk chunkings of the synced data.
+
+* map layout — the partitions themselves: one chunk per time step covering the
+  whole grid, so a map slice is a single contiguous read;
+* series layout — a twin of each partition chunked (all steps x block x block),
+  zlib level 1, under SERIES_DIR, so a point series reads one small chunk per
+  file instead of touching every spatial slice.
+
+A twin is named after the size/mtime of its source
+(<stem>.<mtime_ns>-<size>.nc), so finding a current one is a single stat and a
+re-written partition simply stops matching its old twin.
+"""
+
+import os
+import sys
+import glob
+from typing import Dict, Optional
+
+import xarray as xr
+
+SERIES_BLOCK = 4
+
+TIME_NAMES = ("time", "t")
+LAT_NAMES = ("latitude", "lat", "y")
+LON_NAMES = ("longitude", "lon", "x")
+
+
+def _axis(ds: xr.Dataset, names) -> Optional[str]:
+    for n in names:
+        if n in ds.dims:
+            return n
+    return None
+
+
+def _chunks(da: xr.DataArray, lat_name: str, lon_name: str, time_name: str,
+            series: bool, block: int) -> tuple:
+    out = []
+    for d in da.dims:
+        n = da.sizes[d]
+        if d == time_name:
+            out.append(n if series else 1)
+        elif d in (lat_name, lon_name):
+            out.append(min(block, n) if series else n)
+        else:
+            out.append(1)  # глубина и прочие оси — по одному уровню
+    return tuple(out)
+
+
+def encoding(ds: xr.Dataset, series: bool, block: int = SERIES_BLOCK) -> Dict[str, dict]:
+    """Кодировка to_netcdf для раскладки «карты» (series=False) или «ряды»."""
+    tname, la, lo = _axis(ds, TIME_NAMES), _axis(ds, LAT_NAMES), _axis(ds, LON_NAMES)
+    enc = {}
+    for name, da in ds.data_vars.items():
+        if tname not in da.dims or la not in da.dims or lo not in da.dims:
+            continue
+        e = {"chunksizes": _chunks(da, la, lo, tname, series, block)}
+        if series:
+            e.update(zlib=True, complevel=1, shuffle=True)
+        enc[name] = e
+    return enc
+
+
+def _stamp(path: str) -> str:
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}-{st.st_size}"
+
+
+def series_path(root: str, src_path: str) -> str:
+    stem = os.path.splitext(os.path.basename(src_path))[0]
+    return os.path.join(root, f"{stem}.{_stamp(src_path)}.nc")
+
+
+def find_series(root: str, src_path: str) -> Optional[str]:
+    """Актуальный двойник файла в раскладке «ряды» или None."""
+    try:
+        path = series_path(root, src_path)
+    except OSError:
+        return None
+    return path if os.path.exists(path) else None
+
+
+def drop_series(root: str, src_path: str) -> None:
+    stem = os.path.splitext(os.path.basename(src_path))[0]
+    for old in glob.glob(os.path.join(glob.escape(root), glob.escape(stem) + ".*.nc")):
+        try: os.remove(old)
+        except OSError: pass
+
+
+def build_series(src_path: str, root: str, block: int = SERIES_BLOCK) -> str:
+    os.makedirs(root, exist_ok=True)
+    path = series_path(root, src_path)
+    with xr.open_dataset(src_path) as src:
+        ds = src.load()
+    drop_series(root, src_path)
+    tmp = os.path.join(root, "." + os.path.basename(path) + ".part")
+    ds.to_netcdf(tmp, encoding=encoding(ds, series=True, block=block))
+    os.replace(tmp, path)
+    return path
+
+
+if __name__ == "__main__":
+    root = os.getenv("SERIES_DIR") or os.path.join(os.getenv("CACHE_DIR", "./data/cache"), "series")
+    for src in sys.argv[1:]:
+        if find_series(root, src):
+            print(f"[=] {src}: series layout up to date")
+            continue
+        print(f"[*] {src}: {os.path.basename(build_series(src, root))}")
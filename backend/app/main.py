@@ -1,244 +1,1780 @@
 import os
 import json
-import tempfile
-import subprocess
+import time
+import hashlib
+import asyncio
+import logging
+import contextlib
 import datetime as dt
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict, AsyncIterator
 
 import httpx
 import numpy as np
 import xarray as xr
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Query, Header, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, PlainTextResponse
+from fastapi.responses import Response, PlainTextResponse, RedirectResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-=== Load environment ===
+from .store import (DEPTH_NAMES, LocalStore, Depth, detect_coords as _detect_coords, crop_bbox, depth_name, nearest_time_index,
+                    parse_utc, select_depth, surface_only)
+from .gridmeta import GridCatalog, GridMeta, wet_mask
+from .subset_cache import SubsetCache, SubsetScope, snap_bbox, snap_window, subset_key
+from .singleflight import SingleFlight
+from .wmts import TileCache, Tile, normalize_query, freshness, HTTP2_AVAILABLE
+from .encoding import negotiate, encode, encode_f32, grid_columns, encode_times, iso_times, ndjson_lines, UnsupportedFormat
+from .capabilities import CapabilitiesCache, parse_capabilities, search_layers, nearest_time
+from .tiles import FIELDS as XYZ_FIELDS, tile_bounds, pixel_centres, pixel_deg, pick_tile_level, valid_tile, sample
+from .pyramid import LEVELS as PYRAMID_LEVELS, block_mean, build_pyramid, is_current, pick_level
+from .layout import build_series, find_series
+from .derive import DERIVED, ICE_SIT_NAMES, add_derived, available as _available, inputs_of, pick_var
+from .prefetch import AccessLog, PrefetchScheduler
+from .shared import FileLock, ProcessFlight, arrays_dir, export_arrays, open_arrays
+from .interp import interp_points, is_circular
+from .aggregate import AreaStats, Region, Step, OPS as AGG_OPS
+from .alerts import AlertEngine, AlertHub, Watchlist, rule_region
+from .metrics import (REGISTRY, REQUEST_SECONDS, CACHE_EVENTS, DOWNLOAD_BYTES, span, record as record_stage,
+                      start_trace, end_trace)
+from .jobs import CliExecutor, QueueFull, JobTimeout, PRIORITY_SYSTEM, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+# === Load environment ===
 
 load_dotenv()
 API_HOST = os.getenv("API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("API_PORT", "8000"))
-WMTS_BASE = os.getenv("CMDS_WMTS_BASE", "https://wmts.marine.copernicus.eu/teroWmts
-")
+WMTS_BASE = os.getenv("CMDS_WMTS_BASE", "https://wmts.marine.copernicus.eu/teroWmts")
 CM_USER = os.getenv("COPERNICUSMARINE_USERNAME")
 CM_PASS = os.getenv("COPERNICUSMARINE_PASSWORD")
 DATASET_WAV = os.getenv("CMDS_DATASET_WAV", "cmems_mod_bal_wav_anfc_PT1H-i")
 DATASET_PHY = os.getenv("CMDS_DATASET_PHY", "cmems_mod_bal_phy_anfc_PT15M-i")
+DATASET_ICE = os.getenv("CMDS_DATASET_ICE", DATASET_PHY)
 CACHE_DIR = os.getenv("CACHE_DIR", "./data/cache")
+LOCAL_MAX_LAG_MIN = int(os.getenv("LOCAL_MAX_LAG_MIN", "90"))
+LOCAL_MAX_OPEN = int(os.getenv("LOCAL_MAX_OPEN", "32"))
+SUBSET_CACHE_DIR = os.getenv("SUBSET_CACHE_DIR", os.path.join(CACHE_DIR, "subsets"))
+SUBSET_CACHE_MAX_MB = int(os.getenv("SUBSET_CACHE_MAX_MB", "2048"))
+SUBSET_CACHE_TTL_MIN = int(os.getenv("SUBSET_CACHE_TTL_MIN", "360"))
+SUBSET_SNAP_DEG = float(os.getenv("SUBSET_SNAP_DEG", "0.05"))
+SUBSET_SNAP_MIN = int(os.getenv("SUBSET_SNAP_MIN", "60"))
+CLI_CONCURRENCY = int(os.getenv("CLI_CONCURRENCY", "2"))
+CLI_QUEUE_MAX = int(os.getenv("CLI_QUEUE_MAX", "32"))
+CLI_TIMEOUT_S = float(os.getenv("CLI_TIMEOUT_S", "300"))
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", os.path.join(CACHE_DIR, "tiles"))
+TILE_MEM_MAX_MB = int(os.getenv("TILE_MEM_MAX_MB", "64"))
+TILE_DISK_MAX_MB = int(os.getenv("TILE_DISK_MAX_MB", "1024"))
+TILE_DEFAULT_TTL_S = int(os.getenv("TILE_DEFAULT_TTL_S", "86400"))
+WMTS_MAX_CONNECTIONS = int(os.getenv("WMTS_MAX_CONNECTIONS", "20"))
+WMTS_CAPS_REFRESH_MIN = int(os.getenv("WMTS_CAPS_REFRESH_MIN", "60"))
+WMTS_CAPS_POLL_S = float(os.getenv("WMTS_CAPS_POLL_S", "60"))
+BATCH_MAX_POINTS = int(os.getenv("BATCH_MAX_POINTS", "1000"))
+TRACK_MAX_POINTS = int(os.getenv("TRACK_MAX_POINTS", "10000"))
+AGG_CACHE_MB = int(os.getenv("AGG_CACHE_MB", "64"))
+ALERTS_ENABLED = os.getenv("ALERTS_ENABLED", "1") not in ("0", "false", "no")
+ALERTS_CHECK_S = float(os.getenv("ALERTS_CHECK_S", "30"))
+ALERTS_HORIZON_H = float(os.getenv("ALERTS_HORIZON_H", "72"))
+ALERTS_KEEPALIVE_S = float(os.getenv("ALERTS_KEEPALIVE_S", "15"))
+STREAM_CHUNK_H = int(os.getenv("STREAM_CHUNK_H", "168"))
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") not in ("0", "false", "no")
+PREFETCH_TOP_N = int(os.getenv("PREFETCH_TOP_N", "50"))
+PREFETCH_BUDGET_MB = int(os.getenv("PREFETCH_BUDGET_MB", "500"))
+PREFETCH_HALF_LIFE_H = float(os.getenv("PREFETCH_HALF_LIFE_H", "72"))
+PREFETCH_CHECK_MIN = float(os.getenv("PREFETCH_CHECK_MIN", "5"))
+PREFETCH_MAX_AGE_H = float(os.getenv("PREFETCH_MAX_AGE_H", "6"))
+PYRAMID_DIR = os.getenv("PYRAMID_DIR", os.path.join(CACHE_DIR, "pyramid"))
+PYRAMID_CHECK_MIN = int(os.getenv("PYRAMID_CHECK_MIN", "10"))
+SERIES_DIR = os.getenv("SERIES_DIR", os.path.join(CACHE_DIR, "series"))
+SERIES_MAX_CELLS = int(os.getenv("SERIES_MAX_CELLS", "256"))
+GRID_DIR = os.getenv("GRID_DIR", os.path.join(CACHE_DIR, "grids"))
+SNAP_MAX_KM = float(os.getenv("SNAP_MAX_KM", "5"))
+XYZ_TILE_SIZE = int(os.getenv("XYZ_TILE_SIZE", "64"))
+XYZ_MAX_ZOOM = int(os.getenv("XYZ_MAX_ZOOM", "12"))
+XYZ_MAX_AGE_S = int(os.getenv("XYZ_MAX_AGE_S", "31536000"))
+XYZ_CACHE_DIR = os.getenv("XYZ_CACHE_DIR", os.path.join(CACHE_DIR, "xyz"))
+XYZ_MEM_MAX_MB = int(os.getenv("XYZ_MEM_MAX_MB", "64"))
+XYZ_DISK_MAX_MB = int(os.getenv("XYZ_DISK_MAX_MB", "512"))
+XYZ_LOCATE_TTL_S = float(os.getenv("XYZ_LOCATE_TTL_S", "10"))
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+# число процессов uvicorn (--workers читает ту же переменную): делит бюджеты памяти
+WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
 
 os.makedirs(CACHE_DIR, exist_ok=True)
 
+log = logging.getLogger("uvicorn.error")
+
 app = FastAPI(title="HydroMeteo CMDS API", version="1.1.1")
 
-CORS (без пустых значений)
+# CORS (без пустых значений)
 
 app.add_middleware(
-CORSMiddleware,
-allow_origins=[""], # ограничьте при необходимости
-allow_credentials=True,
-allow_methods=[""],
-allow_headers=["*"],
+    CORSMiddleware,
+    allow_origins=["*"],  # ограничьте при необходимости
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
 )
 
-=== Models ===
+# Файлы app/ingest.py: разделы baltic_<kind>_YYYYMMDD_HHMMSS.nc и суточные baltic_<kind>_YYYYMMDD.nc
+_store = LocalStore(
+    CACHE_DIR,
+    {"phy": DATASET_PHY, "wav": DATASET_WAV, "ice": DATASET_ICE},
+    max_lag=dt.timedelta(minutes=LOCAL_MAX_LAG_MIN),
+    max_open=LOCAL_MAX_OPEN,
+    pyramid_root=PYRAMID_DIR,
+    series_root=SERIES_DIR,
+    series_max_cells=SERIES_MAX_CELLS,
+)
+
+# Сетки и маски «море» по видам файлов: точки привязываются к ближайшему морскому узлу
+_grids = GridCatalog(_store, GRID_DIR, SNAP_MAX_KM)
+
+# Загрузки CLI, адресуемые по содержимому запроса (см. subset_cache.py)
+_subsets = SubsetCache(
+    SUBSET_CACHE_DIR,
+    max_bytes=SUBSET_CACHE_MAX_MB * 1024 * 1024,
+    ttl=dt.timedelta(minutes=SUBSET_CACHE_TTL_MIN),
+)
+
+# Все вызовы copernicusmarine идут через очередь, не блокируя event loop
+_cli = CliExecutor(concurrency=CLI_CONCURRENCY, max_queue=CLI_QUEUE_MAX, timeout=CLI_TIMEOUT_S)
+# Одна загрузка / один разбор файла на все одинаковые запросы «в полёте»
+_flights = SingleFlight()
+# ...и одна на все процессы uvicorn: блокировка по ключу в общем CACHE_DIR
+_xflights = ProcessFlight(os.path.join(CACHE_DIR, "locks"))
+
+# Тайлы WMTS: LRU в памяти + на диске, ключ — нормализованная строка запроса
+_tiles = TileCache(TILE_CACHE_DIR, mem_max_bytes=TILE_MEM_MAX_MB * 1024 * 1024 // WORKERS,
+                   disk_max_bytes=TILE_DISK_MAX_MB * 1024 * 1024)
+_http: Optional[httpx.AsyncClient] = None
+
+# XYZ-тайлы полей из локального куба: отрисованные тайлы, ключ включает версию файла
+_xyz = TileCache(XYZ_CACHE_DIR, mem_max_bytes=XYZ_MEM_MAX_MB * 1024 * 1024 // WORKERS,
+                 disk_max_bytes=XYZ_DISK_MAX_MB * 1024 * 1024)
+# (поле, срок из URL) -> (годен до, файл, фактический срок): тайлы одного срока не сканируют куб заново
+_xyz_located: Dict[Tuple[str, str], tuple] = {}
+
+# Частичные свёртки /api/area-stats по срокам: пересекающиеся запросы их переиспользуют
+_area = AreaStats(AGG_CACHE_MB * 1024 * 1024 // WORKERS)
+
+# Правила оповещений (общий файл всех воркеров) и рассылка изменений по SSE / WebSocket
+_watchlist = Watchlist(os.path.join(CACHE_DIR, "alerts.json"))
+_alert_hub = AlertHub(os.path.join(CACHE_DIR, "alert-events.json"))
+
+# GetCapabilities: сырой XML и компактный индекс слоёв, обновляются по расписанию
+_caps = CapabilitiesCache(os.path.join(CACHE_DIR, "wmts"))
+# качает и разбирает GetCapabilities один воркер, остальные перечитывают его файлы
+_caps_lock = FileLock(os.path.join(CACHE_DIR, "capabilities.lock"))
+
+# Журнал обращений (нормализованные ключи) для прогрева кэшей; планировщик — ниже
+_access = AccessLog(os.path.join(CACHE_DIR, "access_log.json"), half_life_s=PREFETCH_HALF_LIFE_H * 3600)
+# прогрев и фоновая сборка раскладок — в одном процессе из всех воркеров
+_prefetch_lock = FileLock(os.path.join(CACHE_DIR, "prefetch.lock"))
+_layouts_lock = FileLock(os.path.join(CACHE_DIR, "layouts.lock"))
+
+# === Models ===
 
 class TimeSeriesRequest(BaseModel):
-dataset: str
-variable: str
-lat: float
-lon: float
-depth: Optional[float] = None
-start_utc: Optional[str] = None
-end_utc: Optional[str] = None
+    dataset: str
+    variable: str
+    lat: float
+    lon: float
+    depth: Optional[float] = None
+    start_utc: Optional[str] = None
+    end_utc: Optional[str] = None
+    time_format: Optional[str] = None  # iso (по умолчанию) | epoch_ms | start_step
 
 class TimeSeriesResponse(BaseModel):
-times_utc: List[str]
-values: List[float]
-unit: Optional[str] = None
-meta: dict
+    times_utc: List[str]
+    values: List[Optional[float]]
+    unit: Optional[str] = None
+    meta: dict
+    time_encoding: str = "iso"
+    times_epoch_ms: Optional[List[int]] = None
+    time_start: Optional[str] = None
+    time_step_s: Optional[float] = None
+    time_count: Optional[int] = None
 
 class CurrentsGridRequest(BaseModel):
-min_lon: float
-min_lat: float
-max_lon: float
-max_lat: float
-time_utc: Optional[str] = None
-step: int = 6
-depth: Optional[float] = None
+    min_lon: float
+    min_lat: float
+    max_lon: float
+    max_lat: float
+    time_utc: Optional[str] = None
+    step: int = 6
+    depth: Optional[float] = None
+    max_arrows: Optional[int] = None  # предел стрелок по длинной стороне окна (вместо step)
 
 class CurrentsGridResponse(BaseModel):
-lons: List[float]
-lats: List[float]
-u: List[float]
-v: List[float]
-meta: dict
-
-=== Helpers ===
-
-def _ensure_login_if_possible() -> None:
-if not (CM_USER and CM_PASS):
-return
-try:
-subprocess.run(
-["copernicusmarine", "login", "--username", CM_USER, "--password", CM_PASS, "--overwrite"],
-check=False, capture_output=True, text=True
+    lons: List[float]
+    lats: List[float]
+    u: List[Optional[float]]
+    v: List[Optional[float]]
+    meta: dict
+
+class BatchPoint(BaseModel):
+    id: Optional[str] = None
+    lat: float
+    lon: float
+
+class ProfileRequest(BaseModel):
+    dataset: str = "physics"
+    variables: List[str] = ["thetao", "uo", "vo"]
+    lat: float
+    lon: float
+    time_utc: Optional[str] = None
+    max_depth: Optional[float] = None  # м; по умолчанию — весь столб
+
+class ProfileResponse(BaseModel):
+    depths: List[float]
+    values: Dict[str, List[Optional[float]]]
+    units: Dict[str, Optional[str]]
+    meta: dict
+
+class DepthGridRequest(BaseModel):
+    dataset: str = "physics"
+    variables: List[str]
+    min_lon: float
+    min_lat: float
+    max_lon: float
+    max_lat: float
+    time_utc: Optional[str] = None
+    depth: Optional[float] = None  # м; ближайший уровень, по умолчанию верхний
+    step: int = 1
+    max_cells: Optional[int] = None  # предел узлов по длинной стороне окна (вместо step)
+
+class DepthGridResponse(BaseModel):
+    lons: List[float]
+    lats: List[float]
+    values: Dict[str, List[Optional[float]]]
+    units: Dict[str, Optional[str]]
+    meta: dict
+
+class BatchTimeSeriesRequest(BaseModel):
+    dataset: str
+    variables: List[str]
+    points: List[BatchPoint]
+    start_utc: Optional[str] = None
+    end_utc: Optional[str] = None
+    time_format: Optional[str] = None
+
+class BatchTimeSeriesResponse(BaseModel):
+    times_utc: List[str]
+    time_encoding: str = "iso"
+    times_epoch_ms: Optional[List[int]] = None
+    time_start: Optional[str] = None
+    time_step_s: Optional[float] = None
+    time_count: Optional[int] = None
+    points: List[dict]
+    # values[variable][i_point][i_time]
+    values: Dict[str, List[List[Optional[float]]]]
+    units: Dict[str, Optional[str]]
+    meta: dict
+
+class TrackPoint(BaseModel):
+    lat: float
+    lon: float
+    time_utc: str
+
+class TrackRequest(BaseModel):
+    # {"waves": ["VHM0", "VMDR"], "physics": ["uo", "vo"], "ice": ["siconc"]}
+    variables: Dict[str, List[str]]
+    points: List[TrackPoint]
+
+class TrackResponse(BaseModel):
+    times_utc: List[str]
+    # values[variable][i_point]; None — точка вне охвата данных (или на суше)
+    values: Dict[str, List[Optional[float]]]
+    units: Dict[str, Optional[str]]
+    meta: dict
+
+class AreaStatsRequest(BaseModel):
+    dataset: str
+    variable: str
+    # ровно одно из: bbox [min_lon, min_lat, max_lon, max_lat], polygon [[lon, lat], ...], points
+    bbox: Optional[List[float]] = None
+    polygon: Optional[List[List[float]]] = None
+    points: Optional[List[BatchPoint]] = None
+    start_utc: Optional[str] = None
+    end_utc: Optional[str] = None
+    percentiles: List[float] = []
+    # пороги превышения: доля площади по срокам и часы за порогом по узлам
+    thresholds: List[float] = []
+    op: str = "gt"
+    series: bool = False
+
+class AreaStatsResponse(BaseModel):
+    stats: dict
+    exceedance: List[dict]
+    times_utc: Optional[List[str]] = None
+    series: Optional[dict] = None
+    unit: Optional[str] = None
+    meta: dict
+
+class AlertRuleRequest(BaseModel):
+    name: Optional[str] = None
+    dataset: str
+    variable: str
+    op: str = "gt"
+    threshold: float
+    # точка (lat, lon) или область: bbox [min_lon, min_lat, max_lon, max_lat] / polygon [[lon, lat], ...]
+    lat: Optional[float] = None
+    lon: Optional[float] = None
+    bbox: Optional[List[float]] = None
+    polygon: Optional[List[List[float]]] = None
+    # для области: срабатывает, если за порогом не меньше этой доли узлов (%)
+    min_area_pct: Optional[float] = None
+    horizon_h: Optional[float] = None
+
+class IceSeriesRequest(BaseModel):
+    lat: float
+    lon: float
+    start_utc: Optional[str] = None
+    end_utc: Optional[str] = None
+    dataset_id: Optional[str] = None
+
+class IceSeriesResponse(BaseModel):
+    times_utc: List[str]
+    siconc: List[Optional[float]]
+    sithick: List[Optional[float]]
+    drift_speed: Optional[List[Optional[float]]] = None
+    drift_dir_deg: Optional[List[Optional[float]]] = None
+    units: Dict[str, Optional[str]] = {}
+    meta: dict = {}
+
+# === Helpers ===
+
+def _resolve_dataset(name: str) -> str:
+    dataset = name.lower().strip()
+    if dataset not in ("waves", "physics", "ice"):
+        raise HTTPException(status_code=400, detail="dataset должен быть 'waves', 'physics' или 'ice'")
+    return DATASET_WAV if dataset == "waves" else (DATASET_ICE if dataset == "ice" else DATASET_PHY)
+
+def _cli_depth(dataset_id: str, depth: Depth) -> Optional[Tuple[float, float]]:
+    """Глубины для CLI (-z/-Z): у трёхмерного PHY без depth — только верхний уровень."""
+    if dataset_id != DATASET_PHY:
+        return None
+    if depth is None:
+        return 0.0, 0.0
+    if isinstance(depth, tuple):
+        return float(depth[0]), float(depth[1])
+    return float(depth), float(depth)
+
+def _depth_meta(ds) -> Optional[float]:
+    """Фактический уровень (м) после select_depth или None, если у полей нет глубины."""
+    for name in DEPTH_NAMES:
+        if name in ds.coords and ds[name].ndim == 0:
+            return float(ds[name].values)
+    return None
+
+def _snapshot_window(time_utc: Optional[str]) -> Tuple[str, str, str]:
+    """Срок снимка (по умолчанию — сейчас) и окно ±1 мин вокруг него."""
+    t = time_utc or dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+    t_dt = dt.datetime.fromisoformat(t.replace("Z", "+00:00"))
+    t_start = (t_dt - dt.timedelta(minutes=1)).isoformat().replace("+00:00", "Z")
+    t_end = (t_dt + dt.timedelta(minutes=1)).isoformat().replace("+00:00", "Z")
+    return t, t_start, t_end
+
+def _default_window(start_utc: Optional[str], end_utc: Optional[str]) -> Tuple[str, str]:
+    t_end = end_utc or dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+    t_start = start_utc or (dt.datetime.utcnow() - dt.timedelta(hours=48)).replace(microsecond=0).isoformat() + "Z"
+    return t_start, t_end
+
+def _time_fields(times: np.ndarray, time_format: Optional[str]) -> dict:
+    try:
+        return encode_times(times, time_format)
+    except UnsupportedFormat as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _nan_to_none(a: np.ndarray) -> list:
+    out = a.astype(object)
+    out[np.isnan(a)] = None
+    return out.tolist()
+
+async def _ensure_login_if_possible() -> None:
+    if not (CM_USER and CM_PASS):
+        return
+    try:
+        await _cli.run(
+            ["copernicusmarine", "login", "--username", CM_USER, "--password", CM_PASS, "--overwrite"],
+            priority=PRIORITY_SYSTEM,
+        )
+    except (FileNotFoundError, JobTimeout, QueueFull):
+        pass
+
+async def _until_disconnect(aw, request: Optional[Request] = None):
+    """Дождаться aw; если клиент закрыл соединение — отменить ожидание."""
+    task = asyncio.ensure_future(aw)
+    if request is None:
+        return await task
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=0.5)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            task.cancel()
+            # 499: клиент закрыл соединение (ответ уже никто не прочитает)
+            raise HTTPException(status_code=499, detail="Клиент отключился, загрузка отменена")
+
+async def _subset_with_cli(dataset_id: str, variables: List[str],
+                           xmin: float, xmax: float, ymin: float, ymax: float,
+                           t_start: Optional[str], t_end: Optional[str],
+                           request: Optional[Request] = None, priority: int = PRIORITY_INTERACTIVE,
+                           depth: Depth = None) -> str:
+    """Путь к NetCDF-подмножеству из кэша; при промахе — загрузка через CLI.
+
+    bbox и окно времени расширяются до сетки SUBSET_SNAP_DEG / SUBSET_SNAP_MIN,
+    чтобы соседние клики попадали в одну запись кэша. Одновременные запросы с
+    тем же ключом (или внутри уже идущей загрузки) ждут одну общую загрузку.
+    Из трёхмерного PHY качаются только нужные уровни (depth, см. _cli_depth).
+    """
+    xmin, xmax, ymin, ymax = snap_bbox(xmin, xmax, ymin, ymax, SUBSET_SNAP_DEG)
+    if t_start and t_end:
+        t_start, t_end = snap_window(parse_utc(t_start), parse_utc(t_end), SUBSET_SNAP_MIN)
+    z = _cli_depth(dataset_id, depth)
+    key = subset_key(dataset_id, variables, (xmin, xmax, ymin, ymax), t_start, t_end,
+                     extra={"depth": [z[0], z[1] if np.isfinite(z[1]) else None]} if z else None)
+    cached = _subsets.get(key)
+    CACHE_EVENTS.inc(cache="subset", result="hit" if cached else "miss")
+    if cached:
+        return cached
+    scope = SubsetScope(dataset_id, frozenset(variables), xmin, xmax, ymin, ymax, t_start, t_end, z)
+    # другой воркер мог скачать тот же ключ, пока мы ждали его блокировку
+    shared = lambda: _xflights.do("subset:" + key, lambda: _download_subset(key, scope, priority),
+                                  recheck=lambda: _subsets.get(key))
+    flight = _flights.do(key, shared, scope=scope, match=scope.within)
+    return await _until_disconnect(flight, request)
+
+async def _download_subset(key: str, scope: SubsetScope, priority: int = PRIORITY_INTERACTIVE) -> str:
+    part_path = _subsets.reserve(key)
+    cmd = ["copernicusmarine", "subset", "-i", scope.dataset_id]
+    for v in sorted(scope.variables):
+        cmd += ["-v", v]
+    cmd += ["-x", str(scope.xmin), "-X", str(scope.xmax), "-y", str(scope.ymin), "-Y", str(scope.ymax)]
+    if scope.t_start: cmd += ["-t", scope.t_start]
+    if scope.t_end: cmd += ["-T", scope.t_end]
+    if scope.depth is not None:
+        cmd += ["-z", str(scope.depth[0])]
+        if np.isfinite(scope.depth[1]):
+            cmd += ["-Z", str(scope.depth[1])]
+        # границы — к ближайшим уровням: -z 10 -Z 10 даёт один уровень около 10 м
+        cmd += ["--coordinates-selection-method", "nearest"]
+    cmd += ["-o", os.path.dirname(part_path), "-f", os.path.basename(part_path), "--file-format", "netcdf"]
+    try:
+        try:
+            t0 = time.perf_counter()
+            res = await _cli.run(cmd, priority=priority)
+            # ожидание в очереди и сам процесс — отдельными этапами
+            record_stage("cli_queue", max(0.0, time.perf_counter() - t0 - res.elapsed))
+            record_stage("cli", res.elapsed)
+        except FileNotFoundError:
+            raise HTTPException(status_code=500, detail="Не найден CLI 'copernicusmarine'. Установите пакет и выполните login.")
+        except QueueFull as e:
+            raise HTTPException(status_code=503, detail="Очередь загрузок CMDS переполнена, повторите позже",
+                                headers={"Retry-After": str(e.retry_after)})
+        except JobTimeout as e:
+            raise HTTPException(status_code=504, detail=f"Превышено время ожидания copernicusmarine subset: {e}")
+        if res.returncode != 0:
+            raise HTTPException(status_code=502, detail=(res.stderr or res.stdout or "Ошибка copernicusmarine subset"))
+        # .npy-копия для mmap: воркеры делят страницы вместо своих копий массивов
+        await asyncio.to_thread(_export_arrays, part_path)
+    except BaseException:
+        # недокачанный файл (ошибка, таймаут, отмена) в кэш не попадает
+        _subsets.discard(part_path)
+        raise
+    try: DOWNLOAD_BYTES.inc(os.path.getsize(part_path), source="subset")
+    except OSError: pass
+    return _subsets.publish(key, part_path, meta={
+        "dataset_id": scope.dataset_id, "variables": sorted(scope.variables),
+        "bbox": [scope.xmin, scope.xmax, scope.ymin, scope.ymax],
+        "t_start": scope.t_start, "t_end": scope.t_end,
+        "depth": None if scope.depth is None else [scope.depth[0], scope.depth[1] if np.isfinite(scope.depth[1]) else None]})
+
+def _http_client() -> httpx.AsyncClient:
+    """Общий на всё приложение клиент: keep-alive и (если есть h2) HTTP/2 к WMTS."""
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(120.0, connect=15.0),
+            limits=httpx.Limits(max_connections=WMTS_MAX_CONNECTIONS,
+                                max_keepalive_connections=WMTS_MAX_CONNECTIONS),
+            auth=(CM_USER, CM_PASS) if (CM_USER and CM_PASS) else None,
+        )
+    return _http
+
+async def _fetch_tile(query: str, stale: Optional[Tile]) -> Tuple[Tile, str]:
+    url = WMTS_BASE + ("?" + query if query else "")
+    headers = stale.conditional_headers() if stale is not None else {}
+    with span("upstream"):
+        r = await _http_client().get(url, headers=headers)
+    DOWNLOAD_BYTES.inc(len(r.content), source="wmts")
+    expires = freshness(r.headers, TILE_DEFAULT_TTL_S)
+    if r.status_code == 304 and stale is not None:
+        if expires is None:
+            return stale, "REVALIDATED"
+        return _tiles.refresh(query, stale, expires), "REVALIDATED"
+    if r.status_code != 200:
+        raise HTTPException(status_code=r.status_code, detail=f"WMTS tile error: {r.text[:400]}")
+    tile = Tile(r.content, r.headers.get("Content-Type", "image/png"),
+                r.headers.get("ETag"), r.headers.get("Last-Modified"), expires or 0.0)
+    if expires is not None:
+        _tiles.put(query, tile)
+    return tile, "MISS"
+
+def _tile_response(tile: Tile, request: Request, state: str, immutable: bool = False) -> Response:
+    cache_control = f"public, max-age={tile.max_age()}" + (", immutable" if immutable else "")
+    headers = {"Cache-Control": cache_control, "X-Cache": state}
+    if tile.etag:
+        headers["ETag"] = tile.etag
+        if request.headers.get("if-none-match") == tile.etag:
+            return Response(status_code=304, headers=headers)
+    if tile.last_modified:
+        headers["Last-Modified"] = tile.last_modified
+    return Response(content=tile.body, media_type=tile.media_type, headers=headers)
+
+async def _refresh_capabilities() -> None:
+    params = {"service": "WMTS", "version": "1.0.0", "request": "GetCapabilities"}
+    headers = {"If-None-Match": _caps.etag} if (_caps.etag and _caps.xml) else {}
+    r = await _http_client().get(WMTS_BASE, params=params, headers=headers, timeout=60.0)
+    if r.status_code == 304:
+        _caps.touch()
+        return
+    if r.status_code != 200:
+        raise HTTPException(status_code=r.status_code, detail=f"WMTS GetCapabilities error: {r.text[:400]}")
+    index = await asyncio.to_thread(parse_capabilities, r.content)
+    _caps.update(r.content, index, r.headers.get("ETag"))
+
+def _caps_reloaded() -> Optional[dict]:
+    _caps.reload()
+    return _caps.index
+
+async def _capabilities_loop() -> None:
+    """Лидер (по _caps_lock) обновляет раз в WMTS_CAPS_REFRESH_MIN, остальные подхватывают файлы по mtime."""
+    attempted = 0.0
+    while True:
+        try:
+            if _caps_lock.try_acquire():
+                if time.time() - max(_caps.fetched_at or 0.0, attempted) >= WMTS_CAPS_REFRESH_MIN * 60:
+                    attempted = time.time()
+                    await _flights.do("wmts:capabilities", _refresh_capabilities)
+            else:
+                await asyncio.to_thread(_caps.reload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("WMTS GetCapabilities refresh failed: %s", e)
+        await asyncio.sleep(WMTS_CAPS_POLL_S)
+
+def _build_missing_layouts(files: Dict[str, List[str]]) -> List[str]:
+    built = []
+    for path in files["phy"]:
+        if not is_current(PYRAMID_DIR, path):
+            build_pyramid(path, PYRAMID_DIR)
+            built.append("pyramid:" + os.path.basename(path))
+    for kind, paths in files.items():
+        for path in paths:
+            if find_series(SERIES_DIR, path) is None:
+                build_series(path, SERIES_DIR)
+                built.append("series:" + os.path.basename(path))
+    return built
+
+async def _layouts_loop() -> None:
+    """Страховка к ingest: пирамида течений и раскладка «ряды» для файлов без них."""
+    while True:
+        try:
+            if _layouts_lock.try_acquire():
+                # LocalStore потокобезопасен: и обход каталога, и запись файлов — в потоке
+                built = await asyncio.to_thread(
+                    lambda: _build_missing_layouts({kind: _store.files(kind) for kind in ("phy", "wav", "ice")}))
+                if built:
+                    log.info("Derived layouts built: %s", ", ".join(built))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("Derived layouts build failed: %s", e)
+        await asyncio.sleep(PYRAMID_CHECK_MIN * 60)
+
+async def _capabilities_index() -> dict:
+    if _caps.index is None:
+        # холодный старт: качает один воркер, остальные берут его файлы
+        await _flights.do("wmts:capabilities", lambda: _xflights.do(
+            "wmts:capabilities", _refresh_capabilities, recheck=_caps_reloaded))
+    return _caps.index
+
+def _output_format(request: Request, fmt: Optional[str]) -> str:
+    try:
+        return negotiate(fmt, request.headers.get("accept"))
+    except UnsupportedFormat as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+def _binary_response(fmt: str, arrays: Dict[str, np.ndarray], meta: dict,
+                     columns: Optional[Dict[str, np.ndarray]] = None,
+                     quantize: Optional[str] = None, nan_mask: bool = False,
+                     float_fields: Optional[List[str]] = None) -> Response:
+    try:
+        body, media = encode(fmt, arrays, meta, columns=columns, quant=quantize,
+                             nan_mask=nan_mask, float_fields=float_fields)
+    except UnsupportedFormat as e:
+        raise HTTPException(status_code=406, detail=str(e))
+    return Response(content=body, media_type=media)
+
+def _export_arrays(nc_path: str) -> None:
+    with xr.open_dataset(nc_path) as ds:
+        export_arrays(ds.load(), arrays_dir(nc_path))
+
+def _load_nc(path: str) -> xr.Dataset:
+    if os.path.isdir(arrays_dir(path)):
+        try:
+            return open_arrays(arrays_dir(path))
+        except (OSError, ValueError, KeyError):
+            pass
+    with xr.open_dataset(path) as ds:
+        return ds.load()
+
+async def _open_local(dataset_id: str, variables: List[str],
+                      xmin: float, xmax: float, ymin: float, ymax: float,
+                      t_start: str, t_end: str, snapshot: Optional[str] = None, level: int = 1,
+                      depth: Depth = None) -> Optional[xr.Dataset]:
+    """Подмножество из локального куба (с производными полями) или None.
+
+    Чтение NetCDF идёт в потоке: широкое окно не останавливает event loop.
+    """
+    def local(names: List[str]) -> Optional[xr.Dataset]:
+        try:
+            if snapshot is not None:
+                return _store.open_snapshot(dataset_id, names, xmin, xmax, ymin, ymax, snapshot, level=level,
+                                            depth=depth)
+            return _store.open_window(dataset_id, names, xmin, xmax, ymin, ymax, t_start, t_end, depth=depth)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def read() -> Optional[xr.Dataset]:
+        ds = local(variables)
+        derived = [v for v in variables if v in DERIVED]
+        if ds is None and derived:
+            ds = local(inputs_of(variables))
+            if ds is not None:
+                ds = add_derived(ds, derived)
+        return ds
+
+    with span("open"):
+        ds = await asyncio.to_thread(read)
+    CACHE_EVENTS.inc(cache="local_store", result="miss" if ds is None else "hit")
+    return ds
+
+@contextlib.asynccontextmanager
+async def _open_subset(dataset_id: str, variables: List[str],
+                       xmin: float, xmax: float, ymin: float, ymax: float,
+                       t_start: str, t_end: str, snapshot: Optional[str] = None,
+                       request: Optional[Request] = None, level: int = 1,
+                       depth: Depth = None,
+                       cli_variables: Optional[List[str]] = None) -> AsyncIterator[Tuple[xr.Dataset, str]]:
+    """Подмножество из локального куба, а при выходе за его покрытие — через CLI.
+
+    Отдаёт (dataset, source), где source — "local" или "cmds". level > 1 (только
+    для snapshot) — поля, осреднённые блоками level x level узлов. Производные
+    поля (derive.py) берутся из файлов ingest, а если их там нет — считаются
+    по исходным переменным. depth — уровни по глубине (store.select_depth):
+    по умолчанию верхний, число — ближайший уровень, (min, max) — диапазон.
+    cli_variables — что запросить у CLI вместо variables (например, поля,
+    которых в локальном кубе нет вовсе).
+    """
+    ds = await _open_local(dataset_id, variables, xmin, xmax, ymin, ymax, t_start, t_end, snapshot, level, depth)
+    if ds is not None:
+        yield ds, "local"
+        return
+    variables = cli_variables or variables
+    derived = [v for v in variables if v in DERIVED]
+    raw = inputs_of(variables)
+    nc_path = await _subset_with_cli(dataset_id, raw, xmin, xmax, ymin, ymax, t_start, t_end, request, depth=depth)
+    # один разбор файла на всех одновременных читателей
+    with span("open"):
+        full = await _flights.do("open:" + nc_path, lambda: asyncio.to_thread(_load_nc, nc_path))
+    with span("detect_coords"):
+        tname, la, lo = _detect_coords(full)
+    # кэшированный файл шире запроса (snap) — обрезаем до исходного окна
+    with span("select"):
+        ds = select_depth(crop_bbox(full[raw], la, lo, xmin, xmax, ymin, ymax), depth)
+        if snapshot is not None:
+            ds = block_mean(ds.isel({tname: [nearest_time_index(ds, tname, parse_utc(snapshot))]}), level)
+        else:
+            ds = ds.sel({tname: slice(parse_utc(t_start), parse_utc(t_end))})
+        if derived:
+            ds = add_derived(ds, derived)
+    yield ds, "cmds"
+
+def _to_timeseries_json(da: xr.DataArray, time_format: Optional[str] = None) -> TimeSeriesResponse:
+    time_dim = da.dims[0]
+    vals = _nan_to_none(da.values.astype(float))
+    unit = da.attrs.get("units")
+    return TimeSeriesResponse(values=vals, unit=unit, meta={}, **_time_fields(da[time_dim].values, time_format))
+
+# === Prefetch ===
+
+def _hours_from_now(t: str) -> int:
+    now = dt.datetime.now(dt.timezone.utc).replace(tzinfo=None)
+    return int(round((parse_utc(t) - np.datetime64(now, "ns")) / np.timedelta64(1, "h")))
+
+def _record_window(ds_id: str, variables: List[str], xmin: float, xmax: float, ymin: float, ymax: float,
+                   t_start: str, t_end: str, depth: Optional[float] = None) -> None:
+    """Ключ ряда: bbox по сетке кэша, окно — относительно текущего момента, глубина (если не верхний уровень)."""
+    try:
+        end_h = _hours_from_now(t_end)
+        hours = max(1, end_h - _hours_from_now(t_start))
+    except ValueError:
+        return
+    params = {"dataset_id": ds_id, "variables": sorted(variables),
+              "bbox": list(snap_bbox(xmin, xmax, ymin, ymax, SUBSET_SNAP_DEG)), "end_h": end_h, "hours": hours}
+    if depth is not None:
+        params["depth"] = float(depth)
+    _access.record("window", params)
+
+def _record_grid(xmin: float, xmax: float, ymin: float, ymax: float, t: str, depth: Optional[float] = None) -> None:
+    try:
+        offset_h = _hours_from_now(t)
+    except ValueError:
+        return
+    params = {"bbox": list(snap_bbox(xmin, xmax, ymin, ymax, SUBSET_SNAP_DEG)), "offset_h": offset_h}
+    if depth is not None:
+        params["depth"] = float(depth)
+    _access.record("grid", params)
+
+def _from_now(hours: float) -> str:
+    return (dt.datetime.utcnow() + dt.timedelta(hours=hours)).replace(microsecond=0).isoformat() + "Z"
+
+async def _prefetch_subset(ds_id: str, variables: List[str], bbox: List[float], t_start: str, t_end: str,
+                           snapshot: Optional[str] = None, depth: Optional[float] = None) -> int:
+    """Прогреть subset фоновым приоритетом; вернуть объём скачанного (0 — уже было)."""
+    window = (snapshot, snapshot) if snapshot else (t_start, t_end)
+    if (_store.covers(ds_id, variables, *bbox, *window, depth=depth)
+            or _store.covers(ds_id, inputs_of(variables), *bbox, *window, depth=depth)):
+        return 0
+    started = time.time()
+    path = await _subset_with_cli(ds_id, inputs_of(variables), *bbox, t_start, t_end, priority=PRIORITY_BACKGROUND,
+                                  depth=depth)
+    st = os.stat(path)
+    return st.st_size if st.st_mtime >= started else 0
+
+async def _prefetch_window(p: dict) -> int:
+    return await _prefetch_subset(p["dataset_id"], p["variables"], p["bbox"],
+                                  _from_now(p["end_h"] - p["hours"]), _from_now(p["end_h"]), depth=p.get("depth"))
+
+async def _prefetch_grid(p: dict) -> int:
+    t = _from_now(p["offset_h"])
+    return await _prefetch_subset(DATASET_PHY, ["uo", "vo"], p["bbox"], _from_now(p["offset_h"] - 1 / 60),
+                                  _from_now(p["offset_h"] + 1 / 60), snapshot=t, depth=p.get("depth"))
+
+def _fresh_tile(query: str) -> Optional[Tuple[Tile, str]]:
+    tile, tier = _tiles.get(query)
+    return (tile, "HIT-" + tier.upper()) if tile is not None and tile.fresh() else None
+
+async def _fetch_tile_shared(query: str, stale: Optional[Tile]) -> Tuple[Tile, str]:
+    """_fetch_tile один раз на все процессы: остальные берут тайл с общего диска."""
+    return await _flights.do("tile:" + query, lambda: _xflights.do(
+        "tile:" + query, lambda: _fetch_tile(query, stale), recheck=lambda: _fresh_tile(query)))
+
+async def _prefetch_tile(p: dict) -> int:
+    query = p["query"]
+    tile, _ = _tiles.get(query)
+    if tile is not None and tile.fresh():
+        return 0
+    tile, state = await _fetch_tile_shared(query, tile)
+    return len(tile.body) if state == "MISS" else 0
+
+def _estimate_subset(ds_id: str, n_vars: int, bbox: List[float], hours: float) -> int:
+    """Грубая оценка объёма subset: узлы x сроки x переменные x float32."""
+    dlat, dlon = _store.grid_step(ds_id, []) or (1 / 60.0, 1 / 36.0)
+    cells = (abs(bbox[1] - bbox[0]) / dlon + 1) * (abs(bbox[3] - bbox[2]) / dlat + 1)
+    step_h = 0.25 if "PT15M" in ds_id else 1.0
+    return int(cells * (hours / step_h + 1) * n_vars * 4)
+
+def _data_signature():
+    """Меняется с приходом нового прогона в локальный куб (и не реже раза в PREFETCH_MAX_AGE_H)."""
+    latest = tuple(str(_store.latest(d)) for d in (DATASET_PHY, DATASET_WAV, DATASET_ICE))
+    return latest + (int(time.time() // (PREFETCH_MAX_AGE_H * 3600)),)
+
+_prefetch = PrefetchScheduler(
+    _access,
+    runners={"window": _prefetch_window, "grid": _prefetch_grid, "tile": _prefetch_tile},
+    estimate={"window": lambda p: _estimate_subset(p["dataset_id"], len(p["variables"]), p["bbox"], p["hours"]),
+              "grid": lambda p: _estimate_subset(DATASET_PHY, 2, p["bbox"], 0),
+              "tile": lambda p: 50 * 1024},
+    signature=_data_signature,
+    budget_bytes=PREFETCH_BUDGET_MB * 1024 * 1024,
+    top_n=PREFETCH_TOP_N,
+    interval_s=PREFETCH_CHECK_MIN * 60,
+    lead=_prefetch_lock.try_acquire,
 )
-except FileNotFoundError:
-pass
-
-def subset_with_cli(dataset_id: str, variables: List[str],
-xmin: float, xmax: float, ymin: float, ymax: float,
-t_start: Optional[str], t_end: Optional[str]) -> str:
-fd, out_path = tempfile.mkstemp(prefix="subset", suffix=".nc", dir=CACHE_DIR)
-os.close(fd)
-cmd = ["copernicusmarine", "subset", "-i", dataset_id]
-for v in variables:
-cmd += ["-v", v]
-cmd += ["-x", str(xmin), "-X", str(xmax), "-y", str(ymin), "-Y", str(ymax)]
-if t_start: cmd += ["-t", t_start]
-if t_end: cmd += ["-T", t_end]
-cmd += ["-o", os.path.dirname(out_path), "-f", os.path.basename(out_path), "--file-format", "netcdf"]
-try:
-subprocess.run(cmd, check=True, capture_output=True, text=True)
-except FileNotFoundError:
-raise HTTPException(status_code=500, detail="Не найден CLI 'copernicusmarine'. Установите пакет и выполните login.")
-except subprocess.CalledProcessError as e:
-raise HTTPException(status_code=502, detail=(e.stderr or e.stdout or "Ошибка copernicusmarine subset"))
-return out_path
-
-def _detect_coords(ds: xr.Dataset) -> Tuple[str, str, str]:
-time_candidates = ["time", "t"]
-lat_candidates = ["latitude", "lat", "y"]
-lon_candidates = ["longitude", "lon", "x"]
-def pick(cands, present):
-for n in cands:
-if n in present: return n
-return None
-present = set(list(ds.dims) + list(ds.coords))
-t = pick(time_candidates, present)
-la = pick(lat_candidates, present)
-lo = pick(lon_candidates, present)
-if not (t and la and lo):
-for v in ds.variables:
-var = ds[v]
-std = getattr(var, "standard_name", "")
-if std == "latitude": la = v
-elif std == "longitude": lo = v
-if not la or not lo:
-raise ValueError("Невозможно определить имена координат (lat/lon)")
-if not t:
-for cand in time_candidates:
-if cand in ds:
-t = cand
-break
-if not t:
-raise ValueError("Невозможно определить имя временной оси")
-return t, la, lo
-
-def _to_timeseries_json(da: xr.DataArray) -> TimeSeriesResponse:
-times_iso: List[str] = []
-time_dim = da.dims[0]
-for ts in da[time_dim].values:
-if hasattr(ts, "astype"):
-py_dt = np.datetime64(ts).astype("datetime64[ms]").astype(dt.datetime)
-else:
-py_dt = ts
-times_iso.append(py_dt.replace(tzinfo=dt.timezone.utc).isoformat().replace("+00:00", "Z"))
-vals = da.values.astype(float).tolist()
-unit = da.attrs.get("units")
-return TimeSeriesResponse(times_utc=times_iso, values=vals, unit=unit, meta={})
+
+# === Metrics ===
+
+@app.middleware("http")
+async def _timing(request: Request, call_next):
+    """Время запроса по шаблону маршрута; медленные — в лог с разбивкой по этапам.
+
+    Для потоковых ответов это время до начала тела.
+    """
+    trace, token = start_trace(request.scope)
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        end_trace(token)
+        elapsed = trace.elapsed()
+        REQUEST_SECONDS.observe(elapsed, endpoint=trace.endpoint, method=request.method, status=status)
+        if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+            stages = dict(trace.stages)
+            stages["other"] = max(0.0, elapsed - sum(stages.values()))
+            log.warning("Slow request %s %s -> %s in %.0f ms: %s", request.method, request.url.path, status,
+                        elapsed * 1000, ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in stages.items()))
+
+@REGISTRY.collector
+def _component_gauges():
+    cli, subsets, flights = _cli.stats(), _subsets.stats(), _flights.stats()
+    tiles = [(name, cache.stats()) for name, cache in (("wmts", _tiles), ("xyz", _xyz))]
+    last = _prefetch.last_run or {}
+    return [
+        ("hydrometeo_cli_queue_depth", "gauge", "CLI jobs waiting in the queue", [({}, cli["queued"])]),
+        ("hydrometeo_cli_running", "gauge", "CLI jobs running", [({}, cli["running"])]),
+        ("hydrometeo_cli_avg_job_seconds", "gauge", "Moving average of CLI job duration",
+         [({}, cli["avg_job_s"])]),
+        ("hydrometeo_subset_cache_bytes", "gauge", "Subset cache size on disk", [({}, subsets["bytes"])]),
+        ("hydrometeo_subset_cache_entries", "gauge", "Subset cache entries", [({}, subsets["entries"])]),
+        ("hydrometeo_single_flight_in_flight", "gauge", "Shared loads in flight", [({}, flights["in_flight"])]),
+        ("hydrometeo_single_flight_joined_total", "counter", "Requests that joined a load in flight",
+         [({}, flights["joined"])]),
+        ("hydrometeo_shared_flight_total", "counter", "Cross-worker loads run here or adopted from another worker",
+         [({"result": k}, v) for k, v in _xflights.stats().items()]),
+        ("hydrometeo_tile_cache_hits_total", "counter", "Tile cache hits by cache and tier",
+         [({"cache": n, "tier": tier}, v) for n, st in tiles for tier, v in st["hits"].items()]),
+        ("hydrometeo_tile_cache_misses_total", "counter", "Tile cache misses by cache",
+         [({"cache": n}, st["misses"]) for n, st in tiles]),
+        ("hydrometeo_tile_cache_bytes", "gauge", "Tile cache size by cache and tier",
+         [({"cache": n, "tier": "memory"}, st["memory_bytes"]) for n, st in tiles]
+         + [({"cache": n, "tier": "disk"}, st["disk_bytes"]) for n, st in tiles]),
+        ("hydrometeo_grid_index_bytes", "gauge", "Grid metadata and land/sea masks in memory",
+         [({}, _grids.stats()["bytes"])]),
+        ("hydrometeo_area_stats_cache_bytes", "gauge", "Cached per-step partial reductions",
+         [({}, _area.stats()["bytes"])]),
+        ("hydrometeo_alert_subscribers", "gauge", "Open alert streams (SSE and WebSocket)",
+         [({}, _alert_hub.stats()["subscribers"])]),
+        ("hydrometeo_alerts_active", "gauge", "Alert rules currently raised",
+         [({}, sum(s["active"] for s in _alerts.state.values()))]),
+        ("hydrometeo_prefetch_last_run_bytes", "gauge", "Bytes downloaded by the last prefetch run",
+         [({}, last.get("bytes", 0))]),
+    ]
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 @app.on_event("startup")
 async def on_startup():
-_ensure_login_if_possible()
+    await _cli.start()
+    asyncio.create_task(_ensure_login_if_possible())
+    app.state.caps_task = asyncio.create_task(_capabilities_loop())
+    app.state.layouts_task = asyncio.create_task(_layouts_loop())
+    app.state.prefetch_task = asyncio.create_task(_prefetch.loop()) if PREFETCH_ENABLED else None
+    app.state.alerts_task = asyncio.create_task(_alerts.loop()) if ALERTS_ENABLED else None
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    app.state.caps_task.cancel()
+    app.state.layouts_task.cancel()
+    if app.state.prefetch_task is not None:
+        app.state.prefetch_task.cancel()
+    if app.state.alerts_task is not None:
+        app.state.alerts_task.cancel()
+    await _access.save_async()
+    _prefetch_lock.release()
+    _layouts_lock.release()
+    _caps_lock.release()
+    await _cli.stop()
+    if _http is not None:
+        await _http.aclose()
+    _store.close()
+    _subsets.close()
 
 @app.get("/health", response_class=PlainTextResponse)
 async def health():
-info = {"wmts": WMTS_BASE, "datasets": {"waves": DATASET_WAV, "physics": DATASET_PHY}, "cm_user": bool(CM_USER)}
-return json.dumps(info, ensure_ascii=False)
+    info = {"wmts": WMTS_BASE, "datasets": {"waves": DATASET_WAV, "physics": DATASET_PHY}, "cm_user": bool(CM_USER),
+            "subset_cache": _subsets.stats(), "cli": _cli.stats(),
+            "single_flight": _flights.stats(), "shared_flight": _xflights.stats(), "tile_cache": _tiles.stats(),
+            "xyz_cache": _xyz.stats(), "prefetch": _prefetch.stats(), "area_stats": _area.stats(),
+            "alerts": _alerts.stats(), "grids": _grids.stats()}
+    return json.dumps(info, ensure_ascii=False)
 
 @app.get("/wmts/capabilities")
-async def wmts_capabilities():
-params = {"service": "WMTS", "version": "1.0.0", "request": "GetCapabilities"}
-auth = (CM_USER, CM_PASS) if (CM_USER and CM_PASS) else None
-async with httpx.AsyncClient(timeout=60.0) as client:
-r = await client.get(WMTS_BASE, params=params, auth=auth)
-if r.status_code != 200:
-raise HTTPException(status_code=r.status_code, detail=f"WMTS GetCapabilities error: {r.text[:400]}")
-return Response(content=r.content, media_type="application/xml")
+async def wmts_capabilities(request: Request):
+    await _capabilities_index()
+    etag = _caps.xml_etag
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={WMTS_CAPS_REFRESH_MIN * 60}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=_caps.xml, media_type="application/xml", headers=headers)
+
+@app.get("/wmts/layers")
+async def wmts_layers(q: Optional[str] = None, text: Optional[str] = None,
+                      limit: int = Query(200, ge=1, le=5000)):
+    """Компактный список слоёв: q — подстрока идентификатора, text — заголовка/описания."""
+    index = await _capabilities_index()
+    found = search_layers(index, q, text)
+    return {"count": len(found), "fetched_at": _caps.fetched_at,
+            "layers": [index["summaries"][l["id"]] for l in found[:limit]]}
+
+@app.get("/wmts/layers/{layer_id:path}")
+async def wmts_layer(layer_id: str, time: Optional[str] = None):
+    index = await _capabilities_index()
+    layer = index["layers"].get(layer_id)
+    if layer is None:
+        raise HTTPException(status_code=404, detail=f"Слой '{layer_id}' не найден в GetCapabilities")
+    out = dict(layer, summary=index["summaries"][layer_id])
+    time_dim = layer["dimensions"].get("time")
+    if time and time_dim:
+        try:
+            t = dt.datetime.fromisoformat(time.replace("Z", "+00:00"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Некорректное время '{time}'")
+        out["nearest_time"] = nearest_time(time_dim["values"], t)
+    return out
+
+@app.get("/wmts/tilematrixsets/{tms_id:path}")
+async def wmts_tile_matrix_set(tms_id: str):
+    index = await _capabilities_index()
+    tms = index["tile_matrix_sets"].get(tms_id)
+    if tms is None:
+        raise HTTPException(status_code=404, detail=f"TileMatrixSet '{tms_id}' не найден")
+    return tms
 
 @app.get("/wmts/tile")
 async def wmts_tile(request: Request):
-query = str(request.url.query)
-url = WMTS_BASE + ("?" + query if query else "")
-auth = (CM_USER, CM_PASS) if (CM_USER and CM_PASS) else None
-async with httpx.AsyncClient(timeout=120.0) as client:
-r = await client.get(url, auth=auth)
-if r.status_code != 200:
-raise HTTPException(status_code=r.status_code, detail=f"WMTS tile error: {r.text[:400]}")
-media = r.headers.get("Content-Type", "image/png")
-return Response(content=r.content, media_type=media)
+    query = normalize_query(str(request.url.query))
+    _access.record("tile", {"query": query})
+    tile, tier = _tiles.get(query)
+    if tile is not None and tile.fresh():
+        return _tile_response(tile, request, "HIT-" + tier.upper())
+    try:
+        tile, state = await _fetch_tile_shared(query, tile)
+    except httpx.HTTPError as e:
+        if tile is None:
+            raise HTTPException(status_code=502, detail=f"WMTS tile error: {e}")
+        # upstream недоступен — лучше отдать устаревший тайл, чем ошибку
+        tile, state = tile, "STALE"
+    return _tile_response(tile, request, state)
+
+def _render_xyz(field: str, dataset_id: str, cov, t: str, z: int, x: int, y: int,
+                fmt: str, quantize: Optional[str], key: str) -> Tile:
+    kind, variables = XYZ_FIELDS[field]
+    variables = list(variables)
+    lon_w, lon_e, lat_s, lat_n = tile_bounds(z, x, y)
+    lons, lats = pixel_centres(z, x, y, XYZ_TILE_SIZE)
+    level = 1
+    if field == "currents":
+        level = pick_tile_level(z, XYZ_TILE_SIZE, 2 * cov.half_dlon, PYRAMID_LEVELS)
+    # тайл, лишь частично лежащий на сетке, читаем по пересечению с её охватом
+    pad = pixel_deg(z, XYZ_TILE_SIZE) + max(cov.half_dlon, cov.half_dlat) * level
+    xmin, xmax = max(lon_w - pad, cov.lon_min), min(lon_e + pad, cov.lon_max)
+    ymin, ymax = max(lat_s - pad, cov.lat_min), min(lat_n + pad, cov.lat_max)
+    ds = None
+    if xmin <= xmax and ymin <= ymax:
+        with span("open"):
+            ds = _store.open_snapshot(dataset_id, variables, xmin, xmax, ymin, ymax, t, level=level)
+    with span("render"):
+        fields = sample(ds, variables, cov.lat_name, cov.lon_name, lons, lats)
+    meta = {"field": field, "dataset_id": dataset_id, "time": t, "z": z, "x": x, "y": y,
+            "bbox": [lon_w, lat_s, lon_e, lat_n], "size": XYZ_TILE_SIZE, "level": level,
+            "units": {v: (ds[v].attrs.get("units") if ds is not None else None) for v in variables}}
+    with span("serialize"):
+        body, media = encode(fmt, {"lons": lons, "lats": lats, **fields}, meta,
+                             columns=grid_columns(lons, lats, fields), quant=quantize, float_fields=variables)
+    etag = '"' + hashlib.sha1(key.encode("utf-8")).hexdigest() + '"'
+    return Tile(body, media, etag, None, time.time() + XYZ_MAX_AGE_S)
+
+async def _locate_xyz(field: str, dataset_id: str, variables, time_utc: str):
+    """Файл и срок для тайлов поля; ответ обхода куба живёт XYZ_LOCATE_TTL_S секунд."""
+    now = time.monotonic()
+    hit = _xyz_located.get((field, time_utc))
+    if hit is not None and hit[0] > now:
+        return hit[1:]
+    located = await _flights.do(f"xyz-locate:{field}:{time_utc}", lambda: asyncio.to_thread(
+        _store.locate_snapshot, dataset_id, variables, time_utc))
+    if len(_xyz_located) > 1024:
+        for k in [k for k, v in _xyz_located.items() if v[0] <= now]:
+            del _xyz_located[k]
+    if located is not None:
+        _xyz_located[(field, time_utc)] = (now + XYZ_LOCATE_TTL_S,) + tuple(located)
+    return located
+
+@app.get("/tiles/{field}/{time_utc}/{z}/{x}/{y}")
+async def xyz_tile(field: str, time_utc: str, z: int, x: int, y: int, request: Request,
+                   format: Optional[str] = None, quantize: Optional[str] = None):
+    """Тайл поля (см. tiles.FIELDS) на срок time_utc в сетке XYZ Web Mercator."""
+    if field not in XYZ_FIELDS:
+        raise HTTPException(status_code=404, detail=f"Неизвестное поле '{field}' ({'|'.join(XYZ_FIELDS)})")
+    if not valid_tile(z, x, y, XYZ_MAX_ZOOM):
+        raise HTTPException(status_code=400, detail=f"Некорректный тайл {z}/{x}/{y} (z ≤ {XYZ_MAX_ZOOM})")
+    fmt = _output_format(request, format)
+    if fmt == "json":
+        if format:
+            raise HTTPException(status_code=406, detail="Тайлы отдаются только в бинарном формате (f32|npz|arrow)")
+        fmt = "f32"
+    kind, variables = XYZ_FIELDS[field]
+    dataset_id = _store.datasets[kind]
+    try:
+        located = await _locate_xyz(field, dataset_id, variables, time_utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Некорректное время '{time_utc}'")
+    if located is None:
+        raise HTTPException(status_code=404, detail="Нет локальных данных на этот срок")
+    cov, found = located
+    t = iso_times(np.array([found]))[0]
+    if t != time_utc:
+        # канонический URL — точный срок модели: только такие ответы неизменяемы
+        url = request.url.replace(path=f"/tiles/{field}/{t}/{z}/{x}/{y}")
+        return RedirectResponse(str(url), status_code=307, headers={"Cache-Control": "public, max-age=60"})
+    key = f"{field}/{t}/{z}/{x}/{y}?format={fmt}&quantize={quantize or ''}&src={cov.stamp[0]}:{cov.stamp[1]}"
+    tile, tier = _xyz.get(key)
+    if tile is not None:
+        return _tile_response(tile, request, "HIT-" + tier.upper(), immutable=True)
+
+    async def render() -> Tile:
+        try:
+            # чтение, сэмплирование и кодирование — в потоке: залп тайлов при сдвиге карты не душит loop
+            rendered = await asyncio.to_thread(_render_xyz, field, dataset_id, cov, t, z, x, y, fmt, quantize, key)
+        except UnsupportedFormat as e:
+            raise HTTPException(status_code=406, detail=str(e))
+        _xyz.put(key, rendered)
+        return rendered
+
+    tile = await _flights.do("xyz:" + key, lambda: _xflights.do("xyz:" + key, render,
+                                                                 recheck=lambda: _xyz.get(key)[0]))
+    return _tile_response(tile, request, "MISS", immutable=True)
+
+def _snap(ds_id: str, variable: str, lat, lon) -> Tuple[Optional[GridMeta], np.ndarray, np.ndarray, np.ndarray]:
+    """Точки -> сетка, координаты ближайших морских узлов и расстояние до них (км).
+
+    Без сетки (или если точки вне её) — сетка None и точки как есть. Может
+    читать диск и строить маску, поэтому обработчики зовут её через asyncio.to_thread
+    (индекс LocalStore потокобезопасен).
+    """
+    lat = np.atleast_1d(np.asarray(lat, dtype=float))
+    lon = np.atleast_1d(np.asarray(lon, dtype=float))
+    grid = _grids.get(ds_id, variable, inputs_of([variable]))
+    if grid is None or not grid.covers(lat, lon):
+        return None, lat, lon, np.full(lat.shape, np.nan)
+    with span("select"):
+        iy, ix, km = grid.snap(variable, lat, lon, SNAP_MAX_KM)
+    return grid, grid.lats[iy], grid.lons[ix], km
+
+def _point_nodes(ds: xr.Dataset, grid: Optional[GridMeta], variable: str, lat: np.ndarray, lon: np.ndarray,
+                 km: np.ndarray) -> Tuple[Tuple[str, str, str], np.ndarray, np.ndarray, np.ndarray]:
+    """Имена координат и индексы узлов точек (уже привязанных _snap) в ds.
+
+    Без сетки (нет локальных файлов) точки привязываются к морю по маске самого ds.
+    """
+    with span("detect_coords"):
+        names = grid.names if grid is not None and grid.fits(ds) else _detect_coords(ds)
+    with span("select"):
+        local = GridMeta(names, ds[names[1]].values, ds[names[2]].values)
+        if grid is None:
+            local.masks[variable] = wet_mask(ds, [variable], names[1], names[2])
+        iy, ix, local_km = local.snap(variable, lat, lon, SNAP_MAX_KM)
+    return names, iy, ix, (local_km if grid is None else km)
 
 @app.post("/api/timeseries", response_model=TimeSeriesResponse)
-async def timeseries(req: TimeSeriesRequest):
-dataset = req.dataset.lower().strip()
-if dataset not in ("waves", "physics"):
-raise HTTPException(status_code=400, detail="dataset должен быть 'waves' или 'physics'")
-ds_id = DATASET_WAV if dataset == "waves" else DATASET_PHY
-variables = [req.variable]
-eps = 0.05
-xmin, xmax = req.lon - eps, req.lon + eps
-ymin, ymax = req.lat - eps, req.lat + eps
-t_end = req.end_utc or dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-t_start = req.start_utc or (dt.datetime.utcnow() - dt.timedelta(hours=48)).replace(microsecond=0).isoformat() + "Z"
-nc_path = _subset_with_cli(ds_id, variables, xmin, xmax, ymin, ymax, t_start, t_end)
-try:
-ds = xr.open_dataset(nc_path)
-tname, laname, loname = _detect_coords(ds)
-da = ds[req.variable].sel({laname: req.lat, loname: req.lon}, method="nearest")
-ts = _to_timeseries_json(da)
-ts.meta = {"dataset_id": ds_id, "variable": req.variable, "lat": float(req.lat),
-"lon": float(req.lon), "t_start": t_start, "t_end": t_end}
-return ts
-except KeyError:
-raise HTTPException(status_code=400, detail=f"Переменная '{req.variable}' не найдена в '{ds_id}'")
-except Exception as e:
-raise HTTPException(status_code=500, detail=f"Ошибка чтения NetCDF: {e}")
-finally:
-try: os.remove(nc_path)
-except OSError: pass
+async def timeseries(req: TimeSeriesRequest, request: Request, format: Optional[str] = None,
+                     quantize: Optional[str] = None, nan_mask: bool = False):
+    fmt = _output_format(request, format)
+    ds_id = _resolve_dataset(req.dataset)
+    variables = [req.variable]
+    grid, lat, lon, km = await asyncio.to_thread(_snap, ds_id, req.variable, req.lat, req.lon)
+    eps = 0.05
+    xmin, xmax = lon[0] - eps, lon[0] + eps
+    ymin, ymax = lat[0] - eps, lat[0] + eps
+    t_start, t_end = _default_window(req.start_utc, req.end_utc)
+    _record_window(ds_id, variables, xmin, xmax, ymin, ymax, t_start, t_end, req.depth)
+    async with _open_subset(ds_id, variables, xmin, xmax, ymin, ymax, t_start, t_end,
+                            request=request, depth=req.depth) as (ds, source):
+        try:
+            (tname, laname, loname), iy, ix, km = _point_nodes(ds, grid, req.variable, lat, lon, km)
+            with span("select"):
+                da = ds[req.variable].isel({laname: int(iy[0]), loname: int(ix[0])})
+            meta = {"dataset_id": ds_id, "variable": req.variable, "lat": float(req.lat),
+                    "lon": float(req.lon), "t_start": t_start, "t_end": t_end, "source": source,
+                    "depth": _depth_meta(ds), "grid_lat": float(da[laname].values),
+                    "grid_lon": float(da[loname].values), "snap_km": round(float(km[0]), 3)}
+            with span("serialize"):
+                if fmt != "json":
+                    meta["unit"] = da.attrs.get("units")
+                    times_ms = da[da.dims[0]].values.astype("datetime64[ms]").astype(np.int64)
+                    return _binary_response(fmt, {"time_ms": times_ms, "values": da.values}, meta,
+                                            quantize=quantize, nan_mask=nan_mask, float_fields=["values"])
+                ts = _to_timeseries_json(da, req.time_format)
+            ts.meta = meta
+            return ts
+        except KeyError:
+            raise HTTPException(status_code=400, detail=f"Переменная '{req.variable}' не найдена в '{ds_id}'")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка чтения NetCDF: {e}")
+
+def _point_series(ds: xr.Dataset, variable: str, lat: float, lon: float,
+                  grid: Optional[GridMeta] = None) -> xr.DataArray:
+    (tname, laname, loname), iy, ix, _ = _point_nodes(ds, grid, variable, np.array([lat]), np.array([lon]),
+                                                       np.array([np.nan]))
+    with span("select"):
+        da = ds[variable].isel({laname: int(iy[0]), loname: int(ix[0])})
+        return surface_only(da, (tname,))
+
+def _cli_time(t: np.datetime64) -> str:
+    return str(np.datetime64(t, "s")) + "Z"
+
+async def _stream_series(ds_id: str, variable: str, lat: float, lon: float,
+                         t_start: str, t_end: str, request: Request,
+                         depth: Optional[float] = None,
+                         grid: Optional[GridMeta] = None) -> AsyncIterator[xr.DataArray]:
+    """Ряд в точке кусками по STREAM_CHUNK_H часов: в памяти только текущий кусок.
+
+    Пока окно в локальном кубе — читаем его по кускам; остаток берём одним
+    subset через CLI (кэшируется) и читаем из файла лениво, тоже по кускам.
+    lat/lon — уже привязанные к морскому узлу (_snap), если есть сетка grid.
+    """
+    eps = 0.05
+    xmin, xmax, ymin, ymax = lon - eps, lon + eps, lat - eps, lat + eps
+    t0, t1 = parse_utc(t_start), parse_utc(t_end)
+    chunk = np.timedelta64(STREAM_CHUNK_H * 3600, "s")
+    last = None
+    cur = t0
+
+    def fresh(da: xr.DataArray) -> xr.DataArray:
+        # куски стыкуются включительно — повтор граничного срока отбрасываем
+        times = da[da.dims[0]].values
+        return da if last is None else da.isel({da.dims[0]: np.nonzero(times > last)[0]})
+
+    while cur <= t1:
+        end = min(cur + chunk, t1)
+        ds = await _open_local(ds_id, [variable], xmin, xmax, ymin, ymax, _cli_time(cur), _cli_time(end),
+                               depth=depth)
+        if ds is None:
+            break
+        da = fresh(_point_series(ds, variable, lat, lon, grid))
+        if da.size:
+            last = da[da.dims[0]].values[-1]
+            yield da
+        cur = end
+        if end == t1:
+            return
+    raw = inputs_of([variable])
+    nc_path = await _subset_with_cli(ds_id, raw, xmin, xmax, ymin, ymax, _cli_time(cur), t_end, request,
+                                     depth=depth)
+    full = await asyncio.to_thread(xr.open_dataset, nc_path)
+    try:
+        tname = _detect_coords(full)[0]
+        column = select_depth(full[raw], depth)
+        while cur <= t1:
+            end = min(cur + chunk, t1)
+            part = column.sel({tname: slice(cur, end)})
+            with span("open"):
+                part = await asyncio.to_thread(part.load)
+            if variable in DERIVED:
+                part = add_derived(part, [variable])
+            da = fresh(_point_series(part, variable, lat, lon, grid))
+            if da.size:
+                last = da[da.dims[0]].values[-1]
+                yield da
+            if end == t1:
+                break
+            cur = end
+    finally:
+        full.close()
+
+@app.post("/api/timeseries/stream")
+async def timeseries_stream(req: TimeSeriesRequest, request: Request, format: Optional[str] = "ndjson"):
+    """Длинный ряд потоком: NDJSON (строка meta, затем по строке на срок) или кадры f32.
+
+    f32 — последовательность кадров HMF1 (см. encoding.py), по кадру на кусок
+    времени, с массивами time_ms и values.
+    """
+    fmt = (format or "ndjson").lower()
+    if fmt not in ("ndjson", "f32"):
+        raise HTTPException(status_code=406, detail="Потоковый формат: ndjson или f32")
+    ds_id = _resolve_dataset(req.dataset)
+    t_start, t_end = _default_window(req.start_utc, req.end_utc)
+    try:
+        parse_utc(t_start), parse_utc(t_end)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректные start_utc / end_utc")
+    meta = {"dataset_id": ds_id, "variable": req.variable, "lat": float(req.lat), "lon": float(req.lon),
+            "t_start": t_start, "t_end": t_end}
+    grid, lat, lon, km = await asyncio.to_thread(_snap, ds_id, req.variable, req.lat, req.lon)
+    if grid is not None:
+        meta.update(grid_lat=float(lat[0]), grid_lon=float(lon[0]), snap_km=round(float(km[0]), 3))
+    series = _stream_series(ds_id, req.variable, float(lat[0]), float(lon[0]), t_start, t_end, request,
+                            req.depth, grid)
+    # первый кусок читаем до ответа, чтобы ошибки (нет переменной, CLI) стали HTTP-кодом
+    try:
+        first = await series.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Переменная {e} не найдена в '{ds_id}'")
+    if first is not None:
+        meta["unit"] = first.attrs.get("units")
+        meta["depth"] = _depth_meta(first)
+
+    async def body():
+        try:
+            if fmt == "ndjson":
+                yield (json.dumps({"meta": meta}, ensure_ascii=False) + "\n").encode("utf-8")
+            da = first
+            while da is not None:
+                times = da[da.dims[0]].values
+                if fmt == "ndjson":
+                    yield ndjson_lines(times, da.values)
+                else:
+                    yield encode_f32({"time_ms": times.astype("datetime64[ms]").astype(np.int64),
+                                      "values": da.values}, meta, float_fields=["values"])
+                try:
+                    da = await series.__anext__()
+                except StopAsyncIteration:
+                    da = None
+        finally:
+            await series.aclose()
+
+    media = "application/x-ndjson" if fmt == "ndjson" else "application/x-hydrometeo-f32"
+    return StreamingResponse(body(), media_type=media)
+
+@app.post("/api/timeseries/batch", response_model=BatchTimeSeriesResponse)
+async def timeseries_batch(req: BatchTimeSeriesRequest, request: Request):
+    """Ряды для многих точек и переменных одним чтением куба / одним subset."""
+    ds_id = _resolve_dataset(req.dataset)
+    if not req.points:
+        raise HTTPException(status_code=400, detail="Список points пуст")
+    if len(req.points) > BATCH_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"Не более {BATCH_MAX_POINTS} точек за запрос")
+    variables = list(dict.fromkeys(req.variables))
+    if not variables:
+        raise HTTPException(status_code=400, detail="Список variables пуст")
+    # все точки -> морские узлы сетки одним векторным поиском (по маске первой переменной)
+    grid, plat, plon, km = await asyncio.to_thread(_snap, ds_id, variables[0],
+                                                   [p.lat for p in req.points], [p.lon for p in req.points])
+    eps = 0.05
+    t_start, t_end = _default_window(req.start_utc, req.end_utc)
+    async with _open_subset(ds_id, variables, plon.min() - eps, plon.max() + eps, plat.min() - eps, plat.max() + eps,
+                            t_start, t_end, request=request) as (ds, source):
+        try:
+            (tname, laname, loname), iy, ix, km = _point_nodes(ds, grid, variables[0], plat, plon, km)
+            with span("select"):
+                blocks, units = {}, {}
+                for var in variables:
+                    da = surface_only(ds[var], (tname, laname, loname)).transpose(tname, laname, loname)
+                    blocks[var] = np.asarray(da.values, dtype=float)[:, iy, ix]  # (time, point)
+                    units[var] = da.attrs.get("units")
+            with span("serialize"):
+                values = {var: _nan_to_none(block.T) for var, block in blocks.items()}
+            points = [{"id": p.id, "lat": p.lat, "lon": p.lon,
+                       "grid_lat": float(ds[laname].values[j]), "grid_lon": float(ds[loname].values[i]),
+                       "snap_km": round(float(d), 3)}
+                      for p, j, i, d in zip(req.points, iy, ix, km)]
+            return BatchTimeSeriesResponse(
+                points=points, values=values, units=units,
+                meta={"dataset_id": ds_id, "t_start": t_start, "t_end": t_end, "source": source},
+                **_time_fields(ds[tname].values, req.time_format))
+        except KeyError as e:
+            raise HTTPException(status_code=400, detail=f"Переменная {e} не найдена в '{ds_id}'")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка чтения NetCDF: {e}")
+
+async def _sample_track(ds_id: str, variables: List[str], lat: np.ndarray, lon: np.ndarray, t: np.ndarray,
+                        request: Request) -> Tuple[Dict[str, np.ndarray], Dict[str, Optional[str]], str]:
+    """Одно чтение куба по bbox и интервалу маршрута, затем интерполяция во всех точках сразу."""
+    dlat, dlon = _store.grid_step(ds_id, inputs_of(variables)) or (0.05, 0.05)
+    step = np.timedelta64(1, "h")
+    t_start, t_end = _cli_time(t.min() - step), _cli_time(t.max() + step)
+    async with _open_subset(ds_id, variables, lon.min() - dlon, lon.max() + dlon, lat.min() - dlat, lat.max() + dlat,
+                            t_start, t_end, request=request) as (ds, source):
+        with span("detect_coords"):
+            tname, laname, loname = _detect_coords(ds)
+        values, units = {}, {}
+        with span("select"):
+            for var in variables:
+                da = surface_only(ds[var], (tname, laname, loname)).transpose(tname, laname, loname)
+                units[var] = da.attrs.get("units")
+                values[var] = interp_points(da.values, ds[tname].values, ds[laname].values, ds[loname].values,
+                                            t, lat, lon, circular=is_circular(units[var]))
+    return values, units, source
+
+@app.post("/api/track", response_model=TrackResponse)
+async def track(req: TrackRequest, request: Request, format: Optional[str] = None,
+                quantize: Optional[str] = None):
+    """Значения полей вдоль маршрута: билинейно по пространству, линейно по времени.
+
+    variables — {"waves"|"physics"|"ice": [переменные]}; каждый набор данных
+    читается один раз на весь маршрут (bbox и интервал точек).
+    """
+    fmt = _output_format(request, format)
+    if not req.points:
+        raise HTTPException(status_code=400, detail="Список points пуст")
+    if len(req.points) > TRACK_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"Не более {TRACK_MAX_POINTS} точек за запрос")
+    by_dataset: Dict[str, List[str]] = {}
+    for name, names in req.variables.items():
+        by_dataset.setdefault(_resolve_dataset(name), []).extend(names)
+    by_dataset = {d: list(dict.fromkeys(v)) for d, v in by_dataset.items() if v}
+    all_vars = [v for names in by_dataset.values() for v in names]
+    if not all_vars:
+        raise HTTPException(status_code=400, detail="Список variables пуст")
+    if len(set(all_vars)) != len(all_vars):
+        raise HTTPException(status_code=400, detail="Одна переменная запрошена из разных наборов данных")
+    lat = np.array([p.lat for p in req.points], dtype=float)
+    lon = np.array([p.lon for p in req.points], dtype=float)
+    try:
+        t = np.array([parse_utc(p.time_utc) for p in req.points], dtype="datetime64[ns]")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Некорректное time_utc в points")
+    try:
+        results = await asyncio.gather(*(_sample_track(d, names, lat, lon, t, request)
+                                         for d, names in by_dataset.items()))
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Переменная {e} не найдена")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка интерполяции вдоль маршрута: {e}")
+    values, units, sources = {}, {}, {}
+    for ds_id, (v, u, source) in zip(by_dataset, results):
+        values.update(v)
+        units.update(u)
+        sources[ds_id] = source
+    meta = {"datasets": sources, "points": len(req.points),
+            "t_start": _cli_time(t.min()), "t_end": _cli_time(t.max())}
+    with span("serialize"):
+        if fmt != "json":
+            arrays = {"lat": lat, "lon": lon, "time_ms": t.astype("datetime64[ms]").astype(np.int64), **values}
+            return _binary_response(fmt, arrays, {**meta, "units": units}, quantize=quantize,
+                                    float_fields=list(values))
+        return TrackResponse(times_utc=iso_times(t), values={k: _nan_to_none(v) for k, v in values.items()},
+                             units=units, meta=meta)
+
+def _step_reader(ds: xr.Dataset, variable: str, derived: bool):
+    """Чтение одного среза (values[lat, lon], lats, lons) по требованию — из потока свёртки."""
+    def read():
+        part = add_derived(ds.load(), [variable]) if derived else ds[[variable]].load()
+        _, laname, loname = _detect_coords(part)
+        da = surface_only(part[variable], (laname, loname)).transpose(laname, loname)
+        return da.values, part[laname].values, part[loname].values
+    return read
+
+def _local_area_steps(ds_id: str, variable: str, xmin: float, xmax: float, ymin: float, ymax: float,
+                      t_start: str, t_end: str) -> Optional[Tuple[List[Step], dict]]:
+    """Сроки окна из локального куба (ключ частичных свёрток — файл и его версия) или None."""
+    derived = variable in DERIVED and variable not in _store.variables(ds_id)
+    names = inputs_of([variable]) if derived else [variable]
+    try:
+        found = _store.window_steps(ds_id, names, xmin, xmax, ymin, ymax, t_start, t_end)
+    except (OSError, ValueError, KeyError):
+        return None
+    if not found:
+        return None
+    attrs = {} if derived else dict(found[0][2][variable].attrs)
+    steps = [Step((cov.path, cov.stamp), t, _step_reader(part, variable, derived)) for cov, t, part in found]
+    return steps, attrs
+
+def _local_area_run(ds_id: str, variable: str, xmin: float, xmax: float, ymin: float, ymax: float,
+                    t_start: str, t_end: str, region: Region, percentiles: List[float],
+                    thresholds: List[Tuple[str, float]], series: bool) -> Optional[Tuple[List[Step], dict, dict]]:
+    """Сроки из локального куба и их свёртка (в потоке): хэндлы хранилища арендованы до конца чтения."""
+    with _store.lease():
+        with span("open"):
+            local = _local_area_steps(ds_id, variable, xmin, xmax, ymin, ymax, t_start, t_end)
+        if local is None:
+            return None
+        steps, attrs = local
+        with span("select"):
+            return steps, attrs, _area.run(steps, variable, attrs, region, percentiles, thresholds, series)
+
+@app.post("/api/area-stats", response_model=AreaStatsResponse)
+async def area_stats(req: AreaStatsRequest, request: Request):
+    """Статистика поля по области и окну времени: min/max/mean/std, процентили, превышения.
+
+    Окно сворачивается по одному сроку; частичные свёртки сроков из локального
+    куба кэшируются (aggregate.py), так что пересекающиеся запросы читают только
+    новые сроки. Вне локального покрытия — одна загрузка через CLI, без кэша.
+    """
+    ds_id = _resolve_dataset(req.dataset)
+    if req.op not in AGG_OPS:
+        raise HTTPException(status_code=400, detail=f"op должен быть одним из: {', '.join(AGG_OPS)}")
+    if any(not 0 <= q <= 100 for q in req.percentiles):
+        raise HTTPException(status_code=400, detail="percentiles должны быть в диапазоне 0..100")
+    try:
+        region = Region(bbox=req.bbox, polygon=req.polygon,
+                        points=None if req.points is None else [[p.lat, p.lon] for p in req.points])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    t_start, t_end = _default_window(req.start_utc, req.end_utc)
+    dlat, dlon = _store.grid_step(ds_id, inputs_of([req.variable])) or (0.05, 0.05)
+    x0, x1, y0, y1 = region.bounds
+    xmin, xmax, ymin, ymax = x0 - dlon, x1 + dlon, y0 - dlat, y1 + dlat
+    thresholds = [(req.op, float(v)) for v in req.thresholds]
+    try:
+        local = await asyncio.to_thread(_local_area_run, ds_id, req.variable, xmin, xmax, ymin, ymax, t_start, t_end,
+                                        region, req.percentiles, thresholds, req.series)
+        CACHE_EVENTS.inc(cache="local_store", result="miss" if local is None else "hit")
+        if local is not None:
+            steps, attrs, out = local
+            source = "local"
+        else:
+            async with _open_subset(ds_id, [req.variable], xmin, xmax, ymin, ymax, t_start, t_end,
+                                    request=request) as (ds, source):
+                tname, _, _ = _detect_coords(ds)
+                attrs = dict(ds[req.variable].attrs)
+                steps = [Step(None, t, _step_reader(ds.isel({tname: i}), req.variable, False))
+                         for i, t in enumerate(ds[tname].values)]
+                with span("select"):
+                    out = await asyncio.to_thread(_area.run, steps, req.variable, attrs, region,
+                                                  req.percentiles, thresholds, req.series)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Переменная {e} не найдена в '{ds_id}'")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Ошибка расчёта статистики: {e}")
+    if not steps:
+        raise HTTPException(status_code=404, detail="В окне нет ни одного срока")
+    exceedance = out.pop("exceedance")
+    series = out.pop("series", None)
+    meta = {"dataset_id": ds_id, "t_start": t_start, "t_end": t_end, "source": source, "region": region.kind,
+            "cache": _area.stats()}
+    return AreaStatsResponse(stats=out, exceedance=exceedance, series=series, unit=attrs.get("units"),
+                             times_utc=iso_times(np.array([s.time for s in steps])) if req.series else None,
+                             meta=meta)
+
+# === Alerts ===
+
+def _alert_steps(ds_id: str, variable: str, xmin: float, xmax: float, ymin: float, ymax: float,
+                 t_start: str, t_end: str) -> Optional[List[Step]]:
+    """Сроки горизонта правил из локального куба; горизонт обрезается последним сроком прогноза."""
+    latest = _store.latest(ds_id)
+    if latest is None or latest < parse_utc(t_start):
+        return None
+    t_end = min(t_end, _cli_time(latest))
+    dlat, dlon = _store.grid_step(ds_id, inputs_of([variable])) or (0.05, 0.05)
+    found = _local_area_steps(ds_id, variable, xmin - dlon, xmax + dlon, ymin - dlat, ymax + dlat, t_start, t_end)
+    return None if found is None else found[0]
+
+_alerts = AlertEngine(_watchlist, _alert_hub, _alert_steps, horizon_h=ALERTS_HORIZON_H, interval_s=ALERTS_CHECK_S,
+                      snap=lambda ds_id, variable, lat, lon: _snap(ds_id, variable, lat, lon)[1:3],
+                      reading=_store.lease)
+
+def _sse(event: dict) -> str:
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def _rule_filter(rules: Optional[str]) -> Optional[set]:
+    return set(r for r in rules.split(",") if r) if rules else None
+
+def _alert_event_for(event: dict, wanted: Optional[set]) -> bool:
+    return wanted is None or event.get("alert", {}).get("rule_id") in wanted
+
+@app.get("/api/alerts/rules")
+async def alert_rules():
+    _watchlist.reload()
+    return {"rules": list(_watchlist.rules.values())}
+
+@app.post("/api/alerts/rules")
+async def add_alert_rule(req: AlertRuleRequest):
+    """Новое правило; проверяется сразу, дальше — с каждой проверкой куба (ALERTS_CHECK_S)."""
+    ds_id = _resolve_dataset(req.dataset)
+    if req.op not in AGG_OPS:
+        raise HTTPException(status_code=400, detail=f"op должен быть одним из: {', '.join(AGG_OPS)}")
+    rule = req.dict()
+    if (req.lat is None) != (req.lon is None):
+        raise HTTPException(status_code=400, detail="Для точки нужны и lat, и lon")
+    try:
+        rule_region(rule)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    rule = _watchlist.add(dict(rule, dataset_id=ds_id))
+    if ALERTS_ENABLED:
+        await _alerts.check()
+    return {"rule": rule, "alert": _alerts.state.get(rule["id"])}
+
+@app.delete("/api/alerts/rules/{rule_id}")
+async def delete_alert_rule(rule_id: str):
+    if not _watchlist.remove(rule_id):
+        raise HTTPException(status_code=404, detail="Правило не найдено")
+    if ALERTS_ENABLED:
+        await _alerts.check()
+    return {"deleted": rule_id}
+
+@app.get("/api/alerts")
+async def alerts_snapshot(rules: Optional[str] = None):
+    """Текущее состояние всех (или перечисленных через запятую) правил — для первой загрузки."""
+    return {"id": _alert_hub.last_id(), "alerts": _alerts.snapshot(_rule_filter(rules)), "last_check": _alerts.last_check}
+
+@app.get("/api/alerts/stream")
+async def alerts_stream(request: Request, rules: Optional[str] = None,
+                        last_event_id: Optional[str] = Header(None)):
+    """Server-Sent Events: снимок состояния, затем raised / cleared / updated / removed.
+
+    Переподключившийся клиент (заголовок Last-Event-ID) получает пропущенные
+    события из буфера, а если их там уже нет — новый снимок.
+    """
+    wanted = _rule_filter(rules)
+    queue = _alert_hub.subscribe()
+
+    async def events():
+        try:
+            missed = await _alert_hub.since(int(last_event_id)) if (last_event_id or "").isdigit() else None
+            if missed is None:
+                yield _sse({"type": "snapshot", "id": _alert_hub.last_id(), "alerts": _alerts.snapshot(wanted)})
+            else:
+                for e in missed:
+                    if _alert_event_for(e, wanted):
+                        yield _sse(e)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), ALERTS_KEEPALIVE_S)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if _alert_event_for(event, wanted):
+                    yield _sse(event)
+        finally:
+            _alert_hub.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/ws/alerts")
+async def alerts_ws(ws: WebSocket, rules: Optional[str] = None):
+    """То же, что /api/alerts/stream, сообщениями JSON; ping — раз в ALERTS_KEEPALIVE_S."""
+    wanted = _rule_filter(rules)
+    await ws.accept()
+    queue = _alert_hub.subscribe()
+    try:
+        await ws.send_json({"type": "snapshot", "id": _alert_hub.last_id(), "alerts": _alerts.snapshot(wanted)})
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), ALERTS_KEEPALIVE_S)
+            except asyncio.TimeoutError:
+                await ws.send_json({"type": "ping"})
+                continue
+            if _alert_event_for(event, wanted):
+                await ws.send_json(event)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        _alert_hub.unsubscribe(queue)
+
+@app.post("/api/ice-timeseries", response_model=IceSeriesResponse)
+async def ice_timeseries(req: IceSeriesRequest, request: Request):
+    """SIC (%), SIT и дрейф льда в точке: один поиск узла сетки и одно чтение всех переменных.
+
+    Переменной, которой нет в данных, соответствует ряд из null (дрейфу — null);
+    400 — только если нет ни SIC, ни SIT.
+    """
+    ds_id = req.dataset_id or DATASET_ICE
+    eps = 0.05
+    t_start, t_end = _default_window(req.start_utc, req.end_utc)
+    # siconc_pct и дрейф — готовые поля ingest, иначе считаются из siconc и компонент скорости льда;
+    # из локального куба читаем то, что в нём есть, у CLI просим всё (как прежний эндпоинт)
+    wanted = ["siconc_pct", ICE_SIT_NAMES[0], "ice_drift_speed", "ice_drift_dir"]
+    local_vars = _store.variables(ds_id)
+    sit = next((n for n in ICE_SIT_NAMES if n in local_vars), ICE_SIT_NAMES[0])
+    names = [n for n in ["siconc_pct", sit, "ice_drift_speed", "ice_drift_dir"] if _available(n, local_vars)] or wanted
+    grid, lat, lon, km = await asyncio.to_thread(_snap, ds_id, names[0], req.lat, req.lon)
+    async with _open_subset(ds_id, names, lon[0] - eps, lon[0] + eps, lat[0] - eps, lat[0] + eps,
+                            t_start, t_end, request=request, cli_variables=wanted) as (ds, source):
+        try:
+            found = {"siconc": "siconc_pct" if "siconc_pct" in ds.data_vars else None,
+                     "sithick": pick_var(ds, ICE_SIT_NAMES)}
+            if not (found["siconc"] or found["sithick"]):
+                raise HTTPException(status_code=400, detail=f"Переменные льда (SIC/SIT) не найдены в '{ds_id}'")
+            drift = {"ice_drift_speed", "ice_drift_dir"} <= set(ds.data_vars)
+            if drift:
+                found.update(drift_speed="ice_drift_speed", drift_dir_deg="ice_drift_dir")
+            present = {k: n for k, n in found.items() if n}
+            (tname, laname, loname), iy, ix, km = _point_nodes(ds, grid, next(iter(present.values())), lat, lon, km)
+            iy, ix = int(iy[0]), int(ix[0])
+            with span("select"):
+                arrays = {k: surface_only(ds[n], (tname, laname, loname)).transpose(tname, laname, loname)
+                          for k, n in present.items()}
+                series = {k: _nan_to_none(np.asarray(a.values, dtype=float)[:, iy, ix]) for k, a in arrays.items()}
+            times = ds[tname].values
+            empty = [None] * len(times)
+            units = {k: a.attrs.get("units") for k, a in arrays.items()}
+            if "sithick" in units:
+                units["sithick"] = units["sithick"] or "m"
+            out = IceSeriesResponse(times_utc=iso_times(times), siconc=series.get("siconc", empty),
+                                    sithick=series.get("sithick", empty), units=units)
+            if drift:
+                out.drift_speed, out.drift_dir_deg = series["drift_speed"], series["drift_dir_deg"]
+                out.units.update(drift_speed="m s-1", drift_dir_deg="degree")
+            out.meta = {"dataset_id": ds_id, "lat": float(req.lat), "lon": float(req.lon),
+                        "grid_lat": float(ds[laname].values[iy]), "grid_lon": float(ds[loname].values[ix]),
+                        "snap_km": round(float(km[0]), 3), "t_start": t_start, "t_end": t_end, "source": source}
+            # имена исходных переменных, как в прежней версии эндпоинта
+            sources = {k: a.attrs.get("derived_from", present[k]).split() for k, a in arrays.items()}
+            out.meta.update(sic_var=sources["siconc"][0] if "siconc" in sources else None,
+                            sit_var=sources["sithick"][0] if "sithick" in sources else None,
+                            siu_var=sources["drift_speed"][0] if drift else None,
+                            siv_var=sources["drift_speed"][-1] if drift else None)
+            return out
+        except KeyError as e:
+            raise HTTPException(status_code=400, detail=f"Переменные льда {e} не найдены в '{ds_id}'")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка чтения данных по льду: {e}")
 
 @app.post("/api/currents-grid", response_model=CurrentsGridResponse)
-async def currents_grid(req: CurrentsGridRequest):
-ds_id = DATASET_PHY
-variables = ["uo", "vo"]
-t = req.time_utc or dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-t_dt = dt.datetime.fromisoformat(t.replace("Z", "+00:00"))
-t_start = (t_dt - dt.timedelta(minutes=1)).isoformat().replace("+00:00", "Z")
-t_end = (t_dt + dt.timedelta(minutes=1)).isoformat().replace("+00:00", "Z")
-nc_path = _subset_with_cli(ds_id, variables, req.min_lon, req.max_lon, req.min_lat, req.max_lat, t_start, t_end)
-try:
-ds = xr.open_dataset(nc_path)
-, lat_name, lon_name = detect_coords(ds)
-u = ds["uo"].isel({"time": 0})
-v = ds["vo"].isel({"time": 0})
-lats = u[lat_name].values
-lons = u[lon_name].values
-step = max(1, int(req.step))
-lat_idx = np.arange(0, len(lats), step)
-lon_idx = np.arange(0, len(lons), step)
-U = u.values[np.ix(lat_idx, lon_idx)]
-V = v.values[np.ix(lat_idx, lon_idx)]
-return CurrentsGridResponse(
-lons=[float(x) for x in lons[lon_idx]],
-lats=[float(y) for y in lats[lat_idx]],
-u=[float(val) for val in U.flatten()],
-v=[float(val) for val in V.flatten()],
-meta={"dataset_id": ds_id, "time": t}
-)
-except Exception as e:
-raise HTTPException(status_code=500, detail=f"Ошибка выборки течений: {e}")
-finally:
-try: os.remove(nc_path)
-except OSError: pass
+async def currents_grid(req: CurrentsGridRequest, request: Request, format: Optional[str] = None,
+                        quantize: Optional[str] = None, nan_mask: bool = False):
+    fmt = _output_format(request, format)
+    ds_id = DATASET_PHY
+    variables = ["uo", "vo"]
+    t, t_start, t_end = _snapshot_window(req.time_utc)
+    _record_grid(req.min_lon, req.max_lon, req.min_lat, req.max_lat, t, req.depth)
+    step = max(1, int(req.step))
+    # уровень пирамиды по размеру окна в узлах исходной сетки; если шаг сетки
+    # неизвестен (нет локальных файлов), уровень выбирается после чтения
+    native = _store.grid_step(ds_id, variables)
+    level = None
+    if native is not None:
+        n_lat = int(abs(req.max_lat - req.min_lat) / native[0]) + 1
+        n_lon = int(abs(req.max_lon - req.min_lon) / native[1]) + 1
+        level = pick_level(n_lat, n_lon, step=step, max_arrows=req.max_arrows)
+    async with _open_subset(ds_id, variables, req.min_lon, req.max_lon, req.min_lat, req.max_lat,
+                            t_start, t_end, snapshot=t, request=request, level=level or 1,
+                            depth=req.depth) as (ds, source):
+        try:
+            with span("detect_coords"):
+                tname, lat_name, lon_name = _detect_coords(ds)
+            if level is None:
+                level = pick_level(ds.sizes[lat_name], ds.sizes[lon_name], step=step, max_arrows=req.max_arrows)
+                ds = block_mean(ds, level)
+            u = ds["uo"].isel({tname: 0})
+            v = ds["vo"].isel({tname: 0})
+            lats = u[lat_name].values
+            lons = u[lon_name].values
+            # прореживание поверх уровня — только если нужно грубее самого грубого уровня
+            if req.max_arrows:
+                stride = max(1, int(np.ceil(max(len(lats), len(lons)) / float(req.max_arrows))))
+            else:
+                stride = max(1, int(round(step / float(level))))
+            lat_idx = np.arange(0, len(lats), stride)
+            lon_idx = np.arange(0, len(lons), stride)
+            with span("select"):
+                U = u.values[np.ix_(lat_idx, lon_idx)]
+                V = v.values[np.ix_(lat_idx, lon_idx)]
+            meta = {"dataset_id": ds_id, "time": t, "source": source, "level": level, "stride": stride,
+                    "depth": _depth_meta(ds)}
+            with span("serialize"):
+                if fmt != "json":
+                    arrays = {"lons": lons[lon_idx], "lats": lats[lat_idx], "u": U, "v": V}
+                    return _binary_response(fmt, arrays, meta,
+                                            columns=grid_columns(lons[lon_idx], lats[lat_idx], {"u": U, "v": V}),
+                                            quantize=quantize, nan_mask=nan_mask, float_fields=["u", "v"])
+                return CurrentsGridResponse(
+                    lons=lons[lon_idx].astype(float).tolist(),
+                    lats=lats[lat_idx].astype(float).tolist(),
+                    u=_nan_to_none(U.astype(float).ravel()),
+                    v=_nan_to_none(V.astype(float).ravel()),
+                    meta=meta
+                )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка выборки течений: {e}")
+
+@app.post("/api/profile", response_model=ProfileResponse)
+async def profile(req: ProfileRequest, request: Request, format: Optional[str] = None):
+    """Вертикальный профиль (по умолчанию thetao, uo, vo) в ближайшем узле на ближайший срок.
+
+    Читаются только уровни до max_depth и только окрестность точки.
+    """
+    fmt = _output_format(request, format)
+    ds_id = _resolve_dataset(req.dataset)
+    if not req.variables:
+        raise HTTPException(status_code=400, detail="Не заданы переменные")
+    eps = 0.05
+    t, t_start, t_end = _snapshot_window(req.time_utc)
+    depth = (0.0, float(req.max_depth) if req.max_depth is not None else float("inf"))
+    grid, lat, lon, km = await asyncio.to_thread(_snap, ds_id, req.variables[0], req.lat, req.lon)
+    async with _open_subset(ds_id, req.variables, lon[0] - eps, lon[0] + eps, lat[0] - eps, lat[0] + eps,
+                            t_start, t_end, snapshot=t, request=request, depth=depth) as (ds, source):
+        try:
+            zname = depth_name(ds)
+            if zname is None:
+                raise HTTPException(status_code=400, detail=f"У переменных {req.variables} в '{ds_id}' нет оси глубины")
+            (tname, laname, loname), iy, ix, km = _point_nodes(ds, grid, req.variables[0], lat, lon, km)
+            iy, ix = int(iy[0]), int(ix[0])
+            with span("select"):
+                cols = {n: np.asarray(ds[n].isel({tname: 0, laname: iy, loname: ix}).transpose(zname).values,
+                                      dtype=float) for n in req.variables}
+            depths = np.asarray(ds[zname].values, dtype=float)
+            meta = {"dataset_id": ds_id, "lat": float(req.lat), "lon": float(req.lon),
+                    "grid_lat": float(ds[laname].values[iy]), "grid_lon": float(ds[loname].values[ix]),
+                    "snap_km": round(float(km[0]), 3), "time": iso_times(ds[tname].values[:1])[0], "source": source}
+            units = {n: ds[n].attrs.get("units") for n in req.variables}
+            with span("serialize"):
+                if fmt != "json":
+                    meta["units"] = units
+                    return _binary_response(fmt, {"depths": depths, **cols}, meta, float_fields=list(cols))
+                return ProfileResponse(depths=depths.tolist(), values={n: _nan_to_none(v) for n, v in cols.items()},
+                                       units=units, meta=meta)
+        except KeyError as e:
+            raise HTTPException(status_code=400, detail=f"Переменная {e} не найдена в '{ds_id}'")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка чтения профиля: {e}")
+
+@app.post("/api/depth-grid", response_model=DepthGridResponse)
+async def depth_grid(req: DepthGridRequest, request: Request, format: Optional[str] = None,
+                     quantize: Optional[str] = None, nan_mask: bool = False):
+    """Срез полей на одном уровне глубины (ближайшем к depth) в окне на ближайший срок."""
+    fmt = _output_format(request, format)
+    ds_id = _resolve_dataset(req.dataset)
+    if not req.variables:
+        raise HTTPException(status_code=400, detail="Не заданы переменные")
+    t, t_start, t_end = _snapshot_window(req.time_utc)
+    async with _open_subset(ds_id, req.variables, req.min_lon, req.max_lon, req.min_lat, req.max_lat,
+                            t_start, t_end, snapshot=t, request=request, depth=req.depth) as (ds, source):
+        try:
+            with span("detect_coords"):
+                tname, lat_name, lon_name = _detect_coords(ds)
+            lats = ds[lat_name].values
+            lons = ds[lon_name].values
+            if req.max_cells:
+                stride = max(1, int(np.ceil(max(len(lats), len(lons)) / float(req.max_cells))))
+            else:
+                stride = max(1, int(req.step))
+            with span("select"):
+                sub = ds[req.variables].isel({tname: 0, lat_name: slice(None, None, stride),
+                                              lon_name: slice(None, None, stride)})
+                fields = {n: np.asarray(surface_only(sub[n], (lat_name, lon_name)).transpose(lat_name, lon_name)
+                                        .values, dtype=float) for n in req.variables}
+            lats, lons = lats[::stride], lons[::stride]
+            meta = {"dataset_id": ds_id, "time": t, "source": source, "stride": stride, "depth": _depth_meta(ds)}
+            units = {n: ds[n].attrs.get("units") for n in req.variables}
+            with span("serialize"):
+                if fmt != "json":
+                    meta["units"] = units
+                    return _binary_response(fmt, {"lons": lons, "lats": lats, **fields}, meta,
+                                            columns=grid_columns(lons, lats, fields),
+                                            quantize=quantize, nan_mask=nan_mask, float_fields=list(fields))
+                return DepthGridResponse(lons=lons.astype(float).tolist(), lats=lats.astype(float).tolist(),
+                                         values={n: _nan_to_none(v.astype(float).ravel()) for n, v in fields.items()},
+                                         units=units, meta=meta)
+        except KeyError as e:
+            raise HTTPException(status_code=400, detail=f"Переменная {e} не найдена в '{ds_id}'")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Ошибка выборки среза: {e}")
@@ -0,0 +1,176 @@
+"""Request timing spans and Prometheus text exposition.
+
+A request gets a Trace (held in a contextvar by the HTTP middleware); code on
+the hot path wraps its stages in ``with span("cli"):`` and each stage is
+recorded both into a per-endpoint/stage histogram and into the trace, which
+the slow-request log prints as a breakdown. Counters and gauges that already
+live in other components (cache stats, CLI queue) are read at scrape time
+through collector callbacks instead of being duplicated here.
+"""
+
+import time
+import contextvars
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    esc = lambda v: v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in items) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name, self.help = name, help
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        out += [f"{self.name}{_fmt_labels(k)} {_fmt_value(v)}" for k, v in sorted(self._values.items())]
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name, self.help = name, help
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Labels, List[float]] = {}  # counts по корзинам + [sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        s = self._series.get(key)
+        if s is None:
+            s = self._series[key] = [0.0] * (len(self.buckets) + 2)
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                s[i] += 1
+        s[-2] += value
+        s[-1] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, s in sorted(self._series.items()):
+            for b, c in zip(self.buckets, s):
+                out.append(f"{self.name}_bucket{_fmt_labels(key, ('le', _fmt_value(b)))} {_fmt_value(c)}")
+            out.append(f"{self.name}_bucket{_fmt_labels(key, ('le', '+Inf'))} {_fmt_value(s[-1])}")
+            out.append(f"{self.name}_sum{_fmt_labels(key)} {_fmt_value(s[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(key)} {_fmt_value(s[-1])}")
+        return out
+
+
+# collector() -> [(name, type, help, [(labels, value), ...]), ...]
+Collector = Callable[[], List[Tuple[str, str, str, List[Tuple[Dict[str, object], float]]]]]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: "OrderedDict[str, object]" = OrderedDict()
+        self._collectors: List[Collector] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def collector(self, fn: Collector) -> Collector:
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics.values():
+            lines += m.render()
+        for fn in self._collectors:
+            for name, kind, help, samples in fn():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                lines += [f"{name}{_fmt_labels(_labels(l))} {_fmt_value(v)}" for l, v in samples]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.histogram("hydrometeo_request_seconds", "HTTP request latency by endpoint")
+STAGE_SECONDS = REGISTRY.histogram("hydrometeo_stage_seconds", "Time spent per request stage")
+CACHE_EVENTS = REGISTRY.counter("hydrometeo_cache_events_total", "Cache lookups by cache and result")
+DOWNLOAD_BYTES = REGISTRY.counter("hydrometeo_download_bytes_total", "Bytes fetched from CMDS by source")
+
+
+class Trace:
+    """Этапы одного запроса; endpoint — шаблон маршрута, известный после роутинга."""
+
+    __slots__ = ("scope", "stages", "started")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.stages: Dict[str, float] = {}
+        self.started = time.perf_counter()
+
+    @property
+    def endpoint(self) -> str:
+        return getattr(self.scope.get("route"), "path", None) or "unmatched"
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+_trace: "contextvars.ContextVar[Optional[Trace]]" = contextvars.ContextVar("hydrometeo_trace", default=None)
+
+
+def start_trace(scope: dict) -> Tuple[Trace, contextvars.Token]:
+    trace = Trace(scope)
+    return trace, _trace.set(trace)
+
+
+def end_trace(token: contextvars.Token) -> None:
+    _trace.reset(token)
+
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+
+def record(stage: str, seconds: float) -> None:
+    trace = _trace.get()
+    STAGE_SECONDS.observe(seconds, endpoint=trace.endpoint if trace else "background", stage=stage)
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+class span:
+    """with span("open"): ... — время этапа в гистограмму и в трассу текущего запроса."""
+
+    __slots__ = ("stage", "t0")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self) -> "span":
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        record(self.stage, time.perf_counter() - self.t0)
@@ -0,0 +1,192 @@
+"""Access-log driven cache warm-up.
+
+Every served request is reduced to a normalised key: dataset, variables and
+bbox snapped to the subset-cache grid, and the time window *relative to now*,
+so tomorrow's identical request gets the same key. Keys are ranked by an
+exponentially decayed hit count. When the data signature changes (a new
+forecast run reached the local store), the scheduler replays the top keys in
+the background through the normal cache layers. It stops when the per-run
+download budget is spent.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .shared import FileLock
+
+log = logging.getLogger("uvicorn.error")
+
+Runner = Callable[[dict], Awaitable[int]]  # параметры ключа -> скачано байт
+
+
+def make_key(kind: str, params: dict) -> str:
+    return kind + ":" + json.dumps(params, sort_keys=True, separators=(",", ":"))
+
+
+def split_key(key: str) -> Tuple[str, dict]:
+    kind, _, params = key.partition(":")
+    return kind, json.loads(params)
+
+
+class AccessLog:
+    """Частоты ключей с экспоненциальным забыванием, сохраняемые на диск."""
+
+    def __init__(self, path: str, half_life_s: float, max_keys: int = 5000):
+        self.path = path
+        self.half_life_s = half_life_s
+        self.max_keys = max_keys
+        self._scores: Dict[str, List[float]] = {}  # key -> [score, last_seen]
+        self._dirty = False
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._scores = {k: list(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError):
+            self._scores = {}
+
+    def _write(self, mine: Dict[str, List[float]]) -> Dict[str, List[float]]:
+        """Слить снимок с файлом на диске (его же пишут другие процессы API) и записать.
+
+        Возвращает записи, которые на диске свежее снимка. Блокирует (файловая
+        блокировка, запись) — из event loop только через save_async.
+        """
+        with FileLock(self.path + ".lock"):
+            now = time.time()
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    disk = json.load(f)
+            except (OSError, ValueError):
+                disk = {}
+            newer = {k: list(v) for k, v in disk.items()
+                     if k not in mine or self._decayed(list(v), now) > self._decayed(mine[k], now)}
+            tmp = f"{self.path}.{os.getpid()}.part"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({**mine, **newer}, f)
+            os.replace(tmp, self.path)
+        return newer
+
+    def _adopt(self, newer: Dict[str, List[float]]) -> None:
+        now = time.time()
+        for k, v in newer.items():
+            mine = self._scores.get(k)
+            if mine is None or self._decayed(v, now) > self._decayed(mine, now):
+                self._scores[k] = v
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        self._dirty = False
+        self._adopt(self._write(dict(self._scores)))
+
+    async def save_async(self) -> None:
+        """save() в потоке: в потоке только снимок словаря, record() продолжает писать в живой."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            newer = await asyncio.to_thread(self._write, dict(self._scores))
+        except BaseException:
+            self._dirty = True
+            raise
+        self._adopt(newer)
+
+    def _decayed(self, entry: List[float], now: float) -> float:
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life_s)
+
+    def record(self, kind: str, params: dict, now: Optional[float] = None) -> None:
+        now = now or time.time()
+        key = make_key(kind, params)
+        entry = self._scores.get(key)
+        self._scores[key] = [(self._decayed(entry, now) if entry else 0.0) + 1.0, now]
+        self._dirty = True
+        if len(self._scores) > self.max_keys * 1.1:
+            for k, _ in self.top(len(self._scores), now)[self.max_keys:]:
+                del self._scores[k]
+
+    def top(self, n: int, now: Optional[float] = None) -> List[Tuple[str, float]]:
+        now = now or time.time()
+        ranked = sorted(((k, self._decayed(v, now)) for k, v in self._scores.items()),
+                        key=lambda kv: kv[1], reverse=True)
+        return ranked[:n]
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+
+class PrefetchScheduler:
+    """Прогрев кэшей самыми частыми ключами при появлении нового прогноза.
+
+    signature() — что-то, меняющееся с приходом новых данных (например, срок
+    последнего шага в локальном кубе); runners[kind] выполняет ключ через
+    обычные слои кэша и возвращает число скачанных байт; estimate[kind] —
+    оценка объёма до запуска, чтобы не начинать то, что не влезет в бюджет.
+    lead() — может ли этот процесс прогревать (при нескольких воркерах —
+    только один); журнал сохраняют все.
+    """
+
+    def __init__(self, access: AccessLog, runners: Dict[str, Runner],
+                 signature: Callable[[], Hashable], budget_bytes: int, top_n: int,
+                 estimate: Optional[Dict[str, Callable[[dict], int]]] = None,
+                 interval_s: float = 300.0, lead: Callable[[], bool] = lambda: True):
+        self.access = access
+        self.runners = runners
+        self.signature = signature
+        self.budget_bytes = budget_bytes
+        self.top_n = top_n
+        self.estimate = estimate or {}
+        self.interval_s = interval_s
+        self.lead = lead
+        self._last_signature: Optional[Hashable] = None
+        self.runs = 0
+        self.last_run: dict = {}
+
+    def stats(self) -> dict:
+        return {"keys": len(self.access), "runs": self.runs, "last_run": self.last_run}
+
+    async def run_once(self) -> dict:
+        spent, done, skipped, failed = 0, 0, 0, 0
+        for key, score in self.access.top(self.top_n):
+            kind, params = split_key(key)
+            runner = self.runners.get(kind)
+            if runner is None:
+                continue
+            est = self.estimate.get(kind, lambda p: 0)(params)
+            if spent + est > self.budget_bytes:
+                skipped += 1
+                continue
+            try:
+                spent += await runner(params)
+                done += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failed += 1
+                log.debug("prefetch %s failed: %s", key, e)
+            if spent >= self.budget_bytes:
+                break
+        self.runs += 1
+        self.last_run = {"at": time.time(), "done": done, "skipped": skipped,
+                         "failed": failed, "bytes": spent}
+        return self.last_run
+
+    async def loop(self) -> None:
+        while True:
+            try:
+                await self.access.save_async()
+                sig = self.signature()
+                if sig is not None and sig != self._last_signature and self.lead():
+                    self._last_signature = sig
+                    report = await self.run_once()
+                    log.info("Prefetch run: %s", report)
+            except asyncio.CancelledError:
+                self.access.save()
+                raise
+            except Exception as e:
+                log.warning("Prefetch loop failed: %s", e)
+            await asyncio.sleep(self.interval_s)
@@ -0,0 +1,120 @@
+"""Block-averaged multi-resolution pyramid for the currents field.
+
+Level k holds u/v averaged over k x k native cells (NaN-aware, so coastal
+blocks average only their wet cells) for every time step. Blocks are aligned
+to the start of the native grid, so a level is the same field whatever bbox is
+asked for. Levels are written next to the synced file they were built from,
+with the source mtime/size recorded so a re-synced file invalidates them.
+
+Usage from cron after a sync:  python -m app.pyramid <baltic_phy_YYYYMMDD.nc> ...
+"""
+
+import os
+import sys
+import json
+import math
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import xarray as xr
+
+LEVELS: Tuple[int, ...] = (2, 4, 8, 16, 32)
+VARIABLES: Tuple[str, ...] = ("uo", "vo")
+MARKER = "pyramid.json"
+
+TIME_NAMES = ("time", "t")
+LAT_NAMES = ("latitude", "lat", "y")
+LON_NAMES = ("longitude", "lon", "x")
+
+
+def _stamp(path: str) -> List[int]:
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def pyramid_dir(root: str, src_path: str) -> str:
+    return os.path.join(root, os.path.splitext(os.path.basename(src_path))[0])
+
+
+def level_path(root: str, src_path: str, factor: int) -> str:
+    return os.path.join(pyramid_dir(root, src_path), f"L{factor}.nc")
+
+
+def is_current(root: str, src_path: str) -> bool:
+    try:
+        with open(os.path.join(pyramid_dir(root, src_path), MARKER), "r", encoding="utf-8") as f:
+            return json.load(f).get("source_stamp") == _stamp(src_path)
+    except (OSError, ValueError):
+        return False
+
+
+def _axis(ds: xr.Dataset, names: Sequence[str]) -> str:
+    for n in names:
+        if n in ds.dims:
+            return n
+    raise ValueError(f"Нет оси {names[0]} в наборе")
+
+
+def block_mean(ds: xr.Dataset, factor: int) -> xr.Dataset:
+    """Среднее по блокам factor x factor узлов (NaN — суша — не учитываются)."""
+    if factor <= 1:
+        return ds
+    la, lo = _axis(ds, LAT_NAMES), _axis(ds, LON_NAMES)
+    window = {la: min(factor, ds.sizes[la]), lo: min(factor, ds.sizes[lo])}
+    return ds.coarsen(window, boundary="pad").mean(keep_attrs=True)
+
+
+def build_pyramid(src_path: str, root: str, variables: Iterable[str] = VARIABLES,
+                  levels: Iterable[int] = LEVELS) -> List[str]:
+    """Построить все уровни для синхронизированного файла."""
+    stamp = _stamp(src_path)
+    out_dir = pyramid_dir(root, src_path)
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    with xr.open_dataset(src_path) as src:
+        names = [v for v in variables if v in src.data_vars]
+        if not names:
+            return []
+        native = src[names].load()
+        for factor in sorted(levels):
+            # каждый уровень — прямо из исходной сетки: среднее средних смещало бы
+            # блоки у берега, где число «мокрых» узлов в подблоках разное
+            level = block_mean(native, factor)
+            path = os.path.join(out_dir, f"L{factor}.nc")
+            tmp = path + ".part"
+            level.attrs.update(pyramid_factor=factor, source=os.path.basename(src_path))
+            level.to_netcdf(tmp)
+            os.replace(tmp, path)
+            written.append(path)
+    marker = os.path.join(out_dir, MARKER)
+    with open(marker + ".part", "w", encoding="utf-8") as f:
+        json.dump({"source": os.path.basename(src_path), "source_stamp": stamp,
+                   "levels": sorted(levels), "variables": names}, f)
+    os.replace(marker + ".part", marker)
+    return written
+
+
+def pick_level(n_lat: int, n_lon: int, step: Optional[int] = None, max_arrows: Optional[int] = None,
+               levels: Iterable[int] = LEVELS) -> int:
+    """Множитель уровня для окна n_lat x n_lon узлов.
+
+    max_arrows — жёсткий предел стрелок по длинной стороне (берём уровень не мельче
+    нужного); иначе step задаёт желаемое прореживание, берём ближайший уровень.
+    """
+    avail = [1] + sorted(levels)
+    if max_arrows:
+        need = max(n_lat, n_lon) / float(max_arrows)
+        for f in avail:
+            if f >= need:
+                return f
+        return avail[-1]
+    step = max(1, int(step or 1))
+    return min(avail, key=lambda f: abs(math.log2(f) - math.log2(step)))
+
+
+if __name__ == "__main__":
+    root = os.getenv("PYRAMID_DIR") or os.path.join(os.getenv("CACHE_DIR", "./data/cache"), "pyramid")
+    for src in sys.argv[1:]:
+        if is_current(root, src):
+            print(f"[=] {src}: pyramid up to date")
+            continue
+        print(f"[*] {src}: " + ", ".join(os.path.basename(p) for p in build_pyramid(src, root)))
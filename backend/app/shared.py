@@ -0,0 +1,201 @@
+"""Primitives for running several uvicorn workers over one CACHE_DIR.
+
+* FileLock — advisory lock on a file (flock, msvcrt on Windows), usable from
+  threads (blocking) and from the event loop (polling, never blocks the loop);
+* ProcessFlight — cross-process single-flight: the first worker to take the
+  key's lock does the work, the others wait for the lock and then find the
+  result through a re-check callback instead of repeating it;
+* export_arrays / open_arrays — a dataset as raw .npy files next to the
+  cached NetCDF, opened with mmap so every worker maps the same page-cache
+  pages instead of holding its own decoded copy.
+"""
+
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Optional
+
+import numpy as np
+import xarray as xr
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+ARRAYS_META = "arrays.json"
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class FileLock:
+    """Эксклюзивная блокировка файла; файл блокировки не удаляется (так безопасно)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+    def acquire(self, timeout: Optional[float] = None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.005
+        while not self.try_acquire():
+            if deadline is not None and time.monotonic() >= deadline:
+                raise LockTimeout(self.path)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+    async def acquire_async(self, timeout: Optional[float] = None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.005
+        while not self.try_acquire():
+            if deadline is not None and time.monotonic() >= deadline:
+                raise LockTimeout(self.path)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+    async def __aenter__(self) -> "FileLock":
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+
+class ProcessFlight:
+    """Одна работа на ключ среди всех процессов с общим root.
+
+    Внутри процесса одинаковые вызовы склеивает SingleFlight; здесь — между
+    процессами: кто взял блокировку ключа, тот и выполняет factory(), остальные
+    после освобождения блокировки получают результат из recheck().
+    """
+
+    def __init__(self, root: str, stale_s: float = 86400.0):
+        self.root = root
+        self.adopted = 0
+        self.ran = 0
+        os.makedirs(root, exist_ok=True)
+        # файлы блокировок старше stale_s никто не держит — подчищаем
+        now = time.time()
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            try:
+                if now - os.path.getmtime(path) > stale_s:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def lock(self, key: str) -> FileLock:
+        return FileLock(os.path.join(self.root, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".lock"))
+
+    def stats(self) -> dict:
+        return {"ran": self.ran, "adopted": self.adopted}
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]],
+                 recheck: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        async with self.lock(key) as lock:
+            found = recheck()
+            if found is not None:
+                self.adopted += 1
+                return found
+            try: os.utime(lock.path)
+            except OSError: pass
+            self.ran += 1
+            return await factory()
+
+
+def arrays_dir(nc_path: str) -> str:
+    return nc_path + ".arrays"
+
+
+def export_arrays(ds: xr.Dataset, root: str) -> str:
+    """Записать переменные и координаты ds в root/*.npy (атомарно, через переименование каталога)."""
+    tmp = f"{root}.{os.getpid()}.part"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    entries = []
+    for i, (name, var) in enumerate(list(ds.coords.items()) + list(ds.data_vars.items())):
+        values = np.asarray(var.values)
+        entry = {"name": str(name), "dims": list(var.dims), "coord": name in ds.coords,
+                 "attrs": {k: (v.item() if isinstance(v, np.generic) else v) for k, v in var.attrs.items()
+                           if isinstance(v, (str, int, float, np.generic))}}
+        if values.dtype.kind == "O":
+            entry["values"] = values.tolist()
+        else:
+            entry["file"] = f"{i}.npy"
+            np.save(os.path.join(tmp, entry["file"]), values)
+        entries.append(entry)
+    with open(os.path.join(tmp, ARRAYS_META), "w", encoding="utf-8") as f:
+        json.dump({"variables": entries}, f)
+    try:
+        os.replace(tmp, root)
+    except OSError:
+        # другой процесс успел раньше — его копия не хуже
+        shutil.rmtree(tmp, ignore_errors=True)
+    return root
+
+
+def open_arrays(root: str) -> xr.Dataset:
+    """Набор из root/*.npy, отображённых в память только для чтения."""
+    with open(os.path.join(root, ARRAYS_META), "r", encoding="utf-8") as f:
+        entries = json.load(f)["variables"]
+    coords, data = {}, {}
+    for e in entries:
+        values = (np.load(os.path.join(root, e["file"]), mmap_mode="r") if "file" in e
+                  else np.array(e["values"], dtype=object))
+        (coords if e["coord"] else data)[e["name"]] = xr.Variable(e["dims"], values, e["attrs"])
+    return xr.Dataset(data, coords=coords)
+
+
+def dir_size(root: str) -> int:
+    total = 0
+    for dirpath, _, names in os.walk(root):
+        for n in names:
+            try: total += os.path.getsize(os.path.join(dirpath, n))
+            except OSError: pass
+    return total
@@ -0,0 +1,71 @@
+"""In-flight request coalescing.
+
+Concurrent callers asking for the same key (or for something an in-flight job
+already covers) await one shared task instead of starting their own. The task
+runs detached from any single caller: it is cancelled only when every waiter
+has gone away.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class Flight:
+    __slots__ = ("key", "task", "scope", "waiters")
+
+    def __init__(self, key: str, task: "asyncio.Task", scope: Any):
+        self.key = key
+        self.task = task
+        self.scope = scope
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self.started = 0
+        self.joined = 0
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "started": self.started, "joined": self.joined}
+
+    def _find(self, key: str, match: Optional[Callable[[Any], bool]]) -> Optional[Flight]:
+        flight = self._flights.get(key)
+        if flight is not None or match is None:
+            return flight
+        for f in self._flights.values():
+            if f.scope is not None and match(f.scope):
+                return f
+        return None
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]],
+                 scope: Any = None, match: Optional[Callable[[Any], bool]] = None) -> Any:
+        """Результат factory() для key, общий для всех одновременных вызовов.
+
+        match(scope) позволяет присоединиться к уже идущему заданию с другим
+        ключом, если его scope покрывает текущий запрос.
+        """
+        flight = self._find(key, match)
+        if flight is None:
+            flight = Flight(key, asyncio.ensure_future(factory()), scope)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _t, f=flight: self._forget(f))
+            self.started += 1
+        else:
+            self.joined += 1
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _forget(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
@@ -0,0 +1,536 @@
+"""Local Baltic data store.
+
+Answers subset requests from the NetCDF files that cron/sync_baltic.sh keeps in
+CACHE_DIR (baltic_<kind>_YYYYMMDD.nc), so the Copernicus CLI is only needed for
+windows that fall outside the synced coverage.
+"""
+
+import os
+import re
+import threading
+import contextvars
+import datetime as dt
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, NamedTuple, Union
+
+import numpy as np
+import xarray as xr
+
+from .pyramid import block_mean, is_current, level_path
+from .layout import find_series
+
+SYNC_FILE_RE = re.compile(r"^baltic_(?P<kind>[a-z]+)_(?P<day>\d{8}).*\.nc$")
+
+TIME_NAMES = ["time", "t"]
+LAT_NAMES = ["latitude", "lat", "y"]
+LON_NAMES = ["longitude", "lon", "x"]
+DEPTH_NAMES = ["depth", "deptht", "lev", "z"]
+
+# файл годится для глубины z, если его нижний уровень не мельче z - допуск
+DEPTH_TOLERANCE_M = 1.0
+
+# None — верхний уровень, число — ближайший уровень, (min, max) — все уровни в диапазоне
+Depth = Union[None, float, Tuple[float, float]]
+
+
+class Coverage(NamedTuple):
+    path: str
+    kind: str
+    stamp: Tuple[int, int]
+    variables: frozenset
+    time_name: str
+    lat_name: str
+    lon_name: str
+    t_min: np.datetime64
+    t_max: np.datetime64
+    lon_min: float
+    lon_max: float
+    lat_min: float
+    lat_max: float
+    half_dlon: float
+    half_dlat: float
+    depth_max: Optional[float] = None  # нижний уровень файла; None — без оси глубины
+
+
+def parse_utc(value: str) -> np.datetime64:
+    """ISO-8601 (с 'Z' или смещением) -> naive UTC datetime64[ns]."""
+    t = dt.datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if t.tzinfo is not None:
+        t = t.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return np.datetime64(t, "ns")
+
+
+def detect_coords(ds: xr.Dataset) -> Tuple[str, str, str]:
+    def pick(cands, present):
+        for n in cands:
+            if n in present: return n
+        return None
+    present = set(list(ds.dims) + list(ds.coords))
+    t = pick(TIME_NAMES, present)
+    la = pick(LAT_NAMES, present)
+    lo = pick(LON_NAMES, present)
+    if not (t and la and lo):
+        for v in ds.variables:
+            var = ds[v]
+            std = getattr(var, "standard_name", "")
+            if std == "latitude": la = v
+            elif std == "longitude": lo = v
+    if not la or not lo:
+        raise ValueError("Невозможно определить имена координат (lat/lon)")
+    if not t:
+        for cand in TIME_NAMES:
+            if cand in ds:
+                t = cand
+                break
+    if not t:
+        raise ValueError("Невозможно определить имя временной оси")
+    return t, la, lo
+
+
+def crop_bbox(ds: xr.Dataset, lat_name: str, lon_name: str,
+              xmin: float, xmax: float, ymin: float, ymax: float) -> xr.Dataset:
+    lats = ds[lat_name].values
+    lons = ds[lon_name].values
+    lat_sel = slice(ymin, ymax) if lats[0] <= lats[-1] else slice(ymax, ymin)
+    lon_sel = slice(xmin, xmax) if lons[0] <= lons[-1] else slice(xmax, xmin)
+    out = ds.sel({lat_name: lat_sel, lon_name: lon_sel})
+    # узкий бокс (±eps вокруг точки) может не захватить ни одного узла
+    if out.sizes[lat_name] == 0 or out.sizes[lon_name] == 0:
+        cy, cx = (ymin + ymax) / 2.0, (xmin + xmax) / 2.0
+        out = ds.sel({lat_name: [cy], lon_name: [cx]}, method="nearest")
+    return out
+
+
+def nearest_time_index(ds: xr.Dataset, time_name: str, t: np.datetime64) -> int:
+    return int(ds.indexes[time_name].get_indexer([t], method="nearest")[0])
+
+
+def nearest_indices(axis: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Индексы ближайших узлов 1-D оси (возрастающей или убывающей) для массива значений."""
+    axis = np.asarray(axis, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if axis.size == 1:
+        return np.zeros(values.shape, dtype=np.intp)
+    order = np.argsort(axis, kind="stable")
+    sa = axis[order]
+    pos = np.clip(np.searchsorted(sa, values), 1, sa.size - 1)
+    pos -= (values - sa[pos - 1]) < (sa[pos] - values)
+    return order[pos]
+
+
+def surface_only(da: xr.DataArray, keep: Tuple[str, ...]) -> xr.DataArray:
+    """Первый уровень по всем осям, кроме keep (глубина и т.п.)."""
+    extra = {d: 0 for d in da.dims if d not in keep}
+    return da.isel(extra) if extra else da
+
+
+def depth_name(ds: xr.Dataset) -> Optional[str]:
+    for n in DEPTH_NAMES:
+        if n in ds.dims:
+            return n
+    return None
+
+
+def select_depth(ds: xr.Dataset, depth: Depth) -> xr.Dataset:
+    """Только нужные уровни по глубине (лениво — читаться будут лишь они).
+
+    Диапазон без единого уровня внутри даёт ближайший к его середине уровень.
+    """
+    name = depth_name(ds)
+    if name is None:
+        return ds
+    if depth is None:
+        return ds.isel({name: 0})
+    z = ds[name].values
+    if isinstance(depth, tuple):
+        keep = (z >= depth[0]) & (z <= depth[1])
+        if not keep.any():
+            mid = depth[0] if not np.isfinite(depth[1]) else (depth[0] + depth[1]) / 2.0
+            keep[nearest_indices(z, [mid])[0]] = True
+        return ds.isel({name: np.nonzero(keep)[0]})
+    return ds.isel({name: int(nearest_indices(z, [depth])[0])})
+
+
+def deepest(depth: Depth) -> float:
+    """Глубина, до которой должен доходить источник для такого выбора уровней."""
+    if depth is None:
+        return 0.0
+    if isinstance(depth, tuple):
+        return depth[1] if np.isfinite(depth[1]) else depth[0]
+    return float(depth)
+
+
+def _half_step(axis: np.ndarray) -> float:
+    if axis.size < 2:
+        return 0.0
+    return float(np.abs(np.diff(axis)).max()) / 2.0
+
+
+class LocalStore:
+    """Index of synced files with an LRU of open dataset handles.
+
+    ``datasets`` maps a file kind (phy/wav/ice) to the CMDS dataset id it was
+    synced from; several kinds may share one id (PHY and ICE do).
+    ``pyramid_root`` is where pyramid.py writes block-averaged levels of the
+    synced files; snapshots at a coarser level are read from there.
+    ``series_root`` holds the time-contiguous twins written by layout.py;
+    windows over at most ``series_max_cells`` grid cells are read from them.
+
+    The store is shared by the event loop and worker threads: the index and
+    the handle LRU are guarded by a lock, and a handle opened inside
+    ``lease()`` is not closed (by LRU eviction or a removed file) until the
+    lease ends, so a thread can keep reading a lazy slice of it.
+    """
+
+    def __init__(self, root: str, datasets: Dict[str, str],
+                 max_lag: dt.timedelta = dt.timedelta(minutes=90), max_open: int = 8,
+                 pyramid_root: Optional[str] = None, series_root: Optional[str] = None,
+                 series_max_cells: int = 256):
+        self.root = root
+        self.pyramid_root = pyramid_root
+        self.series_root = series_root
+        self.series_max_cells = series_max_cells
+        self.datasets = dict(datasets)
+        self.max_lag = np.timedelta64(int(max_lag.total_seconds()), "s")
+        self.max_open = max_open
+        self._coverage: Dict[str, Coverage] = {}
+        self._handles: "OrderedDict[str, Tuple[Tuple[int, int], xr.Dataset]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._pins: Dict[int, int] = {}  # id(ds) -> число аренд
+        self._retired: Dict[int, xr.Dataset] = {}  # вытеснены, закроются с концом последней аренды
+        self._lease: "contextvars.ContextVar[Optional[list]]" = contextvars.ContextVar(
+            f"store_lease_{id(self)}", default=None)
+
+    # --- index ---
+
+    def _scan(self) -> List[Coverage]:
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return []
+        seen = set()
+        out = []
+        for name in names:
+            m = SYNC_FILE_RE.match(name)
+            if not m or m.group("kind") not in self.datasets:
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stamp = (st.st_mtime_ns, st.st_size)
+            seen.add(path)
+            cov = self._coverage.get(path)
+            if cov is None or cov.stamp != stamp:
+                # файл открывается вне lock; два потока могут описать его оба — не страшно
+                cov = self._describe(path, m.group("kind"), stamp)
+                if cov is None:
+                    continue
+                self._coverage[path] = cov
+            out.append(cov)
+        with self._lock:
+            for path in list(self._coverage):
+                if path not in seen:
+                    self._coverage.pop(path, None)
+                    self._drop_handle(path)
+        return out
+
+    def _describe(self, path: str, kind: str, stamp: Tuple[int, int]) -> Optional[Coverage]:
+        try:
+            with xr.open_dataset(path) as ds:
+                t, la, lo = detect_coords(ds)
+                times = ds[t].values
+                lats = ds[la].values
+                lons = ds[lo].values
+                if times.size == 0 or lats.size == 0 or lons.size == 0:
+                    return None
+                dn = depth_name(ds)
+                return Coverage(
+                    path=path, kind=kind, stamp=stamp,
+                    variables=frozenset(ds.data_vars),
+                    time_name=t, lat_name=la, lon_name=lo,
+                    t_min=times.min(), t_max=times.max(),
+                    lon_min=float(lons.min()), lon_max=float(lons.max()),
+                    lat_min=float(lats.min()), lat_max=float(lats.max()),
+                    half_dlon=_half_step(lons), half_dlat=_half_step(lats),
+                    depth_max=float(ds[dn].values.max()) if dn else None,
+                )
+        except Exception:
+            # Файл может дописываться cron-ом прямо сейчас — просто пропускаем
+            return None
+
+    def _candidates(self, dataset_id: str, variables: Iterable[str],
+                    xmin: float, xmax: float, ymin: float, ymax: float, depth: Depth = None) -> List[Coverage]:
+        need = set(variables)
+        z = deepest(depth)
+        out = []
+        for cov in self._scan():
+            if self.datasets.get(cov.kind) != dataset_id or not need <= cov.variables:
+                continue
+            # файл без оси глубины — двумерные поля, выбирать нечего; с осью — должен доставать до z
+            if cov.depth_max is not None and z > cov.depth_max + DEPTH_TOLERANCE_M:
+                continue
+            if xmin < cov.lon_min - cov.half_dlon or xmax > cov.lon_max + cov.half_dlon:
+                continue
+            if ymin < cov.lat_min - cov.half_dlat or ymax > cov.lat_max + cov.half_dlat:
+                continue
+            out.append(cov)
+        return out
+
+    def _cover(self, cands: List[Coverage], t0: np.datetime64, t1: np.datetime64) -> Optional[List[Coverage]]:
+        """Минимальный набор файлов, покрывающий [t0, t1] (с допуском max_lag)."""
+        lag = self.max_lag
+        pool = [c for c in cands if c.t_max >= t0 - lag and c.t_min <= t1 + lag]
+        chosen: List[Coverage] = []
+        reach = t0
+        while pool:
+            reachable = [c for c in pool if c.t_min <= reach + lag]
+            if not reachable:
+                return None
+            best = max(reachable, key=lambda c: c.t_max)
+            if chosen and best.t_max <= reach:
+                return None
+            chosen.append(best)
+            pool.remove(best)
+            reach = max(reach, best.t_max)
+            if reach + lag >= t1:
+                return sorted(chosen, key=lambda c: (c.t_min, c.t_max))
+        return None
+
+    # --- handles ---
+
+    def _open(self, cov: Coverage) -> xr.Dataset:
+        return self._open_path(cov.path, cov.stamp)
+
+    def _open_path(self, path: str, stamp: Tuple[int, int]) -> xr.Dataset:
+        with self._lock:
+            entry = self._handles.get(path)
+            if entry is not None and entry[0] == stamp:
+                self._handles.move_to_end(path)
+                ds = entry[1]
+            else:
+                self._drop_handle(path)
+                ds = xr.open_dataset(path)
+                self._handles[path] = (stamp, ds)
+                while len(self._handles) > self.max_open:
+                    _, (_, old) = self._handles.popitem(last=False)
+                    self._close(old)
+            held = self._lease.get()
+            if held is not None:
+                self._pins[id(ds)] = self._pins.get(id(ds), 0) + 1
+                held.append(ds)
+            return ds
+
+    def _close(self, ds: xr.Dataset) -> None:
+        # хэндл, который кто-то читает по аренде, закрывается после её окончания
+        if self._pins.get(id(ds)):
+            self._retired[id(ds)] = ds
+        else:
+            ds.close()
+
+    def _drop_handle(self, path: str) -> None:
+        with self._lock:
+            entry = self._handles.pop(path, None)
+            if entry is not None:
+                self._close(entry[1])
+
+    @contextmanager
+    def lease(self) -> Iterator[None]:
+        """Хэндлы, открытые внутри блока (и в asyncio.to_thread из него), не закрываются до выхода.
+
+        Вложенные аренды входят во внешнюю.
+        """
+        if self._lease.get() is not None:
+            yield
+            return
+        held: list = []
+        token = self._lease.set(held)
+        try:
+            yield
+        finally:
+            self._lease.reset(token)
+            with self._lock:
+                for ds in held:
+                    n = self._pins.pop(id(ds)) - 1
+                    if n:
+                        self._pins[id(ds)] = n
+                    elif id(ds) in self._retired:
+                        self._retired.pop(id(ds)).close()
+
+    def _open_series(self, cov: Coverage) -> Optional[xr.Dataset]:
+        """Двойник файла, разбитый на чанки вдоль времени, или None."""
+        if self.series_root is None:
+            return None
+        path = find_series(self.series_root, cov.path)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return self._open_path(path, (st.st_mtime_ns, st.st_size))
+
+    def _open_level(self, cov: Coverage, factor: int) -> Optional[xr.Dataset]:
+        """Готовый уровень пирамиды для файла или None, если он не построен/устарел."""
+        if self.pyramid_root is None or not is_current(self.pyramid_root, cov.path):
+            return None
+        path = level_path(self.pyramid_root, cov.path, factor)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return self._open_path(path, (st.st_mtime_ns, st.st_size))
+
+    def close(self) -> None:
+        with self._lock:
+            for path in list(self._handles):
+                self._drop_handle(path)
+
+    # --- queries ---
+
+    def files(self, kind: str) -> List[str]:
+        return sorted(c.path for c in self._scan() if c.kind == kind)
+
+    def covers(self, dataset_id: str, variables: List[str],
+               xmin: float, xmax: float, ymin: float, ymax: float, t_start: str, t_end: str,
+               depth: Depth = None) -> bool:
+        """Покрывает ли локальный куб окно (без чтения данных)."""
+        cands = self._candidates(dataset_id, variables, xmin, xmax, ymin, ymax, depth)
+        return self._cover(cands, parse_utc(t_start), parse_utc(t_end)) is not None
+
+    def latest(self, dataset_id: str) -> Optional[np.datetime64]:
+        """Последний срок, имеющийся локально для набора данных."""
+        ends = [c.t_max for c in self._scan() if self.datasets.get(c.kind) == dataset_id]
+        return max(ends) if ends else None
+
+    def variables(self, dataset_id: str) -> frozenset:
+        """Все переменные, имеющиеся локально для набора данных."""
+        out = set()
+        for cov in self._scan():
+            if self.datasets.get(cov.kind) == dataset_id:
+                out |= cov.variables
+        return frozenset(out)
+
+    def grid_step(self, dataset_id: str, variables: Iterable[str]) -> Optional[Tuple[float, float]]:
+        """Шаг исходной сетки (dlat, dlon) в градусах по любому подходящему файлу."""
+        need = set(variables)
+        for cov in self._scan():
+            if self.datasets.get(cov.kind) == dataset_id and need <= cov.variables:
+                return 2 * cov.half_dlat, 2 * cov.half_dlon
+        return None
+
+    def grid_source(self, dataset_id: str, variables: Iterable[str]) -> Optional[Coverage]:
+        """Файл набора с самым широким охватом (при равенстве — свежий): по нему строится сетка."""
+        need = set(variables)
+        cands = [c for c in self._scan() if self.datasets.get(c.kind) == dataset_id and need <= c.variables]
+        if not cands:
+            return None
+        return max(cands, key=lambda c: ((c.lon_max - c.lon_min) * (c.lat_max - c.lat_min), c.t_max))
+
+    def open_window(self, dataset_id: str, variables: List[str],
+                    xmin: float, xmax: float, ymin: float, ymax: float,
+                    t_start: str, t_end: str, depth: Depth = None) -> Optional[xr.Dataset]:
+        """Подмножество [bbox] x [t_start, t_end] или None, если вне локального покрытия."""
+        with self.lease():
+            return self._read_window(dataset_id, variables, xmin, xmax, ymin, ymax, t_start, t_end, depth)
+
+    def _read_window(self, dataset_id: str, variables: List[str],
+                     xmin: float, xmax: float, ymin: float, ymax: float,
+                     t_start: str, t_end: str, depth: Depth) -> Optional[xr.Dataset]:
+        t0, t1 = parse_utc(t_start), parse_utc(t_end)
+        chosen = self._cover(self._candidates(dataset_id, variables, xmin, xmax, ymin, ymax, depth), t0, t1)
+        if chosen is None:
+            return None
+        parts = []
+        for cov in chosen:
+            # узкое окно (ряд в точке) — из раскладки «ряды», широкое — из основной
+            n_lon = (xmax - xmin) / max(2 * cov.half_dlon, 1e-9) + 1
+            n_lat = (ymax - ymin) / max(2 * cov.half_dlat, 1e-9) + 1
+            n_cells = n_lon * n_lat
+            src = self._open_series(cov) if n_cells <= self.series_max_cells else None
+            ds = select_depth((src if src is not None else self._open(cov))[variables], depth)
+            ds = crop_bbox(ds, cov.lat_name, cov.lon_name, xmin, xmax, ymin, ymax)
+            parts.append(ds.sel({cov.time_name: slice(t0, t1)}))
+        tname = chosen[0].time_name
+        if len(parts) == 1:
+            return parts[0].load()
+        merged = xr.concat(parts, dim=tname)
+        _, keep = np.unique(merged[tname].values[::-1], return_index=True)
+        # при перекрытии суточных файлов оставляем более свежий прогон
+        keep = np.sort(merged.sizes[tname] - 1 - keep)
+        return merged.isel({tname: keep}).load()
+
+    def window_steps(self, dataset_id: str, variables: List[str],
+                     xmin: float, xmax: float, ymin: float, ymax: float,
+                     t_start: str, t_end: str,
+                     depth: Depth = None) -> Optional[List[Tuple[Coverage, np.datetime64, xr.Dataset]]]:
+        """Сроки окна по одному: (файл, срок, ленивый срез bbox) или None вне покрытия.
+
+        Данные не читаются — каждый срез загружает вызывающий, держа lease()
+        с вызова и до конца чтения; при перекрытии файлов срок берётся из более
+        свежего прогона, как в open_window.
+        """
+        t0, t1 = parse_utc(t_start), parse_utc(t_end)
+        chosen = self._cover(self._candidates(dataset_id, variables, xmin, xmax, ymin, ymax, depth), t0, t1)
+        if chosen is None:
+            return None
+        steps: Dict[np.datetime64, Tuple[Coverage, np.datetime64, xr.Dataset]] = {}
+        for cov in chosen:
+            ds = select_depth(self._open(cov)[variables], depth)
+            ds = crop_bbox(ds, cov.lat_name, cov.lon_name, xmin, xmax, ymin, ymax)
+            times = ds[cov.time_name].values
+            for i in np.nonzero((times >= t0) & (times <= t1))[0]:
+                steps[times[i]] = (cov, times[i], ds.isel({cov.time_name: int(i)}))
+        return [steps[t] for t in sorted(steps)]
+
+    def locate_snapshot(self, dataset_id: str, variables: Iterable[str],
+                        t: str) -> Optional[Tuple[Coverage, np.datetime64]]:
+        """Файл и фактический срок, из которых будет взят срез на момент t (без учёта bbox)."""
+        t0 = parse_utc(t)
+        need = set(variables)
+        cands = [c for c in self._scan() if self.datasets.get(c.kind) == dataset_id and need <= c.variables]
+        chosen = self._cover(cands, t0, t0)
+        if chosen is None:
+            return None
+        cov = max(chosen, key=lambda c: c.t_max)
+        with self.lease():
+            ds = self._open(cov)
+            found = ds[cov.time_name].values[nearest_time_index(ds, cov.time_name, t0)]
+        if abs(found - t0) > self.max_lag:
+            return None
+        return cov, found
+
+    def open_snapshot(self, dataset_id: str, variables: List[str],
+                      xmin: float, xmax: float, ymin: float, ymax: float,
+                      t: str, level: int = 1, depth: Depth = None) -> Optional[xr.Dataset]:
+        """Ближайший по времени срез (ось времени длины 1) или None.
+
+        level > 1 — поля, осреднённые блоками level x level: из пирамиды, если
+        она построена для файла, иначе осреднением прочитанного окна.
+        """
+        with self.lease():
+            return self._read_snapshot(dataset_id, variables, xmin, xmax, ymin, ymax, t, level, depth)
+
+    def _read_snapshot(self, dataset_id: str, variables: List[str],
+                       xmin: float, xmax: float, ymin: float, ymax: float,
+                       t: str, level: int, depth: Depth) -> Optional[xr.Dataset]:
+        t0 = parse_utc(t)
+        chosen = self._cover(self._candidates(dataset_id, variables, xmin, xmax, ymin, ymax, depth), t0, t0)
+        if chosen is None:
+            return None
+        cov = max(chosen, key=lambda c: c.t_max)
+        src = self._open_level(cov, level) if level > 1 else None
+        if src is not None and not set(variables) <= set(src.data_vars):
+            src = None
+        coarse = src is not None
+        ds = select_depth((src if coarse else self._open(cov))[variables], depth)
+        ds = crop_bbox(ds, cov.lat_name, cov.lon_name, xmin, xmax, ymin, ymax)
+        idx = nearest_time_index(ds, cov.time_name, t0)
+        if abs(ds[cov.time_name].values[idx] - t0) > self.max_lag:
+            return None
+        ds = ds.isel({cov.time_name: [idx]}).load()
+        if level > 1 and not coarse:
+            ds = block_mean(ds, level)
+        return ds
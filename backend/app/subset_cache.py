@@ -0,0 +1,279 @@
+"""Persistent, content-addressed cache of CLI subsets.
+
+Files live in <root>/<sha256>.nc; manifest.json records size, creation and last
+access time of every entry so LRU/TTL eviction survives restarts. Downloads go
+to a *.part.nc name and are published with os.replace, so readers never see a
+half-written file. Next to an entry there may be <sha256>.nc.arrays, the same
+data as memory-mappable .npy files (shared.py).
+
+Several worker processes may share one root: files another process published
+are adopted on lookup, and the manifest is merged with the on-disk copy under
+a file lock instead of being overwritten.
+"""
+
+import os
+import json
+import math
+import time
+import shutil
+import hashlib
+import datetime as dt
+from typing import Dict, List, Optional, Tuple, NamedTuple
+
+import numpy as np
+
+from .shared import FileLock, arrays_dir, dir_size
+
+MANIFEST = "manifest.json"
+PART_MAX_AGE_S = 6 * 3600  # недокачанное старше этого — брошено упавшим процессом
+
+
+def _fmt_utc(t: np.datetime64) -> str:
+    return str(np.datetime64(t, "s")) + "Z"
+
+
+def snap_bbox(xmin: float, xmax: float, ymin: float, ymax: float, step: float) -> Tuple[float, float, float, float]:
+    """Расширить bbox наружу до сетки step градусов."""
+    if step <= 0:
+        return xmin, xmax, ymin, ymax
+    lo = lambda v: round(math.floor(round(v / step, 6)) * step, 6)
+    hi = lambda v: round(math.ceil(round(v / step, 6)) * step, 6)
+    return lo(xmin), hi(xmax), lo(ymin), hi(ymax)
+
+
+def snap_window(t0: np.datetime64, t1: np.datetime64, minutes: int) -> Tuple[str, str]:
+    """Расширить окно наружу до границ по minutes минут; отдаёт ISO-строки для CLI."""
+    if minutes <= 0:
+        return _fmt_utc(t0), _fmt_utc(t1)
+    q = np.timedelta64(minutes, "m")
+    base = np.datetime64(0, "m")
+    a = np.datetime64(t0, "m")
+    b = np.datetime64(t1, "s")
+    start = base + ((a - base) // q) * q
+    end = base + -((base - b) // q) * q
+    return _fmt_utc(start), _fmt_utc(end)
+
+
+def subset_key(dataset_id: str, variables: List[str],
+               bbox: Tuple[float, float, float, float], t_start: Optional[str], t_end: Optional[str],
+               extra: Optional[dict] = None) -> str:
+    payload = {"dataset": dataset_id, "variables": sorted(set(variables)),
+               "bbox": [round(v, 6) for v in bbox], "t": [t_start, t_end]}
+    if extra:
+        payload.update(extra)
+    raw = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SubsetCache:
+    def __init__(self, root: str, max_bytes: int, ttl: dt.timedelta, save_interval: float = 30.0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl.total_seconds()
+        self.save_interval = save_interval
+        self._entries: Dict[str, dict] = {}
+        self._removed: set = set()
+        self._last_save = 0.0
+        self._dirty = False
+        self._lock = FileLock(os.path.join(root, MANIFEST + ".lock"))
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    # --- manifest ---
+
+    def _read_manifest(self) -> Dict[str, dict]:
+        try:
+            with open(os.path.join(self.root, MANIFEST), "r", encoding="utf-8") as f:
+                return json.load(f).get("entries", {})
+        except (OSError, ValueError):
+            return {}
+
+    def _load(self) -> None:
+        for key, e in self._read_manifest().items():
+            try:
+                e["size"] = self._size(key)
+            except OSError:
+                continue
+            self._entries[key] = e
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(MANIFEST):
+                continue
+            if name.endswith(".nc") and not name.endswith(".part.nc"):
+                # опубликован другим процессом после записи manifest
+                if name[:-3] not in self._entries:
+                    self._adopt(name[:-3])
+                continue
+            if name.endswith(".nc.arrays") and os.path.exists(path[:-len(".arrays")]):
+                continue
+            # недокачанные *.part: свежие может прямо сейчас писать соседний процесс
+            try:
+                if now - os.path.getmtime(path) < PART_MAX_AGE_S and ".part" in name:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+        self._evict()
+        self.save()
+
+    def save(self) -> None:
+        """Слить свои записи с manifest на диске (его могли обновить другие процессы) и записать."""
+        with self._lock:
+            merged = {}
+            for key, e in self._read_manifest().items():
+                if key in self._removed or key in self._entries:
+                    continue
+                if os.path.exists(self.path(key)):
+                    merged[key] = e
+            merged.update(self._entries)
+            self._entries = merged
+            self._removed.clear()
+            tmp = os.path.join(self.root, f"{MANIFEST}.{os.getpid()}.part")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"version": 1, "entries": self._entries}, f)
+            os.replace(tmp, os.path.join(self.root, MANIFEST))
+        self._last_save = time.time()
+        self._dirty = False
+
+    def _touch_save(self) -> None:
+        self._dirty = True
+        if time.time() - self._last_save >= self.save_interval:
+            self.save()
+
+    # --- entries ---
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key + ".nc")
+
+    def arrays(self, key: str) -> Optional[str]:
+        """Каталог .npy-копии записи (для mmap) или None."""
+        root = arrays_dir(self.path(key))
+        return root if os.path.isdir(root) else None
+
+    def _size(self, key: str) -> int:
+        size = os.path.getsize(self.path(key))
+        root = arrays_dir(self.path(key))
+        return size + (dir_size(root) if os.path.isdir(root) else 0)
+
+    def _adopt(self, key: str) -> Optional[dict]:
+        try:
+            created = os.path.getmtime(self.path(key))
+            size = self._size(key)
+        except OSError:
+            return None
+        e = self._entries[key] = {"size": size, "created": created, "last_access": created, "hits": 0, "meta": {}}
+        self._removed.discard(key)
+        self._dirty = True
+        return e
+
+    def get(self, key: str) -> Optional[str]:
+        e = self._entries.get(key)
+        if e is None:
+            e = self._adopt(key)
+        if e is None:
+            return None
+        now = time.time()
+        if self.ttl and now - e["created"] > self.ttl:
+            self._remove(key)
+            self.save()
+            return None
+        path = self.path(key)
+        if not os.path.exists(path):
+            self._entries.pop(key, None)
+            self._touch_save()
+            return None
+        e["last_access"] = now
+        e["hits"] = e.get("hits", 0) + 1
+        self._touch_save()
+        return path
+
+    def reserve(self, key: str) -> str:
+        """Временное имя для загрузки; публикуется через publish()."""
+        # CLI дописывает своё расширение, если имя не оканчивается на .nc
+        return os.path.join(self.root, f"{key}.{os.getpid()}.{time.monotonic_ns()}.part.nc")
+
+    def publish(self, key: str, part_path: str, meta: Optional[dict] = None) -> str:
+        path = self.path(key)
+        part_arrays = arrays_dir(part_path)
+        shutil.rmtree(arrays_dir(path), ignore_errors=True)
+        if os.path.isdir(part_arrays):
+            os.replace(part_arrays, arrays_dir(path))
+        os.replace(part_path, path)
+        now = time.time()
+        self._removed.discard(key)
+        self._entries[key] = {"size": self._size(key), "created": now, "last_access": now,
+                              "hits": 0, "meta": meta or {}}
+        self._evict(keep=key)
+        self.save()
+        return path
+
+    def discard(self, part_path: str) -> None:
+        shutil.rmtree(arrays_dir(part_path), ignore_errors=True)
+        try: os.remove(part_path)
+        except OSError: pass
+
+    def total_bytes(self) -> int:
+        return sum(e["size"] for e in self._entries.values())
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self.total_bytes(), "max_bytes": self.max_bytes}
+
+    def _remove(self, key: str) -> None:
+        self._entries.pop(key, None)
+        self._removed.add(key)
+        # открытые другими процессами файлы и отображения остаются читаемыми до закрытия (POSIX)
+        shutil.rmtree(arrays_dir(self.path(key)), ignore_errors=True)
+        try: os.remove(self.path(key))
+        except OSError: pass
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        now = time.time()
+        if self.ttl:
+            for key in [k for k, e in self._entries.items() if now - e["created"] > self.ttl and k != keep]:
+                self._remove(key)
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        for key in sorted(self._entries, key=lambda k: self._entries[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self._entries[key]["size"]
+            self._remove(key)
+
+    def close(self) -> None:
+        if self._dirty:
+            self.save()
+
+
+class SubsetScope(NamedTuple):
+    """Что покрывает загрузка: набор данных, переменные, bbox, окно времени и глубины.
+
+    depth — (min, max) переданные CLI как -z/-Z; None — без ограничения по глубине.
+    """
+    dataset_id: str
+    variables: frozenset
+    xmin: float
+    xmax: float
+    ymin: float
+    ymax: float
+    t_start: Optional[str]
+    t_end: Optional[str]
+    depth: Optional[Tuple[float, float]] = None
+
+    def within(self, other: "SubsetScope") -> bool:
+        if self.t_start is None or self.t_end is None or other.t_start is None or other.t_end is None:
+            return False
+        if other.depth is not None and (self.depth is None or not (
+                other.depth[0] <= self.depth[0] and self.depth[1] <= other.depth[1])):
+            return False
+        # ISO-строки одного формата (snap_window) сравниваются лексикографически
+        return (self.dataset_id == other.dataset_id and self.variables <= other.variables
+                and other.xmin <= self.xmin and self.xmax <= other.xmax
+                and other.ymin <= self.ymin and self.ymax <= other.ymax
+                and other.t_start <= self.t_start and self.t_end <= other.t_end)
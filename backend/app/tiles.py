@@ -0,0 +1,93 @@
+"""XYZ (Web Mercator) data tiles cut from the local store.
+
+A tile is a fixed ``size`` x ``size`` grid of samples at the pixel centres of
+the slippy-map tile z/x/y, rows north to south, NaN where the model grid has
+no cell. Samples are nearest-neighbour from the native grid, or from the
+currents pyramid level whose cell is no larger than a tile pixel, so a low-zoom
+tile averages instead of aliasing.
+"""
+
+import math
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+
+from .store import nearest_indices
+
+# field -> (вид синхронизированного файла, переменные)
+FIELDS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    "currents": ("phy", ("uo", "vo")),
+    "waves": ("wav", ("VHM0", "VMDR")),
+    "ice": ("ice", ("siconc", "sithick")),
+    # производные поля ingest (derive.py)
+    "current_speed": ("phy", ("cur_speed", "cur_dir")),
+    "sea_state": ("wav", ("sea_state",)),
+}
+
+MAX_LAT = 85.0511287798066
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(lon_west, lon_east, lat_south, lat_north) тайла."""
+    n = 2 ** z
+
+    def lat(row: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0, lat(y + 1), lat(y)
+
+
+def pixel_centres(z: int, x: int, y: int, size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Долготы столбцов и широты строк (с севера на юг) центров пикселей тайла."""
+    n = 2 ** z
+    frac = (np.arange(size) + 0.5) / size
+    lons = (x + frac) / n * 360.0 - 180.0
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + frac) / n))))
+    return lons, lats
+
+
+def pixel_deg(z: int, size: int) -> float:
+    return 360.0 / (2 ** z) / size
+
+
+def pick_tile_level(z: int, size: int, native_deg: float, levels: Iterable[int]) -> int:
+    """Самый грубый уровень пирамиды, ячейка которого не больше пикселя тайла."""
+    best = 1
+    if native_deg <= 0:
+        return best
+    for f in sorted(levels):
+        if f * native_deg <= pixel_deg(z, size):
+            best = f
+    return best
+
+
+def valid_tile(z: int, x: int, y: int, max_zoom: int) -> bool:
+    return 0 <= z <= max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def sample(ds: Optional[xr.Dataset], variables: Iterable[str], lat_name: str, lon_name: str,
+           lons: np.ndarray, lats: np.ndarray) -> Dict[str, np.ndarray]:
+    """Значения в узлах тайла (size x size, float32); вне сетки — NaN."""
+    shape = (lats.size, lons.size)
+    if ds is None:
+        return {v: np.full(shape, np.nan, dtype="f4") for v in variables}
+    src_lat = ds[lat_name].values.astype(float)
+    src_lon = ds[lon_name].values.astype(float)
+    iy = nearest_indices(src_lat, lats)
+    ix = nearest_indices(src_lon, lons)
+    # пиксель дальше половины ячейки от ближайшего узла — за пределами сетки
+    half_lat = np.abs(np.diff(src_lat)).max() / 2.0 if src_lat.size > 1 else 0.0
+    half_lon = np.abs(np.diff(src_lon)).max() / 2.0 if src_lon.size > 1 else 0.0
+    ok_y = np.abs(src_lat[iy] - lats) <= half_lat + 1e-9
+    ok_x = np.abs(src_lon[ix] - lons) <= half_lon + 1e-9
+    outside = ~(ok_y[:, None] & ok_x[None, :])
+    out = {}
+    for v in variables:
+        da = ds[v]
+        extra = {d: 0 for d in da.dims if d not in (lat_name, lon_name)}
+        grid = (da.isel(extra) if extra else da).transpose(lat_name, lon_name).values
+        a = grid[np.ix_(iy, ix)].astype("f4")
+        a[outside] = np.nan
+        out[v] = a
+    return out
@@ -0,0 +1,221 @@
+"""WMTS proxy helpers: query normalisation and a two-tier (memory + disk) tile cache.
+
+Tiles are keyed on the normalised query string (KVP names are
+case-insensitive in WMTS, parameter order is irrelevant). Freshness follows the
+upstream Cache-Control / Expires headers; stale entries keep their ETag and
+Last-Modified so the proxy can revalidate them with a conditional request.
+"""
+
+import os
+import json
+import time
+import hashlib
+import email.utils
+from collections import OrderedDict
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+try:  # HTTP/2 для пула соединений, если установлен пакет h2
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class Tile(NamedTuple):
+    body: bytes
+    media_type: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    expires: float
+
+    def fresh(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) < self.expires
+
+    def max_age(self, now: Optional[float] = None) -> int:
+        return max(0, int(self.expires - (now or time.time())))
+
+    def conditional_headers(self) -> Dict[str, str]:
+        h = {}
+        if self.etag:
+            h["If-None-Match"] = self.etag
+        if self.last_modified:
+            h["If-Modified-Since"] = self.last_modified
+        return h
+
+
+def normalize_query(query: str) -> str:
+    pairs = [(k.lower(), v) for k, v in parse_qsl(query, keep_blank_values=True)]
+    pairs.sort()
+    return urlencode(pairs)
+
+
+def freshness(headers: Mapping[str, str], default_ttl: float, now: Optional[float] = None) -> Optional[float]:
+    """Момент устаревания по Cache-Control/Expires; None — кэшировать нельзя."""
+    now = now or time.time()
+    cc = {}
+    for part in (headers.get("Cache-Control") or "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            cc[name.lower()] = value.strip('"')
+    if "no-store" in cc or "private" in cc:
+        return None
+    if "no-cache" in cc:
+        return now  # хранить, но перепроверять каждый раз
+    for name in ("s-maxage", "max-age"):
+        if name in cc:
+            try:
+                return now + float(cc[name])
+            except ValueError:
+                pass
+    if headers.get("Expires"):
+        try:
+            return email.utils.parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            return now
+    return now + default_ttl
+
+
+class TileCache:
+    """LRU в памяти поверх LRU на диске, оба с бюджетом в байтах.
+
+    Дисковый уровень может быть общим для нескольких процессов: чужие тайлы
+    подхватываются при чтении, запись атомарна (os.replace).
+    """
+
+    def __init__(self, root: str, mem_max_bytes: int, disk_max_bytes: int):
+        self.root = root
+        self.mem_max_bytes = mem_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._mem: "OrderedDict[str, Tile]" = OrderedDict()
+        self._mem_bytes = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def digest(key: str) -> str:
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest + ".tile")
+
+    def _scan(self) -> None:
+        found = []
+        now = time.time()
+        for sub in os.listdir(self.root):
+            d = os.path.join(self.root, sub)
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                path = os.path.join(d, name)
+                if not name.endswith(".tile"):
+                    # свежий *.part может дописывать соседний процесс
+                    try:
+                        if now - os.path.getmtime(path) > 3600:
+                            os.remove(path)
+                    except OSError: pass
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_atime, name[:-5], st.st_size))
+        for _, digest, size in sorted(found):
+            self._disk[digest] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    # --- memory tier ---
+
+    def _mem_put(self, key: str, tile: Tile) -> None:
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= len(old.body)
+        if len(tile.body) > self.mem_max_bytes:
+            return
+        self._mem[key] = tile
+        self._mem_bytes += len(tile.body)
+        while self._mem_bytes > self.mem_max_bytes:
+            _, t = self._mem.popitem(last=False)
+            self._mem_bytes -= len(t.body)
+
+    # --- disk tier ---
+
+    def _disk_read(self, digest: str) -> Optional[Tile]:
+        try:
+            with open(self._path(digest), "rb") as f:
+                header = json.loads(f.readline())
+                body = f.read()
+                size = f.tell()
+        except (OSError, ValueError):
+            self._disk_forget(digest)
+            return None
+        if digest not in self._disk:
+            # записан другим процессом с тем же каталогом
+            self._disk_bytes += size
+            self._disk[digest] = size
+        self._disk.move_to_end(digest)
+        return Tile(body, header["media_type"], header.get("etag"), header.get("last_modified"), header["expires"])
+
+    def _disk_write(self, digest: str, tile: Tile) -> None:
+        path = self._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        header = {"media_type": tile.media_type, "etag": tile.etag,
+                  "last_modified": tile.last_modified, "expires": tile.expires}
+        tmp = f"{path}.{os.getpid()}.part"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            f.write(tile.body)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        self._disk_bytes += size - self._disk.pop(digest, 0)
+        self._disk[digest] = size
+        self._evict_disk()
+
+    def _disk_forget(self, digest: str) -> None:
+        self._disk_bytes -= self._disk.pop(digest, 0)
+        try: os.remove(self._path(digest))
+        except OSError: pass
+
+    def _evict_disk(self) -> None:
+        while self._disk_bytes > self.disk_max_bytes and self._disk:
+            digest = next(iter(self._disk))
+            self._disk_forget(digest)
+
+    # --- API ---
+
+    def get(self, key: str) -> Tuple[Optional[Tile], str]:
+        """(tile, tier); tile может быть устаревшим — тогда его надо перепроверить."""
+        tile = self._mem.get(key)
+        if tile is not None:
+            self._mem.move_to_end(key)
+            self.hits["memory"] += 1
+            return tile, "memory"
+        digest = self.digest(key)
+        if digest in self._disk or os.path.exists(self._path(digest)):
+            tile = self._disk_read(digest)
+            if tile is not None:
+                self._mem_put(key, tile)
+                self.hits["disk"] += 1
+                return tile, "disk"
+        self.misses += 1
+        return None, "miss"
+
+    def put(self, key: str, tile: Tile) -> None:
+        self._mem_put(key, tile)
+        self._disk_write(self.digest(key), tile)
+
+    def refresh(self, key: str, tile: Tile, expires: float) -> Tile:
+        """Ответ 304: тело прежнее, продлеваем срок свежести."""
+        tile = tile._replace(expires=expires)
+        self.put(key, tile)
+        return tile
+
+    def stats(self) -> dict:
+        return {"memory_entries": len(self._mem), "memory_bytes": self._mem_bytes,
+                "disk_entries": len(self._disk), "disk_bytes": self._disk_bytes,
+                "hits": dict(self.hits), "misses": self.misses}
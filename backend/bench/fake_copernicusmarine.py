@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Offline stand-in for the ``copernicusmarine`` CLI.
+
+Understands the two commands the backend issues: ``login`` (always succeeds)
+and ``subset`` with the -i/-v/-x/-X/-y/-Y/-t/-T/-z/-Z/-o/-f options. Instead of
+downloading, it writes a synthetic NetCDF with the real product layout:
+
+* BAL PHY — 1/60 x 1/36 deg grid (about 1 nmi), 15 min steps, uo/vo/thetao and
+  the ice variables; BAL WAV — same grid, hourly, VHM0/VMDR/VTPK;
+* uo/vo/thetao/so have a depth axis (BAL PHY levels, 0.5 m down), -z/-Z pick
+  the levels as with ``--coordinates-selection-method nearest``, and cells
+  below a synthetic sea floor are NaN;
+* the grid is aligned to the product origin, so a subset has the same nodes
+  as the real one, and a fixed land mask gives NaN cells;
+* values are smooth functions of time and position with realistic ranges.
+
+FAKE_CM_DELAY_S adds a fixed latency per call; FAKE_CM_MBPS limits the
+simulated transfer rate (0 = unlimited), so a large subset takes
+proportionally longer. FAKE_CM_LOG appends every call to a file.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# охват и сетка продуктов BAL (узлы от начала охвата)
+LON_MIN, LON_MAX, LAT_MIN, LAT_MAX = 9.041667, 30.208334, 53.008335, 65.891667
+DLAT, DLON = 1 / 60.0, 1 / 36.0
+# уровни BAL PHY (м), прорежены; у реального продукта их 56
+DEPTHS = np.array([0.5, 1.56, 2.67, 3.86, 5.14, 6.54, 8.09, 9.82, 11.77, 14.0, 16.6, 19.7, 23.4, 27.9,
+                   33.4, 40.3, 48.9, 59.7, 73.4, 90.7, 112.5, 140.3, 175.3, 219.6, 275.6, 346.0, 434.9, 546.0])
+VARS_3D = ("uo", "vo", "thetao", "so")
+
+UNITS = {"uo": "m s-1", "vo": "m s-1", "thetao": "degrees_C", "so": "1e-3",
+         "VHM0": "m", "VMDR": "degree", "VTPK": "s", "VMXL": "m",
+         "siconc": "1", "sithick": "m", "siu": "m s-1", "siv": "m s-1"}
+
+
+def _axis(lo: float, hi: float, origin: float, step: float, top: float) -> np.ndarray:
+    lo, hi = max(lo, origin), min(hi, top)
+    i0 = int(np.ceil((lo - origin) / step - 1e-9))
+    i1 = int(np.floor((hi - origin) / step + 1e-9))
+    return origin + np.arange(i0, i1 + 1) * step
+
+
+def _land(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Грубая маска суши: «берега» по периметру охвата и пара «островов»."""
+    la, lo = lat[:, None], lon[None, :]
+    coast = (lo < 10.2) | (la > 65.7) | ((lo > 29.5) & (la < 59.5))
+    islands = ((la - 57.4) ** 2 / 0.12 + (lo - 18.6) ** 2 / 0.35 < 1) | ((la - 58.5) ** 2 / 0.1 + (lo - 22.5) ** 2 / 0.4 < 1)
+    return coast | islands
+
+
+def _bottom(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Глубина дна (м): мелководье у берегов, впадины до ~450 м."""
+    la, lo = np.radians(lat)[:, None], np.radians(lon)[None, :]
+    return 20 + 430 * np.abs(np.sin(7 * la) * np.cos(5 * lo)) ** 2
+
+
+def levels(z_min, z_max) -> np.ndarray:
+    """Уровни между ближайшими к -z и -Z (как --coordinates-selection-method nearest)."""
+    i0 = 0 if z_min is None else int(np.abs(DEPTHS - float(z_min)).argmin())
+    i1 = len(DEPTHS) - 1 if z_max is None else int(np.abs(DEPTHS - float(z_max)).argmin())
+    return DEPTHS[i0:i1 + 1]
+
+
+def column(name: str, t: np.ndarray, depth: np.ndarray, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Поле [time, depth, lat, lon]: затухание течений и термоклин с глубиной."""
+    surface = field(name, t, lat, lon)[:, None]
+    d = depth[None, :, None, None]
+    if name in ("uo", "vo"):
+        v = surface * np.exp(-d / 60.0)
+    elif name == "thetao":
+        v = surface - (surface - 4.5) * (1 - np.exp(-d / 35.0))
+    else:
+        v = surface + 4 * (1 - np.exp(-d / 70.0))
+    v = v.astype("f4")
+    v[:, depth[:, None, None] > _bottom(lat, lon)[None]] = np.nan
+    return v
+
+
+def field(name: str, t: np.ndarray, lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    hours = ((t - np.datetime64("2024-01-01")) / np.timedelta64(1, "h"))[:, None, None]
+    la, lo = np.radians(lat)[None, :, None], np.radians(lon)[None, None, :]
+    phase = 2 * np.pi * hours / 12.42  # полусуточный период
+    wave = np.sin(3 * la + phase) * np.cos(2 * lo - 0.3 * phase)
+    if name == "uo":
+        v = 0.25 * wave
+    elif name == "vo":
+        v = 0.2 * np.cos(3 * la - phase) * np.sin(2 * lo)
+    elif name == "thetao":
+        v = 8 + 6 * np.cos(2 * np.pi * hours / 8766) - 0.5 * (np.degrees(la) - 53) / 3 + 0.2 * wave
+    elif name == "so":
+        v = 7 - 0.4 * (np.degrees(la) - 53) + 0.1 * wave
+    elif name in ("VHM0", "VMXL"):
+        v = 1.4 + 1.2 * np.abs(wave)
+    elif name == "VMDR":
+        v = (200 + 90 * wave) % 360
+    elif name == "VTPK":
+        v = 5 + 2.5 * np.abs(wave)
+    elif name == "siconc":
+        v = np.clip((np.degrees(la) - 61.5) / 3 + 0.3 * wave, 0, 1)
+    elif name == "sithick":
+        v = 0.6 * np.clip((np.degrees(la) - 61.5) / 3, 0, 1) + 0.05 * np.abs(wave)
+    elif name in ("siu", "siv"):
+        v = 0.1 * (wave if name == "siu" else np.cos(2 * lo + phase))
+    else:
+        v = wave
+    v = np.broadcast_to(v, (len(t), len(lat), len(lon))).astype("f4")
+    v[:, _land(lat, lon)] = np.nan
+    return v
+
+
+def subset(dataset_id: str, variables, xmin: float, xmax: float, ymin: float, ymax: float,
+           t_start: str, t_end: str, z_min=None, z_max=None) -> xr.Dataset:
+    freq = "1h" if "wav" in dataset_id.lower() else "15min"
+    t0, t1 = (pd.Timestamp(v).tz_localize(None) for v in (t_start, t_end))  # время CLI — UTC
+    times = pd.date_range(t0.ceil(freq), t1, freq=freq)
+    if len(times) == 0:
+        # как CMDS: окно между сроками модели даёт ближайший срок
+        times = pd.DatetimeIndex([t0.round(freq)])
+    lat = _axis(ymin, ymax, LAT_MIN, DLAT, LAT_MAX)
+    lon = _axis(xmin, xmax, LON_MIN, DLON, LON_MAX)
+    if lat.size == 0 or lon.size == 0:
+        raise ValueError("requested area is outside of the dataset coverage")
+    t = times.values.astype("datetime64[ns]")
+    depth = levels(z_min, z_max)
+    data = {}
+    for v in variables:
+        if v in VARS_3D and "wav" not in dataset_id.lower():
+            data[v] = (("time", "depth", "latitude", "longitude"), column(v, t, depth, lat, lon),
+                       {"units": UNITS.get(v, "1")})
+        else:
+            data[v] = (("time", "latitude", "longitude"), field(v, t, lat, lon), {"units": UNITS.get(v, "1")})
+    coords = {"time": t, "latitude": lat.astype("f4"), "longitude": lon.astype("f4")}
+    if any(len(d) == 4 for d, _, _ in data.values()):
+        coords["depth"] = xr.Variable("depth", depth.astype("f4"), {"units": "m", "positive": "down"})
+    return xr.Dataset(data, coords=coords, attrs={"source": "bench/fake_copernicusmarine.py", "dataset_id": dataset_id})
+
+
+def main(argv) -> int:
+    if not argv:
+        print("usage: copernicusmarine {login,subset} ...", file=sys.stderr)
+        return 2
+    if argv[0] == "login":
+        return 0
+    p = argparse.ArgumentParser(prog="copernicusmarine subset")
+    p.add_argument("command", choices=["subset"])
+    p.add_argument("-i", "--dataset-id", required=True)
+    p.add_argument("-v", "--variable", action="append", required=True)
+    for opt in ("x", "X", "y", "Y"):
+        p.add_argument("-" + opt, type=float, required=True)
+    p.add_argument("-t", "--start-datetime", required=True)
+    p.add_argument("-T", "--end-datetime", required=True)
+    p.add_argument("-z", "--minimum-depth")
+    p.add_argument("-Z", "--maximum-depth")
+    p.add_argument("--coordinates-selection-method", default="inside")
+    p.add_argument("-o", "--output-directory", default=".")
+    p.add_argument("-f", "--output-filename", required=True)
+    p.add_argument("--file-format", default="netcdf")
+    a = p.parse_args(argv)
+    started = time.time()
+    if os.getenv("FAKE_CM_LOG"):
+        with open(os.environ["FAKE_CM_LOG"], "a", encoding="utf-8") as f:
+            f.write(" ".join(argv) + "\n")
+    try:
+        ds = subset(a.dataset_id, a.variable, a.x, a.X, a.y, a.Y, a.start_datetime, a.end_datetime,
+                    a.minimum_depth, a.maximum_depth)
+    except ValueError as e:
+        print(f"ERROR - {e}", file=sys.stderr)
+        return 1
+    os.makedirs(a.output_directory, exist_ok=True)
+    path = os.path.join(a.output_directory, a.output_filename)
+    ds.to_netcdf(path)
+    # имитация сети: задержка запроса + передача файла с ограниченной скоростью
+    mbps = float(os.getenv("FAKE_CM_MBPS", "0"))
+    wait = float(os.getenv("FAKE_CM_DELAY_S", "0")) + (os.path.getsize(path) / (mbps * 1e6 / 8) if mbps else 0.0)
+    time.sleep(max(0.0, wait - (time.time() - started)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
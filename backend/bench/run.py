@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Offline latency/throughput benchmark of the HydroMeteo API.
+
+Starts the WMTS stub (wmts_stub.py), puts a ``copernicusmarine`` shim for
+fake_copernicusmarine.py first on PATH, runs uvicorn with app.main against a
+throw-away CACHE_DIR and drives the endpoints at the requested concurrency.
+Nothing leaves the machine, so the numbers are comparable between runs on the
+same box. For every scenario it reports throughput and p50/p95/p99; with
+--baseline it compares against a previous --json report and exits with code 1
+when a p95 regressed by more than --max-regression percent.
+
+    cd backend && python -m bench.run --concurrency 16 --requests 300 --json bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import datetime as dt
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+import numpy as np
+
+from . import wmts_stub
+from .wmts_stub import LAYERS
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_copernicusmarine.py")
+
+# «горячие» точки на воде: повторные клики по ним — как у живых пользователей
+SEA_POINTS = [(59.5, 24.8), (59.9, 26.5), (60.1, 22.9), (58.8, 20.6), (57.9, 19.9), (56.2, 18.9),
+              (55.6, 15.7), (54.9, 13.9), (60.8, 19.6), (62.3, 20.2), (63.5, 21.3), (64.6, 23.4)]
+ICE_POINTS = [(63.5, 21.3), (64.6, 23.4), (65.0, 23.0), (62.9, 20.4), (60.2, 27.0)]
+
+Request = Tuple[str, str, Optional[dict]]  # метод, путь, JSON-тело
+
+
+def _iso(t: dt.datetime) -> str:
+    return t.replace(microsecond=0).isoformat() + "Z"
+
+
+def _now() -> dt.datetime:
+    return dt.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+
+def _point(rng: random.Random, pool: List[Tuple[float, float]], hot: int) -> Tuple[float, float]:
+    lat, lon = rng.choice(pool[:hot] if hot else pool)
+    # разброс внутри ячейки кэша subset — такие клики должны попадать в один ключ
+    return round(lat + rng.uniform(-0.01, 0.01), 4), round(lon + rng.uniform(-0.01, 0.01), 4)
+
+
+def req_timeseries(rng: random.Random, hot: int) -> Request:
+    lat, lon = _point(rng, SEA_POINTS, hot)
+    dataset, variable = rng.choice([("waves", "VHM0"), ("physics", "thetao"), ("physics", "uo")])
+    end = _now() + dt.timedelta(hours=rng.choice([0, 24, 48]))
+    body = {"dataset": dataset, "variable": variable, "lat": lat, "lon": lon,
+            "start_utc": _iso(end - dt.timedelta(hours=rng.choice([24, 72]))), "end_utc": _iso(end)}
+    return "POST", "/api/timeseries", body
+
+
+def req_currents_grid(rng: random.Random, hot: int) -> Request:
+    lat, lon = _point(rng, SEA_POINTS, hot)
+    w, h = rng.choice([(1.0, 0.5), (2.0, 1.0), (4.0, 2.0)])
+    body = {"min_lon": lon - w / 2, "max_lon": lon + w / 2, "min_lat": lat - h / 2, "max_lat": lat + h / 2,
+            "time_utc": _iso(_now() + dt.timedelta(hours=rng.randint(0, 6))), "max_arrows": 40}
+    return "POST", "/api/currents-grid", body
+
+
+def req_wmts_tile(rng: random.Random, hot: int) -> Request:
+    z = rng.randint(4, 7)
+    # тайлы над Балтикой (9–31E, 53–66N) в EPSG:3857
+    col = rng.randint(int((9 + 180) / 360 * 2 ** z), int((31 + 180) / 360 * 2 ** z))
+    row_n = int((1 - np.log(np.tan(np.radians(66)) + 1 / np.cos(np.radians(66))) / np.pi) / 2 * 2 ** z)
+    row_s = int((1 - np.log(np.tan(np.radians(53)) + 1 / np.cos(np.radians(53))) / np.pi) / 2 * 2 ** z)
+    query = (f"service=WMTS&request=GetTile&version=1.0.0&layer={rng.choice(LAYERS)}&style=cmap:amp"
+             f"&tilematrixset=EPSG:3857&tilematrix={z}&tilerow={rng.randint(row_n, row_s)}&tilecol={col}"
+             f"&format=image/png&time={_iso(_now())}")
+    return "GET", "/wmts/tile?" + query, None
+
+
+def req_ice(rng: random.Random, hot: int) -> Request:
+    lat, lon = _point(rng, ICE_POINTS, hot)
+    end = _now()
+    return "POST", "/api/ice-timeseries", {"lat": lat, "lon": lon, "start_utc": _iso(end - dt.timedelta(days=1)),
+                                           "end_utc": _iso(end)}
+
+
+SCENARIOS: Dict[str, Callable[[random.Random, int], Request]] = {
+    "timeseries": req_timeseries,
+    "currents_grid": req_currents_grid,
+    "wmts_tile": req_wmts_tile,
+    "ice": req_ice,
+}
+
+
+async def drive(base: str, make: Callable[[random.Random, int], Request], n: int, concurrency: int,
+                seed: int, hot: int) -> dict:
+    rng = random.Random(seed)
+    requests = [make(rng, hot) for _ in range(n)]
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    queue: "asyncio.Queue[Request]" = asyncio.Queue()
+    for r in requests:
+        queue.put_nowait(r)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base, timeout=300.0, limits=limits) as client:
+        async def worker():
+            while True:
+                try:
+                    method, path, body = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                t0 = time.perf_counter()
+                try:
+                    r = await client.request(method, path, json=body)
+                    await r.aread()
+                    status = r.status_code
+                except httpx.HTTPError:
+                    status = 0
+                latencies.append((time.perf_counter() - t0) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - started
+    ms = np.array(latencies)
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99]) if ms.size else (0.0, 0.0, 0.0)
+    errors = sum(c for s, c in statuses.items() if not 200 <= s < 400)
+    return {"requests": n, "concurrency": concurrency, "errors": errors, "statuses": statuses,
+            "throughput_rps": round(n / wall, 2), "p50_ms": round(float(p50), 1), "p95_ms": round(float(p95), 1),
+            "p99_ms": round(float(p99), 1), "max_ms": round(float(ms.max()) if ms.size else 0.0, 1)}
+
+
+def _shim(bin_dir: str) -> None:
+    os.makedirs(bin_dir, exist_ok=True)
+    if os.name == "nt":
+        with open(os.path.join(bin_dir, "copernicusmarine.bat"), "w") as f:
+            f.write(f'@"{sys.executable}" "{FAKE_CLI}" %*\n')
+        return
+    path = os.path.join(bin_dir, "copernicusmarine")
+    with open(path, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_CLI}" "$@"\n')
+    os.chmod(path, 0o755)
+
+
+def _wait_ready(base: str, proc: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"uvicorn завершился с кодом {proc.returncode}")
+        try:
+            if httpx.get(base + "/health", timeout=2.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+    raise RuntimeError("API не ответил на /health")
+
+
+def compare(report: dict, baseline: dict, max_regression: float) -> List[str]:
+    failures = []
+    for name, res in report["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if not old or not old.get("p95_ms"):
+            continue
+        change = (res["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+        if change > max_regression:
+            failures.append(f"{name}: p95 {old['p95_ms']} -> {res['p95_ms']} ms (+{change:.0f}%)")
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline HydroMeteo API benchmark")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="через запятую: " + ",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="запросов на сценарий")
+    parser.add_argument("--warmup", type=int, default=0, help="запросов на сценарий до замера (не считаются)")
+    parser.add_argument("--hot", type=int, default=4, help="число «горячих» точек (0 — все)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cm-delay-ms", type=float, default=300.0, help="задержка одного вызова фейкового CLI")
+    parser.add_argument("--cm-mbps", type=float, default=50.0, help="скорость «скачивания» subset (0 — без предела)")
+    parser.add_argument("--wmts-latency-ms", type=float, default=40.0)
+    parser.add_argument("--ingest", action="store_true",
+                        help="до замера наполнить локальный куб через app.ingest (по фейковому CLI)")
+    parser.add_argument("--ingest-bbox", default="17,27,56,62")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--workers", type=int, default=1, help="процессов uvicorn")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для API (можно несколько)")
+    parser.add_argument("--json", help="сохранить отчёт в файл")
+    parser.add_argument("--baseline", help="отчёт прошлого прогона (--json) для сравнения")
+    parser.add_argument("--max-regression", type=float, default=20.0, help="допустимый рост p95, %%")
+    parser.add_argument("--keep", action="store_true", help="не удалять временный каталог")
+    args = parser.parse_args()
+    names = [s for s in args.scenarios.split(",") if s]
+    unknown = [s for s in names if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+
+    work = tempfile.mkdtemp(prefix="hydrometeo-bench-")
+    stub, wmts_url = wmts_stub.serve(latency_s=args.wmts_latency_ms / 1000)
+    _shim(os.path.join(work, "bin"))
+    env = dict(os.environ)
+    env.pop("COPERNICUSMARINE_USERNAME", None)
+    env.pop("COPERNICUSMARINE_PASSWORD", None)
+    env.update({
+        "PATH": os.path.join(work, "bin") + os.pathsep + env.get("PATH", ""),
+        "CACHE_DIR": os.path.join(work, "cache"),
+        "CMDS_WMTS_BASE": wmts_url,
+        "PREFETCH_ENABLED": "0",
+        "FAKE_CM_DELAY_S": str(args.cm_delay_ms / 1000),
+        "FAKE_CM_MBPS": str(args.cm_mbps),
+        "FAKE_CM_LOG": os.path.join(work, "cli.log"),
+        "INGEST_BBOX": args.ingest_bbox,
+        "INGEST_BOOTSTRAP_H": "48",
+        # только верхний уровень PHY, как было до оси глубины в фейковом CLI
+        "INGEST_PHY_MAX_DEPTH": "0",
+        "PYTHONPATH": BACKEND + os.pathsep + env.get("PYTHONPATH", ""),
+    })
+    env.update(kv.split("=", 1) for kv in args.env)
+    proc = None
+    try:
+        if args.ingest:
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, "-m", "app.ingest", "--kinds", "phy,wav,ice"],
+                           cwd=BACKEND, env=env, check=True)
+            print(f"[*] ingest: {time.perf_counter() - t0:.1f} s")
+        proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                                 "--port", str(args.port), "--workers", str(args.workers), "--log-level", "warning"],
+                                cwd=BACKEND, env=env)
+        base = f"http://127.0.0.1:{args.port}"
+        _wait_ready(base, proc)
+        report = {"started": _iso(dt.datetime.utcnow()), "args": vars(args), "scenarios": {}}
+        print(f"{'scenario':<14}{'n':>6}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (ms)")
+        for i, name in enumerate(names):
+            if args.warmup:
+                asyncio.run(drive(base, SCENARIOS[name], args.warmup, args.concurrency, args.seed + 1000 + i, args.hot))
+            res = asyncio.run(drive(base, SCENARIOS[name], args.requests, args.concurrency, args.seed + i, args.hot))
+            report["scenarios"][name] = res
+            print(f"{name:<14}{res['requests']:>6}{res['errors']:>5}{res['throughput_rps']:>9}"
+                  f"{res['p50_ms']:>9}{res['p95_ms']:>9}{res['p99_ms']:>9}{res['max_ms']:>9}")
+        try:
+            with open(os.path.join(work, "cli.log"), encoding="utf-8") as f:
+                report["cli_calls"] = sum(1 for line in f if line.startswith("subset"))
+        except OSError:
+            report["cli_calls"] = 0
+        print(f"[*] CLI subset calls: {report['cli_calls']}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                failures = compare(report, json.load(f), args.max_regression)
+            for line in failures:
+                print(f"[!] regression: {line}")
+            if failures:
+                return 1
+        return 0
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        stub.shutdown()
+        if args.keep:
+            print(f"[*] kept: {work}")
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
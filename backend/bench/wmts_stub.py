@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Local stand-in for the Copernicus Marine WMTS endpoint.
+
+Answers GetCapabilities with a small document (one layer per Baltic product
+variable, EPSG:3857 matrix set, hourly time dimension around now) and GetTile
+with a deterministic PNG per tile, with ETag / Cache-Control and 304 on
+If-None-Match, so the backend's tile cache and revalidation paths behave as
+against the real service. Latency per request is configurable.
+"""
+
+import zlib
+import time
+import struct
+import hashlib
+import argparse
+import threading
+import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+LAYERS = (
+    "BALTICSEA_ANALYSISFORECAST_WAV_003_010/cmems_mod_bal_wav_anfc_PT1H-i/VHM0",
+    "BALTICSEA_ANALYSISFORECAST_PHY_003_006/cmems_mod_bal_phy_anfc_PT15M-i/thetao",
+    "BALTICSEA_ANALYSISFORECAST_PHY_003_006/cmems_mod_bal_phy_anfc_PT15M-i/siconc",
+)
+
+
+def capabilities_xml() -> bytes:
+    now = dt.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+    t0, t1 = now - dt.timedelta(days=10), now + dt.timedelta(days=3)
+    fmt = lambda t: t.isoformat() + "Z"
+    layers = "".join(
+        f"<Layer><ows:Title>{lid.rsplit('/', 1)[-1]}</ows:Title>"
+        "<ows:WGS84BoundingBox><ows:LowerCorner>9 53</ows:LowerCorner><ows:UpperCorner>31 66</ows:UpperCorner>"
+        f"</ows:WGS84BoundingBox><ows:Identifier>{lid}</ows:Identifier>"
+        '<Style isDefault="true"><ows:Identifier>cmap:amp</ows:Identifier></Style><Format>image/png</Format>'
+        "<TileMatrixSetLink><TileMatrixSet>EPSG:3857</TileMatrixSet></TileMatrixSetLink>"
+        f"<Dimension><ows:Identifier>time</ows:Identifier><Default>{fmt(now)}</Default>"
+        f"<Value>{fmt(t0)}/{fmt(t1)}/PT1H</Value></Dimension></Layer>"
+        for lid in LAYERS)
+    matrices = "".join(
+        f"<TileMatrix><ows:Identifier>{z}</ows:Identifier><ScaleDenominator>{559082264.0287178 / 2 ** z}"
+        "</ScaleDenominator><TopLeftCorner>-20037508.34 20037508.34</TopLeftCorner><TileWidth>256</TileWidth>"
+        f"<TileHeight>256</TileHeight><MatrixWidth>{2 ** z}</MatrixWidth><MatrixHeight>{2 ** z}</MatrixHeight>"
+        "</TileMatrix>" for z in range(11))
+    return ('<?xml version="1.0"?><Capabilities xmlns="http://www.opengis.net/wmts/1.0" '
+            'xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0"><ows:ServiceIdentification>'
+            "<ows:Title>WMTS stub</ows:Title></ows:ServiceIdentification><Contents>" + layers +
+            "<TileMatrixSet><ows:Identifier>EPSG:3857</ows:Identifier><ows:SupportedCRS>EPSG:3857"
+            "</ows:SupportedCRS>" + matrices + "</TileMatrixSet></Contents></Capabilities>").encode("utf-8")
+
+
+def png_tile(seed: str, size: int = 256) -> bytes:
+    """Настоящий PNG (RGB, градиент от seed) — объём и сжатие как у тайла с полем."""
+    h = hashlib.sha1(seed.encode("utf-8")).digest()
+    row = bytes((h[i % 20] + i) & 0xFF for i in range(size * 3))
+    raw = b"".join(b"\x00" + row[y % 7:] + row[:y % 7] for y in range(size))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency_s = 0.0
+    max_age_s = 3600
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes = b"", headers: Tuple[Tuple[str, str], ...] = ()) -> None:
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        query = {k.lower(): v for k, v in parse_qsl(urlsplit(self.path).query)}
+        req = query.get("request", "").lower()
+        if req == "getcapabilities":
+            body = capabilities_xml()
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, headers=(("ETag", etag),))
+            return self._send(200, body, (("Content-Type", "application/xml"), ("ETag", etag)))
+        if req == "gettile":
+            seed = "|".join(query.get(k, "") for k in ("layer", "time", "tilematrix", "tilerow", "tilecol"))
+            etag = '"' + hashlib.sha1(seed.encode("utf-8")).hexdigest() + '"'
+            headers = (("ETag", etag), ("Cache-Control", f"max-age={self.max_age_s}"))
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, headers=headers)
+            return self._send(200, png_tile(seed), (("Content-Type", "image/png"),) + headers)
+        self._send(400, b"unsupported request", (("Content-Type", "text/plain"),))
+
+
+def serve(host: str = "127.0.0.1", port: int = 0, latency_s: float = 0.0,
+          max_age_s: int = 3600) -> Tuple[ThreadingHTTPServer, str]:
+    """Запустить заглушку в фоновом потоке; вернуть (сервер, базовый URL)."""
+    handler = type("Handler", (StubHandler,), {"latency_s": latency_s, "max_age_s": max_age_s})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/teroWmts"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WMTS stub for offline benchmarks")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+    server, url = serve(port=args.port, latency_s=args.latency_ms / 1000)
+    print(f"[*] WMTS stub: {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
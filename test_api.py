@@ -2,12 +2,28 @@
 # -*- coding: utf-8 -*-
 """Тестовый скрипт для проверки работы HydroMeteo API"""
 
+import os
+import sys
 import requests
 import json
 from datetime import datetime, timedelta
 
 BASE_URL = "http://localhost:8000"
 
+def _iso(t):
+    return t.replace(microsecond=0).isoformat() + "Z"
+
+def _window(hours_back=24, hours_ahead=24):
+    now = datetime.utcnow()
+    return _iso(now - timedelta(hours=hours_back)), _iso(now + timedelta(hours=hours_ahead))
+
+def _report(name, response, summary):
+    if response.status_code == 200:
+        print(f"✅ {name}: {summary(response)}")
+    else:
+        print(f"❌ {name} failed: {response.status_code}")
+        print(f"   {response.text[:300]}")
+
 def test_health():
     """Тест health endpoint"""
     response = requests.get(f"{BASE_URL}/health")
@@ -53,10 +69,153 @@ def test_ice():
     else:
         print(f"❌ Ice data failed: {response.status_code}")
 
+def test_aggregate():
+    """Свёртки area-stats на маленьком массиве с сушей (NaN) — без API, детерминированно"""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+    import numpy as np
+    from app.aggregate import AreaStats, Region, Step, exceed_step, reduce_step
+
+    nan = np.nan
+    # (0, 0) и (1, 2) — суша на обоих сроках
+    step1 = np.array([[nan, 1.0, 2.0], [0.5, 3.0, nan]])
+    step2 = np.array([[nan, 2.5, 0.0], [1.5, 1.0, nan]])
+
+    part = reduce_step(step1, (0.0, 4.0))
+    assert (part.count, part.total, part.total_sq, part.vmin, part.vmax) == (4, 6.5, 14.25, 0.5, 3.0)
+    assert part.hist.sum() == 4
+    empty = reduce_step(np.full((2, 2), nan), None)
+    assert empty.count == 0 and empty.hist is None
+
+    ex = exceed_step(step1, "gt", 1.5)
+    assert (ex.count, ex.valid, ex.cells) == (2, 4, 6)
+    assert np.unpackbits(ex.bits)[:ex.cells].tolist() == [0, 0, 1, 0, 1, 0]
+    assert np.unpackbits(ex.wet)[:ex.cells].tolist() == [0, 1, 1, 1, 1, 0]
+    assert exceed_step(step1, "le", 1.0).count == 2  # NaN не проходит ни одно сравнение
+
+    lats, lons = np.array([0.0, 1.0]), np.array([0.0, 1.0, 2.0])
+    t0 = np.datetime64("2024-01-01T00:00")
+    steps = [Step(None, t0, lambda: (step1, lats, lons)),
+             Step(None, t0 + np.timedelta64(1, "h"), lambda: (step2, lats, lons))]
+    out = AreaStats(1 << 20).run(steps, "VHM0", {}, Region(bbox=[-1, -1, 3, 2]), thresholds=[("gt", 1.5)])
+    assert (out["steps"], out["count"], out["min"], out["max"]) == (2, 8, 0.0, 3.0)
+    assert abs(out["mean"] - 11.5 / 8) < 1e-12
+    e = out["exceedance"][0]
+    # 2 и 1 узел из 4 морских; суша не входит в знаменатели
+    assert (e["area_pct_max"], e["area_pct_mean"]) == (50.0, 37.5)
+    assert (e["hours_max"], e["hours_mean"], e["area_pct_ever"]) == (1.0, 0.75, 75.0)
+    print("✅ Aggregate: reduce_step / exceed_step / AreaStats.run")
+
+def test_timeseries_binary():
+    """Тест бинарного ответа временного ряда (?format=f32)"""
+    start, end = _window(48, 0)
+    payload = {"dataset": "waves", "variable": "VHM0", "lat": 59.5, "lon": 24.8, "start_utc": start, "end_utc": end}
+    response = requests.post(f"{BASE_URL}/api/timeseries", params={"format": "f32"}, json=payload)
+    if response.status_code == 200 and not response.content.startswith(b"HMF1"):
+        print(f"❌ Timeseries f32: неожиданный ответ {response.headers.get('content-type')}")
+        return
+    _report("Timeseries f32", response,
+            lambda r: f"{len(r.content)} байт, {r.headers.get('content-type')}")
+
+def test_batch():
+    """Тест пакетных рядов по нескольким точкам"""
+    start, end = _window(24, 24)
+    payload = {
+        "dataset": "waves",
+        "variables": ["VHM0", "VMDR"],
+        "points": [{"id": "tallinn", "lat": 59.5, "lon": 24.8}, {"id": "gotland", "lat": 57.4, "lon": 19.1}],
+        "start_utc": start,
+        "end_utc": end
+    }
+    response = requests.post(f"{BASE_URL}/api/timeseries/batch", json=payload)
+    _report("Batch", response, lambda r: f"{len(r.json()['times_utc'])} сроков, "
+                                          f"переменные {', '.join(r.json()['values'])}")
+
+def test_track():
+    """Тест значений вдоль маршрута судна"""
+    now = datetime.utcnow()
+    payload = {
+        "variables": {"waves": ["VHM0"], "physics": ["uo", "vo"]},
+        "points": [
+            {"lat": 59.45, "lon": 24.75, "time_utc": _iso(now)},
+            {"lat": 59.7, "lon": 23.0, "time_utc": _iso(now + timedelta(hours=3))},
+            {"lat": 59.8, "lon": 21.0, "time_utc": _iso(now + timedelta(hours=6))}
+        ]
+    }
+    response = requests.post(f"{BASE_URL}/api/track", json=payload)
+    _report("Track", response, lambda r: ", ".join(f"{k}={v}" for k, v in r.json()["values"].items()))
+
+def test_area_stats():
+    """Тест статистики по области с процентилями и превышениями"""
+    start, end = _window(0, 24)
+    payload = {
+        "dataset": "waves",
+        "variable": "VHM0",
+        "bbox": [19.0, 57.0, 21.0, 58.5],
+        "start_utc": start,
+        "end_utc": end,
+        "percentiles": [50, 95],
+        "thresholds": [1.0, 2.0]
+    }
+    response = requests.post(f"{BASE_URL}/api/area-stats", json=payload)
+    _report("Area stats", response, lambda r: f"mean={r.json()['stats'].get('mean')}, "
+                                               f"превышений: {len(r.json()['exceedance'])}")
+
+def test_grids():
+    """Тест сеток: течения, разрез по глубине и профиль"""
+    bbox = {"min_lon": 19.0, "min_lat": 57.0, "max_lon": 21.0, "max_lat": 58.5}
+    response = requests.post(f"{BASE_URL}/api/currents-grid", json=dict(bbox, max_arrows=20))
+    _report("Currents grid", response, lambda r: f"{len(r.json()['u'])} стрелок")
+    response = requests.post(f"{BASE_URL}/api/depth-grid", json=dict(bbox, variables=["thetao"], depth=10, max_cells=20))
+    _report("Depth grid", response, lambda r: f"{len(r.json()['lons'])}×{len(r.json()['lats'])} узлов")
+    response = requests.post(f"{BASE_URL}/api/profile", json={"lat": 57.4, "lon": 19.15, "max_depth": 100})
+    _report("Profile", response, lambda r: f"{len(r.json()['depths'])} уровней")
+
+def test_xyz_tile():
+    """Тест XYZ-тайла данных (Готланд, z=5) и его повторной выдачи по ETag"""
+    t = _iso(datetime.utcnow().replace(minute=0, second=0))
+    response = requests.get(f"{BASE_URL}/tiles/waves/{t}/5/17/9")
+    if response.status_code == 200 and not response.content.startswith(b"HMF1"):
+        print(f"❌ XYZ tile: неожиданный ответ {response.headers.get('content-type')}")
+        return
+    _report("XYZ tile", response, lambda r: f"{len(r.content)} байт")
+    etag = response.headers.get("etag")
+    if response.status_code == 200 and etag:
+        again = requests.get(f"{BASE_URL}/tiles/waves/{t}/5/17/9", headers={"If-None-Match": etag})
+        print(f"{'✅' if again.status_code == 304 else '❌'} XYZ tile по ETag: {again.status_code}")
+
+def test_alerts():
+    """Тест правил оповещений: создание, снимок, поток SSE, удаление"""
+    rule = {"name": "test_api", "dataset": "waves", "variable": "VHM0", "op": "gt", "threshold": 0.5,
+            "lat": 57.4, "lon": 19.15, "horizon_h": 24}
+    response = requests.post(f"{BASE_URL}/api/alerts/rules", json=rule)
+    _report("Alert rule", response, lambda r: f"id={r.json()['rule']['id']}, состояние {r.json()['alert']}")
+    if response.status_code != 200:
+        return
+    rule_id = response.json()["rule"]["id"]
+    try:
+        response = requests.get(f"{BASE_URL}/api/alerts/rules")
+        _report("Alert rules", response, lambda r: f"{len(r.json()['rules'])} правил")
+        response = requests.get(f"{BASE_URL}/api/alerts", params={"rules": rule_id})
+        _report("Alerts", response, lambda r: f"id={r.json()['id']}, оповещений {len(r.json()['alerts'])}")
+        with requests.get(f"{BASE_URL}/api/alerts/stream", params={"rules": rule_id}, stream=True, timeout=10) as r:
+            lines = []
+            for line in r.iter_lines(decode_unicode=True):
+                if not line:
+                    break
+                lines.append(line)
+            event = dict(line.split(": ", 1) for line in lines if ": " in line)
+            ok = r.status_code == 200 and event.get("event") == "snapshot" and "id" in event
+            print(f"{'✅' if ok else '❌'} Alerts stream: {event.get('event')} id={event.get('id')}")
+    finally:
+        response = requests.delete(f"{BASE_URL}/api/alerts/rules/{rule_id}")
+        _report("Alert rule delete", response, lambda r: r.json()["deleted"])
+
 if __name__ == "__main__":
     print("ТЕСТИРОВАНИЕ HYDROMETEO API")
     print("=" * 40)
-    
+
+    test_aggregate()
+
     try:
         # Проверка доступности
         health_data = test_health()
@@ -65,7 +224,14 @@ if __name__ == "__main__":
         if health_data.get("cm_user"):
             print("\n📊 Тестирование с реальными данными...")
             test_timeseries()
+            test_timeseries_binary()
+            test_batch()
             test_ice()
+            test_track()
+            test_area_stats()
+            test_grids()
+            test_xyz_tile()
+            test_alerts()
         else:
             print("\n⚠️ Учетные данные CMDS не настроены")
             print("   Заполните COPERNICUSMARINE_USERNAME и COPERNICUSMARINE_PASSWORD в backend/.env")